@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark parsing gzipped jellyfish dumps: the line by line text parser that
+check_kmer_consistency.py.py used before, against the bulk parser in kmers.py with each
+available gzip reader.  Writes <parser><TAB><reader><TAB><seconds><TAB><million lines/s>.
+"""
+
+__version__ = "0.1.0"
+
+
+import argparse
+import gzip
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from kmers import BLOCK_SIZE, gzip_readers, iter_kmer_counts, open_decompressed, sorted_unique
+
+
+def write_dump(path, n_kmers, k, seed=1):
+    """Write a gzipped dump of n_kmers random k-mers and counts."""
+    rng = np.random.default_rng(seed)
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    with gzip.open(path, "wt", compresslevel=6) as f:
+        for start in range(0, n_kmers, 1 << 20):
+            n = min(1 << 20, n_kmers - start)
+            kmers = bases[rng.integers(0, 4, size=(n, k))]
+            counts = rng.geometric(0.2, size=n)
+            f.writelines(
+                f"{kmer.tobytes().decode()}\t{count}\n" for kmer, count in zip(kmers, counts)
+            )
+
+
+def legacy_read_kmers(kmers_tsv, solid_count=5):
+    """Read sets of all and solid kmers line by line, as check_kmer_consistency.py.py did."""
+    kmers = set()
+    solid_kmers = set()
+    with io.TextIOWrapper(gzip.open(kmers_tsv)) as f:
+        for line in f:
+            kmer, count = line.rstrip("\n").split()
+            count = int(count)
+            kmers.add(kmer)
+            if count >= solid_count:
+                solid_kmers.add(kmer)
+    return kmers, solid_kmers
+
+
+def bulk_read_kmers(kmers_tsv, solid_count=5, reader=None, block_size=BLOCK_SIZE):
+    """Read sorted arrays of all and solid packed kmers with the bulk parser."""
+    kmers = [np.zeros(0, dtype=np.uint64)]
+    solid_kmers = [np.zeros(0, dtype=np.uint64)]
+    with open_decompressed(kmers_tsv, reader) as f:
+        for block_kmers, counts, _ in iter_kmer_counts(f, block_size):
+            kmers.append(block_kmers)
+            solid_kmers.append(block_kmers[counts >= solid_count])
+    return sorted_unique(np.concatenate(kmers)), sorted_unique(np.concatenate(solid_kmers))
+
+
+def best_time(repeat, read, *args, **kwargs):
+    """Return the fastest of repeat runs and the result of the last."""
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = read(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(args):
+    with tempfile.TemporaryDirectory(prefix="benchmark_read_kmers.") as tmpdir:
+        dump = args.dump
+        if dump is None:
+            dump = os.path.join(tmpdir, "kmers.tsv.gz")
+            write_dump(dump, args.kmers, args.k)
+        with gzip.open(dump, "rb") as f:
+            n_lines = sum(block.count(b"\n") for block in iter(lambda: f.read(BLOCK_SIZE), b""))
+
+        results = list()
+        if not args.skip_legacy:
+            seconds, (kmers, solid_kmers) = best_time(args.repeat, legacy_read_kmers, dump)
+            legacy_counts = (len(kmers), len(solid_kmers))
+            del kmers, solid_kmers
+            results.append(("legacy", "gzip", seconds))
+        for reader in gzip_readers():
+            seconds, (kmers, solid_kmers) = best_time(
+                args.repeat, bulk_read_kmers, dump, reader=reader, block_size=args.block_size
+            )
+            if not args.skip_legacy and (len(kmers), len(solid_kmers)) != legacy_counts:
+                raise RuntimeError(f"bulk parser with {reader} read different kmers than the legacy parser")
+            results.append(("bulk", reader, seconds))
+
+    print("parser\treader\tseconds\tmillion_lines_per_s")
+    for parser, reader, seconds in results:
+        print(f"{parser}\t{reader}\t{seconds:0.3f}\t{n_lines / seconds / 1e6:0.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "dump", nargs="?", default=None, help="Gzipped kmer counts (kmer<TAB>count); by default, a random dump"
+    )
+    parser.add_argument("--kmers", default=2_000_000, type=int, help="Lines of the random dump")
+    parser.add_argument("-k", default=31, type=int, help="Kmer length of the random dump")
+    parser.add_argument("--repeat", default=3, type=int, help="Report the fastest of this many runs")
+    parser.add_argument("--block-size", default=BLOCK_SIZE, type=int, help="Bytes to parse at a time")
+    parser.add_argument("--skip-legacy", action="store_true", help="Only benchmark the bulk parser")
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version=__version__),
+    )
+
+    args = parser.parse_args()
+    main(args)
@@ -8,64 +8,113 @@ with each other.  It is preferred that kmer counts be filtered
 to only report modimers.
 """
 
-__version__ = "0.2.0"
+__version__ = "0.6.2"
 
 
 import argparse
-import gzip
-import io
+import collections
+import itertools
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+
+from kmers import decompressed, is_kmer_counts_file, iter_kmer_counts, read_kmer_counts, sorted_unique
 
 THRESHOLD = 0.03  # empirically determined threshold for kmer consistency
 
+# number of bits set in each byte value
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+# reference kmers as packed bitmaps over the reference kmers, and non-reference kmers as sorted arrays
+KmerSplit = collections.namedtuple("KmerSplit", ["ref_all", "ref_solid", "nonref_all", "nonref_solid"])
+
 
 def read_kmers(kmers_tsv, solid_count=5, return_solid=False):
-    """Read kmers and counts from a tsv file.
-    Return a set of all kmers and optionally a set of solid kmers.
+    """Read kmers and counts from a tsv file, optionally gzipped, or a binary
+    kmer counts file from jellyfish_dump_to_kmers.py.
+    Return a tuple of a sorted array of all kmers, packed 2 bits per base, and
+    optionally a sorted array of solid kmers, and the kmer length k (None for an
+    empty text file).
     """
-    kmers = set()
-    solid_kmers = set()
-    with io.TextIOWrapper(gzip.open(kmers_tsv)) as f:
-        for line in f:
-            kmer, count = line.rstrip("\n").split()
-            count = int(count)
-            kmers.add(kmer)
-            # a kmer is solid if it is seen at least solid_count times
-            if count >= solid_count:
-                solid_kmers.add(kmer)
+    k = None
+    # open once and peek at the format, so that pipes and process substitutions can be read
+    with open(kmers_tsv, "rb") as f:
+        if is_kmer_counts_file(f):
+            kmers, counts, k = read_kmer_counts(f)
+            if return_solid:
+                return (kmers, kmers[counts >= solid_count]), k
+            else:
+                return (kmers, ), k
+        kmers = [np.zeros(0, dtype=np.uint64)]
+        solid_kmers = [np.zeros(0, dtype=np.uint64)]
+        with decompressed(f) as dump:
+            for block_kmers, counts, k in iter_kmer_counts(dump):
+                kmers.append(block_kmers)
+                # a kmer is solid if it is seen at least solid_count times
+                solid_kmers.append(block_kmers[counts >= solid_count])
+    kmers = sorted_unique(np.concatenate(kmers))
     if return_solid:
-        return (kmers, solid_kmers)
+        return (kmers, sorted_unique(np.concatenate(solid_kmers))), k
     else:
-        return (kmers, )
+        return (kmers, ), k
 
 
-def kmer_inconsistency(ds1_kmers, ds2_kmers, refkmers):
+def isin_sorted(values, sorted_kmers):
+    """Return a mask of values in the sorted array sorted_kmers."""
+    if len(sorted_kmers) == 0:
+        return np.zeros(len(values), dtype=bool)
+    ix = np.searchsorted(sorted_kmers, values)
+    ix[ix == len(sorted_kmers)] = 0
+    return sorted_kmers[ix] == values
+
+
+def ref_bitmap(kmers, refkmers):
+    """Return the non-reference kmers of a sorted kmer array and a packed bitmap
+    of the reference kmers it contains, indexed by their position in refkmers.
     """
-    For each pair of datasets, count the number of shared and unique
-    reference and non-reference kmers.  Use the count of unique reference
-    kmers to adjust for undersampling (i.e. low coverage) since they are
-    likely shared between any two humans.
+    ix = np.searchsorted(refkmers, kmers)
+    is_ref = np.zeros(len(kmers), dtype=bool)
+    in_range = ix < len(refkmers)
+    is_ref[in_range] = refkmers[ix[in_range]] == kmers[in_range]
+    bitmap = np.zeros(len(refkmers), dtype=bool)
+    bitmap[ix[is_ref]] = True
+    return kmers[~is_ref], np.packbits(bitmap)
+
+
+def split_kmers(ds_kmers, refkmers):
+    """Split the (all, solid) kmers of a dataset into reference kmers, as packed
+    bitmaps over refkmers, and sorted arrays of non-reference kmers.
     """
-    # unpack kmers tuples
-    ds1_allkmers, ds1_solidkmers = ds1_kmers
-    ds2_allkmers, ds2_solidkmers = ds2_kmers
-
-    # kmers solid in at least one dataset
-    solidkmers = ds1_solidkmers | ds2_solidkmers
-    # "shared" kmers solid in at least one dataset and present in both
-    sharedsolidkmers = solidkmers & ds1_allkmers & ds2_allkmers
-    # "unique" kmers solid in one dataset and absent in the other
-    uniquekmers = solidkmers - sharedsolidkmers
-    # all "shared" kmers whether or not they are solid
-    sharedkmers = ds1_allkmers & ds2_allkmers
-
-    # count separately for reference and non-reference kmers
-    ref_shared = len(sharedkmers & refkmers)
-    ref_unique = len(uniquekmers & refkmers)
+    ds_allkmers, ds_solidkmers = ds_kmers
+    nonref_all, ref_all = ref_bitmap(ds_allkmers, refkmers)
+    nonref_solid, ref_solid = ref_bitmap(ds_solidkmers, refkmers)
+    return KmerSplit(ref_all, ref_solid, nonref_all, nonref_solid)
+
+
+def popcount(bitmap):
+    return int(POPCOUNT[bitmap].sum())
+
+
+def split_inconsistency(ds1_split, ds2_split):
+    """
+    kmer_inconsistency of two datasets split by split_kmers.  A kmer is "unique"
+    if it is solid in one dataset and absent in the other, so the unique kmers of
+    each dataset are disjoint and are counted separately.
+    """
+    ref_shared = popcount(ds1_split.ref_all & ds2_split.ref_all)
+    ref_unique = popcount(ds1_split.ref_solid & ~ds2_split.ref_all) + popcount(
+        ds2_split.ref_solid & ~ds1_split.ref_all
+    )
     refkmer_inconsistency = (
         0 if ref_unique == 0 else ref_unique / (ref_shared + ref_unique)
     )
-    nonref_shared = len(sharedkmers - refkmers)
-    nonref_unique = len(uniquekmers - refkmers)
+    nonref_shared = int(np.count_nonzero(isin_sorted(ds1_split.nonref_all, ds2_split.nonref_all)))
+    nonref_unique = int(
+        np.count_nonzero(~isin_sorted(ds1_split.nonref_solid, ds2_split.nonref_all))
+        + np.count_nonzero(~isin_sorted(ds2_split.nonref_solid, ds1_split.nonref_all))
+    )
     nonrefkmer_inconsistency = (
         0 if nonref_unique == 0 else nonref_unique / (nonref_shared + nonref_unique)
     )
@@ -74,41 +123,136 @@ def kmer_inconsistency(ds1_kmers, ds2_kmers, refkmers):
     return max(0, nonrefkmer_inconsistency - refkmer_inconsistency)
 
 
-def main(args):
-    # Read the reference kmers/modimers
-    refkmers = read_kmers(args.ref_kmers_tsv, return_solid=False)[0]
+def kmer_inconsistency(ds1_kmers, ds2_kmers, refkmers):
+    """
+    For each pair of datasets, count the number of shared and unique
+    reference and non-reference kmers.  Use the count of unique reference
+    kmers to adjust for undersampling (i.e. low coverage) since they are
+    likely shared between any two humans.
+    Kmers are sorted arrays of unique packed kmers, as returned by read_kmers.
+    """
+    return split_inconsistency(split_kmers(ds1_kmers, refkmers), split_kmers(ds2_kmers, refkmers))
 
-    # Read the kmers for each sample
-    datasetkmers = list()
-    for ds in args.dataset_kmers_tsv:
-        datasetkmers.append(read_kmers(ds, return_solid=True))
 
-    print("movieA\tmovieB\tadjusted_nonref_inconsistency\tconsistent")
-    for ds1ix in range(len(args.dataset_kmers_tsv)):
-        movie1 = (".").join(args.dataset_kmers_tsv[ds1ix].split("/")[-1].split(".")[0:-3])
-        for ds2ix in range(ds1ix + 1, len(args.dataset_kmers_tsv)):
-            movie2 = (".").join(args.dataset_kmers_tsv[ds2ix].split("/")[-1].split(".")[0:-3])
+# Worker state: the reference kmers and dataset splits, memory mapped from the
+# files in _worker_tmpdir when run in a process pool, or held in memory
+_worker_tmpdir = None
+_worker_refkmers = None
+_worker_splits = dict()
+
+
+def _init_worker(tmpdir, refkmers=None):
+    global _worker_tmpdir, _worker_refkmers, _worker_splits
+    _worker_tmpdir = tmpdir
+    if tmpdir is not None:
+        refkmers = np.load(os.path.join(tmpdir, "ref.npy"), mmap_mode="r")
+    _worker_refkmers = refkmers
+    _worker_splits = dict()
+
+
+def _split_path(ix, field):
+    return os.path.join(_worker_tmpdir, f"{ix}.{field}.npy")
+
+
+def _split_dataset(ix, kmers_tsv):
+    """Read and split the kmers of a dataset, and save the split for _pair_inconsistency.
+    Return the kmer length of the dataset.
+    """
+    ds_kmers, k = read_kmers(kmers_tsv, return_solid=True)
+    split = split_kmers(ds_kmers, _worker_refkmers)
+    if _worker_tmpdir is None:
+        _worker_splits[ix] = split
+        return k
+    for field, array in zip(split._fields, split):
+        np.save(_split_path(ix, field), array)
+    return k
+
+
+def check_kmer_lengths(ref_kmers_tsv, ref_k, dataset_kmers_tsv, dataset_ks):
+    """Raise ValueError unless all datasets have the kmer length of the reference, as packed
+    kmers of different lengths can be equal.  Empty text files have no kmer length.
+    """
+    if ref_k is None:
+        ref_k = next((k for k in dataset_ks if k is not None), None)
+    for kmers_tsv, k in zip(dataset_kmers_tsv, dataset_ks):
+        if k is not None and k != ref_k:
+            raise ValueError(f"{kmers_tsv} has {k}-mers, but {ref_kmers_tsv} has {ref_k}-mers")
 
-            adjusted_nonrefkmer_inconsistency = kmer_inconsistency(
-                datasetkmers[ds1ix], datasetkmers[ds2ix], refkmers
-            )
-            inconsistent = (
-                "YES" if adjusted_nonrefkmer_inconsistency < THRESHOLD else "NO"
-            )
 
-            print(
-                f"{movie1}\t{movie2}\t{adjusted_nonrefkmer_inconsistency:0.5f}\t{inconsistent}"
-            )
+def _dataset_split(ix):
+    if ix not in _worker_splits:
+        _worker_splits[ix] = KmerSplit(
+            *(np.load(_split_path(ix, field), mmap_mode="r") for field in KmerSplit._fields)
+        )
+    return _worker_splits[ix]
+
+
+def _pair_inconsistency(ds1ix, ds2ix):
+    return split_inconsistency(_dataset_split(ds1ix), _dataset_split(ds2ix))
+
+
+def pair_inconsistencies(ref_kmers_tsv, dataset_kmers_tsv, threads=1):
+    """Yield the adjusted non-reference kmer inconsistency of each pair of datasets, in order.
+    With threads > 1, datasets are read and pairs compared in a process pool,
+    sharing kmers through memory mapped temporary files.
+    Raise ValueError, before any pair is compared, if the datasets and the reference
+    have kmers of different lengths.
+    """
+    (refkmers, ), ref_k = read_kmers(ref_kmers_tsv, return_solid=False)
+    datasets = list(enumerate(dataset_kmers_tsv))
+    pairs = list(itertools.combinations(range(len(dataset_kmers_tsv)), 2))
+    if threads <= 1:
+        _init_worker(None, refkmers)
+        dataset_ks = list(itertools.starmap(_split_dataset, datasets))
+        check_kmer_lengths(ref_kmers_tsv, ref_k, dataset_kmers_tsv, dataset_ks)
+        yield from itertools.starmap(_pair_inconsistency, pairs)
+        return
+    with tempfile.TemporaryDirectory(prefix="kmer_consistency.") as tmpdir:
+        np.save(os.path.join(tmpdir, "ref.npy"), refkmers)
+        del refkmers
+        with multiprocessing.Pool(threads, initializer=_init_worker, initargs=(tmpdir,)) as pool:
+            dataset_ks = pool.starmap(_split_dataset, datasets, chunksize=1)
+            check_kmer_lengths(ref_kmers_tsv, ref_k, dataset_kmers_tsv, dataset_ks)
+            yield from pool.starmap(_pair_inconsistency, pairs, chunksize=1)
+
+
+def main(args):
+    movies = [
+        (".").join(kmers_tsv.split("/")[-1].split(".")[0:-3]) for kmers_tsv in args.dataset_kmers_tsv
+    ]
+    pairs = itertools.combinations(range(len(movies)), 2)
+    # compare all pairs before writing, so that a kmer length mismatch leaves no partial table
+    inconsistencies = list(pair_inconsistencies(args.ref_kmers_tsv, args.dataset_kmers_tsv, args.threads))
+
+    print("movieA\tmovieB\tadjusted_nonref_inconsistency\tconsistent")
+    for (ds1ix, ds2ix), adjusted_nonrefkmer_inconsistency in zip(pairs, inconsistencies):
+        inconsistent = (
+            "YES" if adjusted_nonrefkmer_inconsistency < THRESHOLD else "NO"
+        )
+
+        print(
+            f"{movies[ds1ix]}\t{movies[ds2ix]}\t{adjusted_nonrefkmer_inconsistency:0.5f}\t{inconsistent}"
+        )
 
 
 if __name__ == "__main__":
     """This is executed when run from the command line"""
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
-        "ref_kmers_tsv", help="Reference genome kmer counts (kmer<TAB>count)"
+        "ref_kmers_tsv",
+        help="Reference genome kmer counts (kmer<TAB>count, or binary from jellyfish_dump_to_kmers.py)",
+    )
+    parser.add_argument(
+        "dataset_kmers_tsv",
+        nargs="+",
+        help="Kmer counts (kmer<TAB>count, or binary from jellyfish_dump_to_kmers.py)",
     )
     parser.add_argument(
-        "dataset_kmers_tsv", nargs="+", help="Kmer counts (kmer<TAB>count)"
+        "--threads",
+        "-t",
+        default=1,
+        type=int,
+        help="Worker processes for reading datasets and comparing pairs of datasets",
     )
     parser.add_argument(
         "--version",
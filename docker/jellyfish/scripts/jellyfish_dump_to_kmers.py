@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Convert kmer counts from `jellyfish dump -c` (kmer<TAB>count lines, optionally gzipped,
+or - for stdin) to a binary kmer counts file of sorted unique 2-bit packed kmers and
+their counts, which check_kmer_consistency.py.py reads without parsing.  Counts of
+repeated kmers are summed.  Name outputs <movie>.<kmer set>.kmers.bin for
+check_kmer_consistency.py.py to report the movie name.
+"""
+
+__version__ = "0.1.0"
+
+
+import argparse
+import contextlib
+import sys
+
+import numpy as np
+
+from kmers import collapse_kmer_counts, line_blocks, open_decompressed, parse_kmer_counts, write_kmer_counts
+
+
+def read_dump(f):
+    """Read all kmers and counts of a dump from a binary file.  Return (packed kmers, counts, k),
+    k 0 if the dump is empty.
+    """
+    kmers = [np.zeros(0, dtype=np.uint64)]
+    counts = [np.zeros(0, dtype=np.int64)]
+    k = None
+    for block in line_blocks(f):
+        block_kmers, block_counts, k = parse_kmer_counts(block, k)
+        kmers.append(block_kmers)
+        counts.append(block_counts)
+    return np.concatenate(kmers), np.concatenate(counts), k or 0
+
+
+def main(args):
+    with contextlib.ExitStack() as stack:
+        if args.dump == "-":
+            f = sys.stdin.buffer
+        else:
+            f = stack.enter_context(open_decompressed(args.dump))
+        kmers, counts, k = read_dump(f)
+    kmers, counts = collapse_kmer_counts(kmers, counts)
+    write_kmer_counts(args.output, kmers, counts, k)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("dump", help="jellyfish dump in tabular format, or - for stdin", type=str)
+    parser.add_argument("output", help="Binary kmer counts", type=str)
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version=__version__),
+    )
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,283 @@
+"""
+K-mers packed 2 bits per base into unsigned 64-bit integers (A=0, C=1, G=2, T=3), first base
+in the most significant bits, so that numeric order is lexicographic order.
+"""
+
+__version__ = "0.4.2"
+
+
+import contextlib
+import gzip
+import os
+import shutil
+import signal
+import stat
+import struct
+import subprocess
+import tempfile
+
+import numpy as np
+
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+MAX_K = 32  # bases that fit in 64 bits
+MAX_COUNT_DIGITS = 18  # digits of counts that fit in int64
+
+BLOCK_SIZE = 1 << 20  # bytes of kmer counts to parse at a time, small enough to stay in cache
+
+BASE_CODES = str.maketrans("ACGT", "0123")
+
+# 2-bit code of each ASCII byte, 4 if it is not a base
+BASE_LOOKUP = np.full(256, 4, dtype=np.uint8)
+BASE_LOOKUP[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Binary kmer counts: a header of magic, format version, k and number of kmers, padded to
+# 32 bytes, then the sorted unique packed kmers as little-endian uint64 and their counts as
+# little-endian uint32, saturated at the uint32 max
+KMER_COUNTS_MAGIC = b"KMERCNTS"
+KMER_COUNTS_VERSION = 1
+KMER_COUNTS_HEADER = struct.Struct("<8sIIQ8x")
+KMER_DTYPE = np.dtype("<u8")
+COUNT_DTYPE = np.dtype("<u4")
+NEWLINE, TAB, SPACE, ZERO, NINE = b"\n\t 09"
+
+
+def encode_kmer(kmer):
+    """Return the 2-bit packed integer of a k-mer of at most MAX_K A, C, G or T bases."""
+    if not 0 < len(kmer) <= MAX_K or kmer.strip("ACGT"):
+        raise ValueError(f"Cannot pack k-mer {kmer!r} into 64 bits")
+    return int(kmer.translate(BASE_CODES), 4)
+
+
+def decode_kmer(code, k):
+    """Return the k-mer of length k packed in code."""
+    return "".join("ACGT"[(int(code) >> (2 * (k - 1 - i))) & 3] for i in range(k))
+
+
+def encode_kmers(data, starts, k):
+    """Return the 2-bit packed integers of the k-mers of k ASCII bases at offsets starts of a uint8 array."""
+    if not 0 < k <= MAX_K:
+        raise ValueError(f"Cannot pack {k}-mers into 64 bits")
+    packed = np.zeros(len(starts), dtype=np.uint64)
+    offsets = np.array(starts, dtype=np.intp)
+    bases = np.empty(len(starts), dtype=np.uint8)
+    invalid = np.zeros(len(starts), dtype=np.uint8)
+    for _ in range(k):
+        np.take(data, offsets, out=bases)
+        codes = np.take(BASE_LOOKUP, bases)
+        invalid |= codes
+        packed <<= np.uint64(2)
+        packed |= codes
+        offsets += 1
+    # any code of 4 is not a base
+    if np.any(invalid & 4):
+        raise ValueError("Cannot pack k-mers with bases other than A, C, G and T")
+    return packed
+
+
+def sorted_unique(kmers):
+    """Return the unique packed k-mers of an array, sorted."""
+    kmers = np.sort(kmers)
+    if len(kmers) == 0:
+        return kmers
+    return kmers[np.concatenate(([True], kmers[1:] != kmers[:-1]))]
+
+
+def parse_counts(data, starts, ends):
+    """Return the non-negative decimal integers in the ASCII bytes [starts, ends) of a uint8 array."""
+    widths = ends - starts
+    if len(widths) and (widths.min() < 1 or widths.max() > MAX_COUNT_DIGITS):
+        raise ValueError(f"Expected counts of 1 to {MAX_COUNT_DIGITS} digits")
+    counts = np.zeros(len(starts), dtype=np.int64)
+    for i in range(widths.max() if len(widths) else 0):
+        has_digit = widths > i
+        digits = data[np.where(has_digit, starts + i, 0)]
+        if np.any(has_digit & ((digits < ZERO) | (digits > NINE))):
+            raise ValueError("Expected decimal counts")
+        counts = np.where(has_digit, counts * 10 + (digits.astype(np.int64) - ZERO), counts)
+    return counts
+
+
+def kmer_lines(block, k=None):
+    """Find whole lines of kmer<TAB>count, all k-mers of length k (by default, that of the
+    first k-mer).  Return (uint8 array of the block, line starts, line ends, k).
+    """
+    data = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(data == NEWLINE)
+    if len(ends) == 0:
+        return data, ends, ends, k
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    if k is None:
+        k = len(bytes(block[: ends[0]]).split()[0])
+    # k bases, a separator and at least one digit; packed kmers of different lengths can collide
+    if np.any(ends - starts < k + 2):
+        raise ValueError(f"Expected lines of {k}-mer<TAB>count")
+    separators = data[starts + k]
+    if np.any((separators != TAB) & (separators != SPACE)):
+        raise ValueError(f"Expected lines of {k}-mer<TAB>count")
+    return data, starts, ends, k
+
+
+def parse_kmer_counts(block, k=None):
+    """Parse whole lines of kmer<TAB>count, all k-mers of length k (by default, that of
+    the first k-mer).  Return (packed k-mers, counts, k).
+    """
+    data, starts, ends, k = kmer_lines(block, k)
+    if len(ends) == 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64), k
+    return encode_kmers(data, starts, k), parse_counts(data, starts + k + 1, ends), k
+
+
+def line_blocks(f, block_size=BLOCK_SIZE):
+    """Yield blocks of whole lines of about block_size bytes from a binary file."""
+    partial_line = b""
+    for block in iter(lambda: f.read(block_size), b""):
+        block = partial_line + block
+        end = block.rfind(b"\n") + 1
+        yield block[:end]
+        partial_line = block[end:]
+    if partial_line:
+        yield partial_line + b"\n"
+
+
+def iter_kmer_counts(f, block_size=BLOCK_SIZE):
+    """Yield (packed k-mers, counts, k) for blocks of lines of kmer<TAB>count read from a binary file.
+    k is the length of the first k-mer, and a block with k-mers of another length raises ValueError.
+    """
+    k = None
+    for block in line_blocks(f, block_size):
+        kmers, counts, k = parse_kmer_counts(block, k)
+        yield kmers, counts, k
+
+
+def gzip_readers():
+    """Return the available gzip readers, fastest first."""
+    readers = ["gzip"]
+    if shutil.which("pigz"):
+        readers.insert(0, "pigz")
+    if igzip_threaded is not None:
+        readers.insert(0, "isal")
+    return readers
+
+
+@contextlib.contextmanager
+def open_decompressed(path, reader=None):
+    """Open a file for reading bytes, decompressing it if it is gzipped with reader:
+    "isal" (python-isal) or "pigz", which decompress in another thread, or "gzip".
+    By default, the first of gzip_readers().  Pipes are always read with gzip.
+    """
+    with open(path, "rb") as f:
+        with decompressed(f, reader) as d:
+            yield d
+
+
+@contextlib.contextmanager
+def decompressed(f, reader=None):
+    """Yield a binary file of the bytes of a buffered binary file f, opened at its start and named by
+    its path, decompressed with reader as in open_decompressed if they are gzipped.  Only a regular
+    file is reopened, by isal or pigz; otherwise f is read with gzip.
+    """
+    # peek rather than read, so that pipes can be read from the start
+    if f.peek(len(GZIP_MAGIC))[: len(GZIP_MAGIC)] != GZIP_MAGIC:
+        yield f
+        return
+    path = f.name
+    if reader is None:
+        reader = gzip_readers()[0]
+    if not isinstance(path, str) or not os.path.isfile(path):
+        reader = "gzip"
+    if reader == "isal":
+        with igzip_threaded.open(path, "rb", threads=1) as gz:
+            yield gz
+    elif reader == "pigz":
+        pigz = subprocess.Popen(["pigz", "-dc", path], stdout=subprocess.PIPE)
+        try:
+            yield pigz.stdout
+        except BaseException:
+            pigz.kill()
+            raise
+        finally:
+            pigz.stdout.close()
+            returncode = pigz.wait()
+        # pigz is killed by SIGPIPE if the file is closed before it is read to the end
+        if returncode not in (0, -signal.SIGPIPE):
+            raise OSError(f"pigz failed to decompress {path}")
+    elif reader == "gzip":
+        with gzip.open(f, "rb") as gz:
+            yield gz
+    else:
+        raise ValueError(f"Unknown gzip reader {reader!r}")
+
+
+def is_kmer_counts_file(f):
+    """Return whether a path, or a buffered binary file at its start, is a binary kmer counts file.
+    A file is peeked, not read, so that a pipe can still be read from the start.
+    """
+    if not hasattr(f, "peek"):
+        with open(f, "rb") as f:
+            return is_kmer_counts_file(f)
+    return f.peek(len(KMER_COUNTS_MAGIC))[: len(KMER_COUNTS_MAGIC)] == KMER_COUNTS_MAGIC
+
+
+def collapse_kmer_counts(kmers, counts):
+    """Return the sorted unique kmers and the sum of the counts of each, saturated at the uint32 max."""
+    order = np.argsort(kmers, kind="stable")
+    kmers = kmers[order]
+    if len(kmers) == 0:
+        return kmers, np.zeros(0, dtype=COUNT_DTYPE)
+    starts = np.flatnonzero(np.concatenate(([True], kmers[1:] != kmers[:-1])))
+    counts = np.add.reduceat(np.asarray(counts, dtype=np.uint64)[order], starts)
+    return kmers[starts], np.minimum(counts, np.iinfo(COUNT_DTYPE).max).astype(COUNT_DTYPE)
+
+
+def write_kmer_counts(path, kmers, counts, k):
+    """Write sorted unique kmers and their counts as a binary kmer counts file, atomically."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".kmers.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(KMER_COUNTS_HEADER.pack(KMER_COUNTS_MAGIC, KMER_COUNTS_VERSION, k, len(kmers)))
+            f.write(np.ascontiguousarray(kmers, dtype=KMER_DTYPE).tobytes())
+            f.write(np.ascontiguousarray(counts, dtype=COUNT_DTYPE).tobytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_kmer_counts(f):
+    """Read a binary kmer counts file from a path or a binary file at its start, memory mapping it if
+    it is a regular file.  Return (packed kmers, counts, k).
+    """
+    if not hasattr(f, "read"):
+        with open(f, "rb") as f:
+            return read_kmer_counts(f)
+    path = f.name
+    header = f.read(KMER_COUNTS_HEADER.size)
+    if len(header) < KMER_COUNTS_HEADER.size:
+        raise ValueError(f"{path}: not a kmer counts file")
+    magic, version, k, n = KMER_COUNTS_HEADER.unpack(header)
+    if magic != KMER_COUNTS_MAGIC:
+        raise ValueError(f"{path}: not a kmer counts file")
+    if version != KMER_COUNTS_VERSION:
+        raise ValueError(f"{path}: kmer counts format version {version}, expected {KMER_COUNTS_VERSION}")
+    size = KMER_COUNTS_HEADER.size + n * (KMER_DTYPE.itemsize + COUNT_DTYPE.itemsize)
+    if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+        # a pipe cannot be memory mapped or reopened, so read it to the end
+        data = f.read()
+        if KMER_COUNTS_HEADER.size + len(data) != size:
+            raise ValueError(f"{path}: expected {size} bytes for {n} kmers")
+        kmers = np.frombuffer(data, dtype=KMER_DTYPE, count=n)
+        counts = np.frombuffer(data, dtype=COUNT_DTYPE, count=n, offset=kmers.nbytes)
+        return kmers, counts, k
+    if os.fstat(f.fileno()).st_size != size:
+        raise ValueError(f"{path}: expected {size} bytes for {n} kmers")
+    if n == 0:
+        return np.zeros(0, dtype=KMER_DTYPE), np.zeros(0, dtype=COUNT_DTYPE), k
+    kmers = np.memmap(f, dtype=KMER_DTYPE, mode="r", offset=KMER_COUNTS_HEADER.size, shape=(n,))
+    counts = np.memmap(f, dtype=COUNT_DTYPE, mode="r", offset=KMER_COUNTS_HEADER.size + kmers.nbytes, shape=(n,))
+    return kmers, counts, k
@@ -1,22 +1,131 @@
 #!/usr/bin/env python3
 """
-Print modimer counts.
-For consistency, always prepend with PYTHONHASHSEED=0.
+Print modimer counts: the kmers of a jellyfish dump whose hash is divisible by modN.
+
+Kmers are hashed with one of:
+  siphash24   hash(kmer.encode("utf-8")) with PYTHONHASHSEED=0 in Python 3.10 and earlier, which
+              earlier versions used in this image's Python 3.8, so that existing modimer sets stay
+              valid.  This is SipHash-2-4 with a zero key over the kmer's ASCII bytes, computed here
+              so that the selection depends on neither PYTHONHASHSEED nor the running Python.
+  siphash13   the same for Python 3.11 and later, which use SipHash-1-3.
+  splitmix64  the splitmix64 finalizer of the kmer packed 2 bits per base (A=0, C=1, G=2,
+              T=3, first base most significant).
 """
 
 __author__ = "William Rowell"
-__version__ = "0.1.0"
+__version__ = "0.2.1"
 
 
 import argparse
+import sys
+
+import numpy as np
+
+from kmers import encode_kmers, kmer_lines, line_blocks, open_decompressed
+
+# (compression, finalization) rounds of the SipHash variants used by Python's bytes hash
+SIPHASH_ROUNDS = {"siphash24": (2, 4), "siphash13": (1, 3)}
+
+HASHES = (*SIPHASH_ROUNDS, "splitmix64")
+
+SIPHASH_V0, SIPHASH_V1, SIPHASH_V2, SIPHASH_V3 = (
+    np.uint64(0x736F6D6570736575),
+    np.uint64(0x646F72616E646F6D),
+    np.uint64(0x6C7967656E657261),
+    np.uint64(0x7465646279746573),
+)
+
+
+def rotl(x, bits):
+    return (x << np.uint64(bits)) | (x >> np.uint64(64 - bits))
+
+
+def sip_rounds(v0, v1, v2, v3, rounds):
+    for _ in range(rounds):
+        v0 += v1
+        v2 += v3
+        v1 = rotl(v1, 13) ^ v0
+        v3 = rotl(v3, 16) ^ v2
+        v0 = rotl(v0, 32)
+        v2 += v1
+        v0 += v3
+        v1 = rotl(v1, 17) ^ v2
+        v3 = rotl(v3, 21) ^ v0
+        v2 = rotl(v2, 32)
+    return v0, v1, v2, v3
+
+
+def little_endian_words(data, starts, length):
+    """Return the little-endian uint64 of length <= 8 bytes at offsets starts of a uint8 array
+    with at least 8 bytes after each start.
+    """
+    # the unaligned uint64 starting at every byte
+    words_at = np.ndarray(shape=(len(data) - 7,), dtype="<u8", buffer=data, strides=(1,))
+    words = words_at[starts].astype(np.uint64, copy=False)
+    if length < 8:
+        words &= np.uint64((1 << (8 * length)) - 1)
+    return words
+
+
+def siphash(data, starts, length, c_rounds, d_rounds):
+    """Return SipHash-c-d with a zero key of the length bytes at offsets starts of a uint8 array."""
+    n = len(starts)
+    v0, v1, v2, v3 = (np.full(n, v, dtype=np.uint64) for v in (SIPHASH_V0, SIPHASH_V1, SIPHASH_V2, SIPHASH_V3))
+    for offset in range(0, length - length % 8, 8):
+        m = little_endian_words(data, starts + offset, 8)
+        v3 ^= m
+        v0, v1, v2, v3 = sip_rounds(v0, v1, v2, v3, c_rounds)
+        v0 ^= m
+    b = little_endian_words(data, starts + (length - length % 8), length % 8) | np.uint64((length & 0xFF) << 56)
+    v3 ^= b
+    v0, v1, v2, v3 = sip_rounds(v0, v1, v2, v3, c_rounds)
+    v0 ^= b
+    v2 ^= np.uint64(0xFF)
+    v0, v1, v2, v3 = sip_rounds(v0, v1, v2, v3, d_rounds)
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+def python_hash_selected(data, starts, k, modN, algorithm="siphash24"):
+    """Return a mask of the kmers at offsets starts whose Python bytes hash, with
+    PYTHONHASHSEED=0 and the given SipHash algorithm, is divisible by modN.
+    """
+    c_rounds, d_rounds = SIPHASH_ROUNDS[algorithm]
+    hashes = siphash(data, starts, k, c_rounds, d_rounds).view(np.int64)
+    # Python never returns a hash of -1
+    hashes[hashes == -1] = -2
+    return hashes % modN == 0
+
+
+def splitmix64(x):
+    """Return the splitmix64 finalizer of uint64 values."""
+    z = x + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def select_modimers(f, fout, modN, hash_name="siphash24"):
+    """Write the kmer<TAB>count lines of modimers in the dump read from binary file f to binary file fout."""
+    k = None
+    for block in line_blocks(f):
+        data, starts, ends, k = kmer_lines(block, k)
+        if len(ends) == 0:
+            continue
+        if hash_name in SIPHASH_ROUNDS:
+            # pad so that every kmer has 8 bytes to read after each of its offsets
+            padded = np.concatenate((data, np.zeros(8, dtype=np.uint8)))
+            selected = python_hash_selected(padded, starts, k, modN, hash_name)
+        else:
+            selected = splitmix64(encode_kmers(data, starts, k)) % np.uint64(modN) == 0
+        fout.writelines(
+            block[start : start + k] + b"\t" + block[start + k + 1 : end] + b"\n"
+            for start, end in zip(starts[selected].tolist(), ends[selected].tolist())
+        )
 
 
 def main(args):
-    with open(args.counts, "r") as dumpfile:
-        for row in dumpfile:
-            kmer, count = row.rstrip("\n").split()
-            if not hash(kmer.encode("utf-8")) % args.modN:
-                print(f"{kmer}\t{count}")
+    with open_decompressed(args.counts) as f:
+        select_modimers(f, sys.stdout.buffer, args.modN, args.hash)
 
 
 if __name__ == "__main__":
@@ -29,6 +138,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "-N", "--modN", help="dividend for modular division", type=int, default=5003
     )
+    parser.add_argument(
+        "--hash",
+        choices=HASHES,
+        default="siphash24",
+        help="kmer hash; siphash24 matches modimer sets from earlier versions (default: %(default)s)",
+    )
 
     # Specify output of "--version"
     parser.add_argument(
@@ -38,4 +153,4 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import importlib.util
+import io
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+import jellyfish_dump_to_kmers
+from kmers import encode_kmer, read_kmer_counts
+from test_kmers import pipe_path
+
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the script's file name is not importable as a module name
+spec = importlib.util.spec_from_file_location(
+  'check_kmer_consistency', os.path.join(SCRIPTS_DIR, 'check_kmer_consistency.py.py')
+)
+check_kmer_consistency = importlib.util.module_from_spec(spec)
+# worker functions are pickled by module name
+sys.modules['check_kmer_consistency'] = check_kmer_consistency
+spec.loader.exec_module(check_kmer_consistency)
+
+K = 21
+
+
+def random_kmer(rng, k=K):
+  return ''.join(rng.choice('ACGT') for _ in range(k))
+
+
+def write_dump(path, counts):
+  """Write a gzipped jellyfish dump of kmer counts."""
+  with gzip.open(path, 'wt') as f:
+    f.writelines(f'{kmer}\t{count}\n' for kmer, count in counts.items())
+
+
+def read_dump(path):
+  with gzip.open(path, 'rt') as f:
+    return {kmer: int(count) for kmer, count in (line.split() for line in f)}
+
+
+def simulate_datasets(tmp_path, n_datasets=4, n_kmers=4000, seed=1):
+  """Write reference kmers and datasets that share most of the sample's kmers, one of them a different sample."""
+  rng = random.Random(seed)
+  reference = {random_kmer(rng) for _ in range(n_kmers)}
+  sample = set(rng.sample(sorted(reference), n_kmers * 9 // 10)) | {random_kmer(rng) for _ in range(n_kmers // 5)}
+  other = set(rng.sample(sorted(reference), n_kmers * 9 // 10)) | {random_kmer(rng) for _ in range(n_kmers // 5)}
+  ref_path = str(tmp_path / 'ref.kmers.tsv.gz')
+  write_dump(ref_path, {kmer: 1 for kmer in reference})
+  paths = list()
+  for ds in range(n_datasets):
+    kmers = other if ds == n_datasets - 1 else sample
+    counts = {kmer: rng.randint(1, 12) for kmer in kmers if rng.random() < 0.9}
+    counts.update({random_kmer(rng): rng.randint(1, 3) for _ in range(n_kmers // 20)})
+    paths.append(str(tmp_path / f'm{ds}.modimers.tsv.gz'))
+    write_dump(paths[-1], counts)
+  return ref_path, paths
+
+
+def legacy_read_kmers(path, solid_count=5):
+  counts = read_dump(path)
+  return set(counts), {kmer for kmer, count in counts.items() if count >= solid_count}
+
+
+def legacy_kmer_inconsistency(ds1_kmers, ds2_kmers, refkmers):
+  ds1_allkmers, ds1_solidkmers = ds1_kmers
+  ds2_allkmers, ds2_solidkmers = ds2_kmers
+  solidkmers = ds1_solidkmers | ds2_solidkmers
+  sharedsolidkmers = solidkmers & ds1_allkmers & ds2_allkmers
+  uniquekmers = solidkmers - sharedsolidkmers
+  sharedkmers = ds1_allkmers & ds2_allkmers
+  ref_shared = len(sharedkmers & refkmers)
+  ref_unique = len(uniquekmers & refkmers)
+  refkmer_inconsistency = 0 if ref_unique == 0 else ref_unique / (ref_shared + ref_unique)
+  nonref_shared = len(sharedkmers - refkmers)
+  nonref_unique = len(uniquekmers - refkmers)
+  nonrefkmer_inconsistency = 0 if nonref_unique == 0 else nonref_unique / (nonref_shared + nonref_unique)
+  return max(0, nonrefkmer_inconsistency - refkmer_inconsistency)
+
+
+@pytest.fixture(scope='module')
+def datasets(tmp_path_factory):
+  return simulate_datasets(tmp_path_factory.mktemp('kmers'))
+
+
+def test_read_kmers(datasets):
+  ref_path, paths = datasets
+  (kmers, solid), k = check_kmer_consistency.read_kmers(paths[0], return_solid=True)
+  legacy_kmers, legacy_solid = legacy_read_kmers(paths[0])
+  assert kmers.dtype == np.uint64
+  assert kmers.tolist() == sorted(encode_kmer(kmer) for kmer in legacy_kmers)
+  assert solid.tolist() == sorted(encode_kmer(kmer) for kmer in legacy_solid)
+  assert k == K
+  ref_kmers, ref_k = check_kmer_consistency.read_kmers(ref_path)
+  assert len(ref_kmers) == 1 and ref_k == k
+
+
+def test_read_kmers_unterminated(tmp_path):
+  path = str(tmp_path / 'unterminated.tsv.gz')
+  with gzip.open(path, 'wt') as f:
+    f.write('ACGT\t5\nACGA\t7\nTTTT\t1')
+  (kmers, solid), k = check_kmer_consistency.read_kmers(path, return_solid=True)
+  assert k == 4
+  assert kmers.tolist() == sorted(encode_kmer(kmer) for kmer in ('ACGT', 'ACGA', 'TTTT'))
+  assert solid.tolist() == sorted(encode_kmer(kmer) for kmer in ('ACGT', 'ACGA'))
+
+
+def test_read_kmers_lengths(tmp_path):
+  path = str(tmp_path / 'mixed.tsv.gz')
+  write_dump(path, {'ACGT': 5, 'ACG': 5})
+  with pytest.raises(ValueError):
+    check_kmer_consistency.read_kmers(path)
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_main_kmer_lengths(datasets, tmp_path, capsys, threads):
+  ref_path, paths = datasets
+  rng = random.Random(3)
+  shorter = str(tmp_path / 'short.modimers.tsv.gz')
+  write_dump(shorter, {random_kmer(rng, K - 1): 5 for _ in range(100)})
+  with pytest.raises(ValueError, match=f'{K - 1}-mers'):
+    check_kmer_consistency.main(
+      argparse.Namespace(ref_kmers_tsv=ref_path, dataset_kmers_tsv=[paths[0], shorter], threads=threads)
+    )
+  assert capsys.readouterr().out == ''
+  # an empty dataset has no kmer length to disagree with
+  empty = str(tmp_path / 'empty.modimers.tsv.gz')
+  write_dump(empty, {})
+  check_kmer_consistency.main(argparse.Namespace(ref_kmers_tsv=ref_path, dataset_kmers_tsv=[paths[0], empty], threads=threads))
+  assert len(capsys.readouterr().out.splitlines()) == 2
+
+
+def test_kmer_inconsistency_matches_legacy(datasets):
+  ref_path, paths = datasets
+  refkmers = check_kmer_consistency.read_kmers(ref_path)[0][0]
+  legacy_refkmers = set(read_dump(ref_path))
+  for ds1 in range(len(paths)):
+    for ds2 in range(ds1 + 1, len(paths)):
+      inconsistency = check_kmer_consistency.kmer_inconsistency(
+        check_kmer_consistency.read_kmers(paths[ds1], return_solid=True)[0],
+        check_kmer_consistency.read_kmers(paths[ds2], return_solid=True)[0],
+        refkmers,
+      )
+      assert inconsistency == legacy_kmer_inconsistency(
+        legacy_read_kmers(paths[ds1]), legacy_read_kmers(paths[ds2]), legacy_refkmers
+      )
+
+
+def test_split_kmers(datasets):
+  ref_path, paths = datasets
+  refkmers = check_kmer_consistency.read_kmers(ref_path)[0][0]
+  ds_kmers = check_kmer_consistency.read_kmers(paths[0], return_solid=True)[0]
+  split = check_kmer_consistency.split_kmers(ds_kmers, refkmers)
+  for kmers, ref_bitmap, nonref in zip(ds_kmers, split[:2], split[2:]):
+    in_ref = np.isin(kmers, refkmers)
+    assert nonref.tolist() == kmers[~in_ref].tolist()
+    assert refkmers[np.unpackbits(ref_bitmap, count=len(refkmers)).astype(bool)].tolist() == kmers[in_ref].tolist()
+
+
+@pytest.mark.parametrize('threads', [1, 3])
+def test_main(datasets, capsys, threads):
+  ref_path, paths = datasets
+  check_kmer_consistency.main(argparse.Namespace(ref_kmers_tsv=ref_path, dataset_kmers_tsv=paths, threads=threads))
+  lines = capsys.readouterr().out.splitlines()
+  assert lines[0] == 'movieA\tmovieB\tadjusted_nonref_inconsistency\tconsistent'
+  legacy_refkmers = set(read_dump(ref_path))
+  expected = list()
+  for ds1 in range(len(paths)):
+    for ds2 in range(ds1 + 1, len(paths)):
+      inconsistency = legacy_kmer_inconsistency(
+        legacy_read_kmers(paths[ds1]), legacy_read_kmers(paths[ds2]), legacy_refkmers
+      )
+      expected.append(f'm{ds1}\tm{ds2}\t{inconsistency:0.5f}\t{"YES" if inconsistency < 0.03 else "NO"}')
+  assert lines[1:] == expected
+  # the last dataset is from another sample
+  assert [line.endswith('YES') for line in lines[1:]] == [True, True, False, True, False, False]
+
+
+def test_binary_kmer_counts(datasets, tmp_path, capsys):
+  ref_path, paths = datasets
+  binaries = list()
+  for path in [ref_path, *paths]:
+    binaries.append(str(tmp_path / os.path.basename(path).replace('.tsv.gz', '.kmers.bin')))
+    jellyfish_dump_to_kmers.main(argparse.Namespace(dump=path, output=binaries[-1]))
+  for path, binary in zip(paths, binaries[1:]):
+    for text_kmers, binary_kmers in zip(
+      check_kmer_consistency.read_kmers(path, return_solid=True)[0],
+      check_kmer_consistency.read_kmers(binary, return_solid=True)[0],
+    ):
+      assert text_kmers.tolist() == binary_kmers.tolist()
+    assert check_kmer_consistency.read_kmers(binary)[1] == K
+
+  check_kmer_consistency.main(argparse.Namespace(ref_kmers_tsv=ref_path, dataset_kmers_tsv=paths, threads=1))
+  expected = capsys.readouterr().out
+  check_kmer_consistency.main(argparse.Namespace(ref_kmers_tsv=binaries[0], dataset_kmers_tsv=binaries[1:], threads=2))
+  assert capsys.readouterr().out == expected
+
+
+def test_dump_to_kmers_stdin(tmp_path, monkeypatch):
+  dump = b'ACGT\t5\nAAAA\t1\nACGT\t2\n'
+  monkeypatch.setattr(sys, 'stdin', io.TextIOWrapper(io.BytesIO(dump)))
+  output = str(tmp_path / 'stdin.kmers.bin')
+  jellyfish_dump_to_kmers.main(argparse.Namespace(dump='-', output=output))
+  kmers, counts, k = read_kmer_counts(output)
+  assert (kmers.tolist(), counts.tolist(), k) == ([encode_kmer('AAAA'), encode_kmer('ACGT')], [1, 7], 4)
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/fd'), reason='no /dev/fd')
+def test_read_kmers_pipe(datasets, tmp_path):
+  """Text, gzipped and binary kmer counts can be read from a pipe, as with <(cat kmers.tsv.gz)."""
+  _, paths = datasets
+  binary = str(tmp_path / 'm0.modimers.kmers.bin')
+  jellyfish_dump_to_kmers.main(argparse.Namespace(dump=paths[0], output=binary))
+  with gzip.open(paths[0], 'rb') as f:
+    text = f.read()
+  expected = [kmers.tolist() for kmers in check_kmer_consistency.read_kmers(paths[0], return_solid=True)[0]]
+  for data in (text, open(paths[0], 'rb').read(), open(binary, 'rb').read()):
+    with pipe_path(data) as path:
+      assert [kmers.tolist() for kmers in check_kmer_consistency.read_kmers(path, return_solid=True)[0]] == expected
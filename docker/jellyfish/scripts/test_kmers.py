@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import contextlib
+import gzip
+import io
+import os
+import random
+import threading
+
+import numpy as np
+import pytest
+
+import kmers
+from kmers import (
+  collapse_kmer_counts,
+  decode_kmer,
+  encode_kmer,
+  is_kmer_counts_file,
+  iter_kmer_counts,
+  line_blocks,
+  open_decompressed,
+  parse_kmer_counts,
+  read_kmer_counts,
+  write_kmer_counts,
+)
+
+
+def random_kmer(rng, k):
+  return ''.join(rng.choice('ACGT') for _ in range(k))
+
+
+@contextlib.contextmanager
+def pipe_path(data):
+  """Yield a /dev/fd path to a pipe that a thread writes data to, as for a shell <(...)."""
+  read_fd, write_fd = os.pipe()
+
+  def write():
+    with open(write_fd, 'wb') as f:
+      f.write(data)
+
+  writer = threading.Thread(target=write, daemon=True)
+  writer.start()
+  try:
+    yield f'/dev/fd/{read_fd}'
+  finally:
+    os.close(read_fd)
+    writer.join()
+
+
+def test_encode_kmer():
+  rng = random.Random(2)
+  kmer_list = sorted(random_kmer(rng, 32) for _ in range(100))
+  codes = [encode_kmer(kmer) for kmer in kmer_list]
+  assert codes == sorted(codes)
+  assert [decode_kmer(code, 32) for code in codes] == kmer_list
+  assert encode_kmer('T' * 32) == 2**64 - 1
+  for kmer in ('', 'A' * 33, 'ACGN', 'acgt', '0123'):
+    with pytest.raises(ValueError):
+      encode_kmer(kmer)
+
+
+@pytest.mark.parametrize('k', [1, 21, 31, 32])
+def test_parse_kmer_counts(k):
+  rng = random.Random(k)
+  rows = [(random_kmer(rng, k), rng.choice([0, 1, 9, 10, 12345, 10**17])) for _ in range(1000)]
+  separators = [rng.choice('\t ') for _ in rows]
+  block = ''.join(f'{kmer}{sep}{count}\n' for (kmer, count), sep in zip(rows, separators)).encode()
+  packed, counts, parsed_k = parse_kmer_counts(block)
+  assert parsed_k == k
+  assert packed.tolist() == [encode_kmer(kmer) for kmer, _ in rows]
+  assert counts.tolist() == [count for _, count in rows]
+
+
+@pytest.mark.parametrize(
+  'block',
+  [b'ACGT\t5\nACG\t5\n', b'ACGT\t5\nACGTA\t5\n', b'ACGT\t5\nACGT\t\n', b'ACGT\t5\n\n', b'ACNT\t5\n', b'ACGT\t5x\n', b'ACGT 1e3\n'],
+)
+def test_parse_kmer_counts_errors(block):
+  with pytest.raises(ValueError):
+    parse_kmer_counts(block)
+
+
+def test_line_blocks():
+  f = io.BytesIO(b'ACGT\t5\nACGA\t7\nTTTT\t1')
+  assert list(line_blocks(f, 9)) == [b'ACGT\t5\n', b'ACGA\t7\n', b'', b'TTTT\t1\n']
+
+
+def test_iter_kmer_counts():
+  rng = random.Random(1)
+  rows = [(random_kmer(rng, 21), rng.randint(1, 1000)) for _ in range(1000)]
+  f = io.BytesIO(''.join(f'{kmer}\t{count}\n' for kmer, count in rows).encode())
+  blocks = list(iter_kmer_counts(f, 1000))
+  assert len(blocks) > 1
+  assert np.concatenate([packed for packed, _, _ in blocks]).tolist() == [encode_kmer(kmer) for kmer, _ in rows]
+  assert np.concatenate([counts for _, counts, _ in blocks]).tolist() == [count for _, count in rows]
+  assert {k for _, _, k in blocks} == {21}
+  # the length of the first kmer applies to all blocks
+  for line in (b'ACG\t5\n', b'ACGTA\t5\n'):
+    with pytest.raises(ValueError):
+      list(iter_kmer_counts(io.BytesIO(b'ACGT\t5\n' * 100 + line), 100))
+
+
+@pytest.mark.parametrize('reader', ['gzip', 'isal', 'pigz'])
+def test_open_decompressed(tmp_path, reader):
+  if reader not in kmers.gzip_readers():
+    pytest.skip(f'{reader} is not installed')
+  data = b''.join(b'ACGT\t%d\n' % i for i in range(100000))
+  path = tmp_path / 'kmers.tsv.gz'
+  path.write_bytes(gzip.compress(data))
+  with open_decompressed(str(path), reader) as f:
+    assert f.read() == data
+  plain = tmp_path / 'kmers.tsv'
+  plain.write_bytes(data)
+  with open_decompressed(str(plain), reader) as f:
+    assert f.read() == data
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/fd'), reason='no /dev/fd')
+@pytest.mark.parametrize('reader', ['gzip', 'isal', 'pigz'])
+@pytest.mark.parametrize('compress', [True, False])
+def test_open_decompressed_pipe(reader, compress):
+  data = b''.join(b'ACGT\t%d\n' % i for i in range(100000))
+  # pipes cannot be reopened, so any reader falls back to gzip on the same handle
+  with pipe_path(gzip.compress(data) if compress else data) as path:
+    with open_decompressed(path, reader) as f:
+      assert f.read() == data
+
+
+def test_kmer_counts_file(tmp_path):
+  kmer_list, counts = collapse_kmer_counts(
+    np.array([7, 3, 7, 2**64 - 1, 0], dtype=np.uint64), np.array([1, 2, 3, 2**32, 5], dtype=np.int64)
+  )
+  assert kmer_list.tolist() == [0, 3, 7, 2**64 - 1]
+  assert counts.tolist() == [5, 2, 4, 2**32 - 1]
+  path = str(tmp_path / 'm0.modimers.kmers.bin')
+  write_kmer_counts(path, kmer_list, counts, 32)
+  assert is_kmer_counts_file(path)
+  read_kmers, read_counts, k = read_kmer_counts(path)
+  assert (read_kmers.tolist(), read_counts.tolist(), k) == (kmer_list.tolist(), counts.tolist(), 32)
+  assert read_kmers.dtype == np.uint64 and read_counts.dtype == np.uint32
+
+  empty = str(tmp_path / 'empty.kmers.bin')
+  write_kmer_counts(empty, np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint32), 0)
+  assert [len(a) for a in read_kmer_counts(empty)[:2]] == [0, 0]
+
+  truncated = tmp_path / 'truncated.kmers.bin'
+  truncated.write_bytes(open(path, 'rb').read()[:-1])
+  text = tmp_path / 'kmers.tsv'
+  text.write_text('ACGT\t5\n')
+  assert not is_kmer_counts_file(str(text))
+  for bad in (truncated, text):
+    with pytest.raises(ValueError):
+      read_kmer_counts(str(bad))
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/fd'), reason='no /dev/fd')
+def test_kmer_counts_pipe(tmp_path):
+  path = str(tmp_path / 'm0.modimers.kmers.bin')
+  write_kmer_counts(path, np.array([1, 5, 9], dtype=np.uint64), np.array([3, 2, 1], dtype=np.uint32), 4)
+  data = open(path, 'rb').read()
+  with pipe_path(data) as pipe, open(pipe, 'rb') as f:
+    # the magic is peeked, so the file is read from the start
+    assert is_kmer_counts_file(f)
+    read_kmers, read_counts, k = read_kmer_counts(f)
+  assert (read_kmers.tolist(), read_counts.tolist(), k) == ([1, 5, 9], [3, 2, 1], 4)
+  with pipe_path(data[:-1]) as pipe, pytest.raises(ValueError):
+    read_kmer_counts(pipe)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import os
+import random
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import modimer
+from kmers import encode_kmer
+
+
+LEGACY_MODIMERS = '''
+import sys
+with open(sys.argv[1], 'r') as dumpfile:
+  for row in dumpfile:
+    kmer, count = row.rstrip('\\n').split()
+    if not hash(kmer.encode('utf-8')) % int(sys.argv[2]):
+      print(f'{kmer}\\t{count}')
+'''
+
+
+# hash(kmer.encode()) with PYTHONHASHSEED=0 in Python 3.8 (siphash24) and 3.11 (siphash13)
+KNOWN_HASHES = {
+  'siphash24': {
+    'A': 2507792285634992701,
+    'ACGTACG': 2531177191503153982,
+    'ACGTACGT': 1125383828477642763,
+    'ACGTACGTACGTACGTACGTACGTACGTACG': 6624303112931152854,
+    'TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT': 5380774261799039513,
+  },
+  'siphash13': {
+    'A': -1454356908258778490,
+    'ACGTACG': -8956236493138226577,
+    'ACGTACGT': 1484641052778746264,
+    'ACGTACGTACGTACGTACGTACGTACGTACG': 3329000987456813703,
+    'TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT': -7719989083970605815,
+  },
+}
+
+# hash() of this Python reproduced by python_hash_selected, if any
+BUILTIN_HASH = sys.hash_info.algorithm if sys.hash_info.cutoff == 0 else None
+builtin_siphash = pytest.mark.skipif(BUILTIN_HASH not in modimer.SIPHASH_ROUNDS, reason='hash() is not SipHash')
+
+
+def random_kmer(rng, k):
+  return ''.join(rng.choice('ACGT') for _ in range(k))
+
+
+def builtin_hashes(kmers):
+  """Return hash(kmer.encode()) of each kmer in a Python with PYTHONHASHSEED=0."""
+  script = 'import sys\nfor line in sys.stdin: print(hash(line.rstrip().encode()))'
+  out = subprocess.run(
+    [sys.executable, '-c', script], input='\n'.join(kmers), capture_output=True, text=True, check=True,
+    env={**os.environ, 'PYTHONHASHSEED': '0'},
+  ).stdout
+  return [int(h) for h in out.split()]
+
+
+@pytest.fixture(scope='module')
+def dump(tmp_path_factory):
+  rng = random.Random(1)
+  path = tmp_path_factory.mktemp('modimer') / 'kmers.tsv'
+  path.write_text(''.join(f'{random_kmer(rng, 21)}\t{rng.randint(1, 1000)}\n' for _ in range(5000)))
+  return str(path)
+
+
+@pytest.mark.parametrize('algorithm', modimer.SIPHASH_ROUNDS)
+def test_python_hash_known_answers(algorithm):
+  starts = np.array([0])
+  for kmer, expected in KNOWN_HASHES[algorithm].items():
+    data = np.frombuffer(kmer.encode() + bytes(8), dtype=np.uint8)
+    siphash = modimer.siphash(data, starts, len(kmer), *modimer.SIPHASH_ROUNDS[algorithm])
+    assert int(siphash[0]) == expected % 2**64
+    for modN in (2, 3, 7, abs(expected)):
+      selected = modimer.python_hash_selected(data, starts, len(kmer), modN, algorithm)
+      assert selected.tolist() == [expected % modN == 0]
+
+
+@builtin_siphash
+@pytest.mark.parametrize('k', [1, 7, 8, 15, 21, 31, 32])
+def test_python_hash_matches_builtin(k):
+  rng = random.Random(k)
+  kmers = [random_kmer(rng, k) for _ in range(500)]
+  hashes = builtin_hashes(kmers)
+  block = b''.join(f'{kmer}\t1\n'.encode() for kmer in kmers)
+  data = np.frombuffer(block + bytes(8), dtype=np.uint8)
+  starts = np.arange(len(kmers)) * (k + 3)
+  for modN in (2, 3, 7):
+    selected = modimer.python_hash_selected(data, starts, k, modN, BUILTIN_HASH)
+    assert selected.tolist() == [h % modN == 0 for h in hashes]
+
+
+def test_splitmix64():
+  assert int(modimer.splitmix64(np.zeros(1, dtype=np.uint64))[0]) == 0xE220A8397B1DCDAF
+
+
+@builtin_siphash
+def test_main_matches_legacy(dump, tmp_path, capsysbinary):
+  expected = subprocess.run(
+    [sys.executable, '-c', LEGACY_MODIMERS, dump, '7'], capture_output=True, check=True,
+    env={**os.environ, 'PYTHONHASHSEED': '0'},
+  ).stdout
+  assert expected
+  modimer.main(argparse.Namespace(counts=dump, modN=7, hash=BUILTIN_HASH))
+  assert capsysbinary.readouterr().out == expected
+
+  gzipped = str(tmp_path / 'kmers.tsv.gz')
+  with open(dump, 'rb') as f, gzip.open(gzipped, 'wb') as gz:
+    gz.write(f.read())
+  modimer.main(argparse.Namespace(counts=gzipped, modN=7, hash=BUILTIN_HASH))
+  assert capsysbinary.readouterr().out == expected
+
+
+def test_default_hash_siphash24(dump, capsysbinary):
+  """Modimer sets do not depend on the Python running the script."""
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modimer.py')
+  out = subprocess.run(
+    [sys.executable, script, '-N', '7', dump], capture_output=True, check=True,
+    env={**os.environ, 'PYTHONHASHSEED': '1'},
+  ).stdout
+  modimer.main(argparse.Namespace(counts=dump, modN=7, hash='siphash24'))
+  assert out and capsysbinary.readouterr().out == out
+
+
+def test_main_splitmix64(dump, capsysbinary):
+  modimer.main(argparse.Namespace(counts=dump, modN=7, hash='splitmix64'))
+  lines = capsysbinary.readouterr().out.decode().splitlines()
+  with open(dump) as f:
+    expected = [
+      line.rstrip('\n') for line in f
+      if int(modimer.splitmix64(np.array([encode_kmer(line.split()[0])], dtype=np.uint64))[0]) % 7 == 0
+    ]
+  assert expected and lines == expected
+
+
+def test_select_modimers_lengths(tmp_path):
+  path = tmp_path / 'mixed.tsv'
+  path.write_bytes(b'ACGT\t5\nACG\t5\n')
+  with open(path, 'rb') as f, open(os.devnull, 'wb') as fout, pytest.raises(ValueError):
+    modimer.select_modimers(f, fout, 7)
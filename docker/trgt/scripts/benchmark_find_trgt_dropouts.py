@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Benchmark find_trgt_dropouts.py on synthetic inputs.
+
+Generates a synthetic catalog with a configurable number of loci spread over the GRCh38 primary
+chromosomes, a PAR/X/Y ploidy BED for a male sample, and spanning BAMs with configurable depth, read
+length, fraction of reads with rq tags and fraction of haplotagged reads.  Reports wall time and peak RSS
+for each stage of find_trgt_dropouts.py: catalog load, ploidy load, BAM walk and output.  Optionally
+also times the ploidy lookup for every locus using both the legacy linear scan and the PloidyIndex.
+"""
+
+__version__ = '0.2.0'
+
+import argparse
+import array
+import contextlib
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pysam
+
+import find_trgt_dropouts as ftd
+
+logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y%m%dT%H:%M:%S%z', level=logging.INFO)
+
+
+# GRCh38 primary chromosome lengths
+CHROM_LENGTHS = {
+  'chr1': 248956422,
+  'chr2': 242193529,
+  'chr3': 198295559,
+  'chr4': 190214555,
+  'chr5': 181538259,
+  'chr6': 170805979,
+  'chr7': 159345973,
+  'chr8': 145138636,
+  'chr9': 138394717,
+  'chr10': 133797422,
+  'chr11': 135086622,
+  'chr12': 133275309,
+  'chr13': 114364328,
+  'chr14': 107043718,
+  'chr15': 101991189,
+  'chr16': 90338345,
+  'chr17': 83257441,
+  'chr18': 80373285,
+  'chr19': 58617616,
+  'chr20': 64444167,
+  'chr21': 46709983,
+  'chr22': 50818468,
+  'chrX': 156040895,
+  'chrY': 57227415,
+}
+
+# GRCh38 PAR/X/Y ploidy regions for a male sample (chrom, start, end, ploidy)
+MALE_PLOIDY_REGIONS = [
+  ('chrX', 10000, 2781479, 2),
+  ('chrX', 2781479, 155701383, 1),
+  ('chrX', 155701383, 156030895, 2),
+  ('chrY', 10000, 2781479, 0),
+  ('chrY', 2781479, 56887902, 1),
+  ('chrY', 56887902, 57217415, 0),
+]
+
+
+def synthetic_loci(n_loci: int, seed: int = 0) -> List[Tuple[str, int, int]]:
+  """Return n_loci (chrom, start, end) tuples spread over the genome proportionally to chromosome length."""
+  rng = random.Random(seed)
+  genome_length = sum(CHROM_LENGTHS.values())
+  loci = []
+  for chrom, length in CHROM_LENGTHS.items():
+    n = round(n_loci * length / genome_length)
+    starts = sorted(rng.randrange(0, length - 1000) for _ in range(n))
+    loci.extend((chrom, start, start + rng.randint(10, 500)) for start in starts)
+  return loci
+
+
+# rq tag values of synthetic reads and their weights; reads below find_trgt_dropouts' default threshold fail
+RQ_VALUES = (0.95, 0.99, 0.995, 0.999)
+RQ_WEIGHTS = (0.05, 0.1, 0.25, 0.6)
+# base quality of synthetic reads, used for rq when the tag is missing
+BASE_QUALITY = 40
+
+
+def write_catalog_bed(path: str, loci: List[Tuple[str, int, int]]) -> None:
+  """Write loci as a TRGT catalog BED with one ID per locus."""
+  with open(path, 'w') as out:
+    for i, (chrom, start, end) in enumerate(loci):
+      out.write(f'{chrom}\t{start}\t{end}\tID={chrom}_{i};MOTIFS=CAG;STRUC=(CAG)n\n')
+
+
+def write_ploidy_bed(path: str) -> None:
+  """Write the male PAR/X/Y ploidy regions as a ploidy BED."""
+  with open(path, 'w') as out:
+    for chrom, start, end, ploidy in MALE_PLOIDY_REGIONS:
+      out.write(f'{chrom}\t{start}\t{end}\tregion\t{ploidy}\n')
+
+
+def write_spanning_bam(
+  path: str,
+  loci: List[Tuple[str, int, int]],
+  sample: str,
+  depth: float = 10,
+  read_length: int = 500,
+  rq_fraction: float = 0.9,
+  hp_fraction: float = 0.9,
+  seed: int = 0,
+) -> int:
+  """
+  Write a sorted, indexed spanning BAM with a Poisson-like number of reads around depth for each locus.
+
+  Reads are centered on their locus and span it; read_length is raised to the locus length plus two bases
+  where needed.  A rq_fraction of reads carry an rq tag and a hp_fraction carry an HP tag of 1 or 2.
+  Returns the number of reads written.
+  """
+  rng = random.Random(seed)
+  header = {
+    'HD': {'VN': '1.6', 'SO': 'coordinate'},
+    'SQ': [{'SN': chrom, 'LN': length} for chrom, length in CHROM_LENGTHS.items()],
+    'RG': [{'ID': f'{sample}_rg', 'SM': sample}],
+  }
+  qualities: Dict[int, array.array] = {}
+  loci_by_chrom: Dict[str, List[Tuple[int, int, int]]] = {}
+  for i, (chrom, start, end) in enumerate(loci):
+    loci_by_chrom.setdefault(chrom, []).append((start, end, i))
+  n_reads = 0
+  with pysam.AlignmentFile(path, 'wb', header=header) as out:
+    for chrom, chrom_loci in loci_by_chrom.items():
+      tid = out.header.get_tid(chrom)
+      reads = []
+      for start, end, i in chrom_loci:
+        length = max(read_length, end - start + 2)
+        read_start = max(0, start - (length - (end - start)) // 2)
+        # binomial over 2 * depth trials gives a mean of depth with some spread
+        n = sum(rng.random() < 0.5 for _ in range(round(2 * depth)))
+        reads.extend((read_start, length, f'{chrom}_{i}', j) for j in range(n))
+      reads.sort()
+      for read_start, length, trid, j in reads:
+        a = pysam.AlignedSegment(out.header)
+        a.query_name = f'{trid}_read{j}'
+        a.reference_id = tid
+        a.reference_start = read_start
+        a.mapping_quality = 60
+        a.query_sequence = 'A' * length
+        a.cigartuples = [(0, length)]
+        if length not in qualities:
+          qualities[length] = array.array('B', [BASE_QUALITY] * length)
+        a.query_qualities = qualities[length]
+        tags = [('TR', trid), ('RG', f'{sample}_rg')]
+        if rng.random() < rq_fraction:
+          tags.append(('rq', rng.choices(RQ_VALUES, RQ_WEIGHTS)[0]))
+        if rng.random() < hp_fraction:
+          tags.append(('HP', rng.choice((1, 2))))
+        a.set_tags(tags)
+        out.write(a)
+      n_reads += len(reads)
+  pysam.index(path)
+  return n_reads
+
+
+def peak_rss_mb() -> Tuple[float, float]:
+  """Return (process, children) peak RSS in MB since the last reset_peak_rss()."""
+  children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+  try:
+    with open('/proc/self/status') as status:
+      for line in status:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) / 1024, children
+  except OSError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, children
+
+
+def reset_peak_rss() -> None:
+  """Reset the process peak RSS where the kernel allows it, so that each stage reports its own peak."""
+  with contextlib.suppress(OSError):
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+      clear_refs.write('5')
+
+
+@contextlib.contextmanager
+def stage(name: str, report: List[Dict]) -> Iterator[None]:
+  """Time a stage and record its wall time and peak RSS in report."""
+  reset_peak_rss()
+  t0 = time.perf_counter()
+  yield
+  wall_time = time.perf_counter() - t0
+  rss, children_rss = peak_rss_mb()
+  report.append({'stage': name, 'wall_time_s': wall_time, 'peak_rss_mb': rss, 'children_peak_rss_mb': children_rss})
+  logging.info(f'{name}: {wall_time:.3f} s, peak RSS {rss:.1f} MB (children {children_rss:.1f} MB)')
+
+
+def benchmark_stages(
+  catalog_bed: str,
+  ploidy_bed: str,
+  spanning_bams: List[str],
+  output: str,
+  threads: int = 1,
+  fetch_mode: str = 'auto',
+  catalog_cache: Optional[str] = None,
+) -> List[Dict]:
+  """Run find_trgt_dropouts.py stage by stage and return wall time and peak RSS of each stage."""
+  report: List[Dict] = []
+  with stage('catalog load', report):
+    tandem_repeats = ftd.load_trgt_catalog(catalog_bed, cache_dir=catalog_cache)
+    if len(spanning_bams) > 1:
+      tandem_repeats.set_samples([ftd.bam_sample_name(spanning_bam) for spanning_bam in spanning_bams])
+  with stage('ploidy load', report):
+    ploidy_index = ftd.load_allosome_ploidy_bed(ploidy_bed)
+  with stage('BAM walk', report):
+    ftd.assign_haplotags(tandem_repeats, spanning_bams, threads=threads, fetch_mode=fetch_mode)
+  with stage('output', report):
+    ftd.write_results(tandem_repeats, ploidy_index, 2, True, output)
+  return report
+
+
+def legacy_get_ploidy_for_region(ploidy_dict: Dict[Tuple[str, int, int], int], chrom: str, start: int, end: int) -> int:
+  """Ploidy lookup as implemented in find_trgt_dropouts.py 0.3.0."""
+  if chrom not in [_[0] for _ in ploidy_dict.keys()]:
+    return 2
+  for (c, s, e), p in ploidy_dict.items():
+    if c == chrom and start >= s and end <= e:
+      return p
+  return 2
+
+
+def benchmark_ploidy_lookup(loci: List[Tuple[str, int, int]]) -> None:
+  """Time legacy and indexed ploidy lookups over all loci and check that they agree."""
+  ploidy_dict = {(chrom, start, end): ploidy for chrom, start, end, ploidy in MALE_PLOIDY_REGIONS}
+  ploidy_index = ftd.PloidyIndex()
+  for chrom, start, end, ploidy in MALE_PLOIDY_REGIONS:
+    ploidy_index.add(chrom, start, end, ploidy)
+
+  t0 = time.perf_counter()
+  legacy = [legacy_get_ploidy_for_region(ploidy_dict, chrom, start, end) for chrom, start, end in loci]
+  legacy_time = time.perf_counter() - t0
+
+  t0 = time.perf_counter()
+  indexed = [ftd.get_ploidy_for_region(ploidy_index, chrom, start, end) for chrom, start, end in loci]
+  indexed_time = time.perf_counter() - t0
+
+  if legacy != indexed:
+    raise RuntimeError('Legacy and indexed ploidy lookups disagree')
+  logging.info(f'ploidy lookup, legacy linear scan: {legacy_time:.3f} s')
+  logging.info(f'ploidy lookup, PloidyIndex: {indexed_time:.3f} s ({legacy_time / indexed_time:.1f}x)')
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--loci', '-n', type=int, default=100_000, help='Number of synthetic catalog loci.')
+  parser.add_argument('--samples', type=int, default=1, help='Number of synthetic spanning BAMs.')
+  parser.add_argument('--depth', type=float, default=10, help='Mean spanning reads per locus.')
+  parser.add_argument('--read-length', type=int, default=500, help='Spanning read length.')
+  parser.add_argument('--rq-fraction', type=float, default=0.9, help='Fraction of reads with an rq tag.')
+  parser.add_argument('--hp-fraction', type=float, default=0.9, help='Fraction of reads with an HP tag.')
+  parser.add_argument('--seed', type=int, default=0, help='Random seed for synthetic inputs.')
+  parser.add_argument('--threads', '-t', type=int, default=1, help='find_trgt_dropouts worker processes.')
+  parser.add_argument(
+    '--fetch', choices=['auto', 'targeted', 'full'], default='auto', help='find_trgt_dropouts fetch mode.'
+  )
+  parser.add_argument('--catalog-cache', default=None, help='find_trgt_dropouts catalog cache directory.')
+  parser.add_argument(
+    '--workdir', default=None, help='Directory for synthetic inputs, kept after the run. (default: temporary)'
+  )
+  parser.add_argument('--report', default=None, help='Write per-stage results as JSON to this file.')
+  parser.add_argument(
+    '--ploidy-lookup', action='store_true', help='Also compare legacy and indexed ploidy lookups for every locus.'
+  )
+  parser.add_argument('--version', '-V', action='version', version=f'%(prog)s (version {__version__})')
+  args = parser.parse_args(argv)
+
+  loci = synthetic_loci(args.loci, args.seed)
+  logging.info(f'Generated {len(loci)} synthetic loci')
+  if args.ploidy_lookup:
+    benchmark_ploidy_lookup(loci)
+
+  workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark_find_trgt_dropouts.')
+  os.makedirs(workdir, exist_ok=True)
+  try:
+    catalog_bed = os.path.join(workdir, 'catalog.bed')
+    ploidy_bed = os.path.join(workdir, 'ploidy.bed')
+    write_catalog_bed(catalog_bed, loci)
+    write_ploidy_bed(ploidy_bed)
+    spanning_bams = []
+    for i in range(args.samples):
+      spanning_bam = os.path.join(workdir, f'sample{i}.spanning.bam')
+      t0 = time.perf_counter()
+      n_reads = write_spanning_bam(
+        spanning_bam,
+        loci,
+        f'sample{i}',
+        args.depth,
+        args.read_length,
+        args.rq_fraction,
+        args.hp_fraction,
+        args.seed + i,
+      )
+      logging.info(f'Wrote {n_reads} reads to {spanning_bam} in {time.perf_counter() - t0:.1f} s')
+      spanning_bams.append(spanning_bam)
+
+    report = benchmark_stages(
+      catalog_bed,
+      ploidy_bed,
+      spanning_bams,
+      os.path.join(workdir, 'dropouts.tsv'),
+      args.threads,
+      args.fetch,
+      args.catalog_cache,
+    )
+  finally:
+    if not args.workdir:
+      shutil.rmtree(workdir)
+  if args.report:
+    with open(args.report, 'w') as out:
+      json.dump({'version': __version__, 'args': vars(args), 'stages': report}, out, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -8,22 +8,65 @@ spanning each TRGT region, and determines whether there are coverage dropouts ba
 thresholds, outputting a tab-delimited summary for tandem repeat regions with detected dropouts.
 """
 
-__version__ = '0.3.0'
+__version__ = '0.4.0'
 
 import argparse
+import array
+import bisect
 import gzip
+import hashlib
+import io
+import itertools
 import logging
-import math
+import multiprocessing
+import os
+import shutil
 import sys
-from typing import Dict, Tuple, Optional
+import tempfile
+from collections import Counter, defaultdict
+from collections.abc import Mapping
+from typing import Container, Dict, Iterable, Iterator, List, Sequence, TextIO, Tuple, Optional
 
+import numpy as np
 import pysam
 
 logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y%m%dT%H:%M:%S%z', level=logging.INFO)
 
+# catalog intervals closer than this are fetched from the BAM together
+TARGETED_FETCH_MERGE_GAP = 10000
+# use targeted fetches when merged catalog intervals cover at most this fraction of the reference
+TARGETED_FETCH_MAX_FRACTION = 0.05
+
+# bump when the layout of cached catalogs changes
+CATALOG_CACHE_VERSION = 1
+CATALOG_CACHE_ARRAYS = ('chrom_idx', 'starts', 'ends', 'label_buffer', 'label_starts', 'label_ends', 'trid_buffer')
+
+# values of the dropout column, indexed by determine_dropouts codes
+DROPOUT_LABELS = ('', 'HaplotypeDropout', 'PhasingDropout', 'FullDropout')
+# output is formatted and written this many rows at a time
+WRITE_BLOCK_ROWS = 65536
+WRITE_BUFFER_BYTES = 1 << 20
+
+DEFAULT_MIN_RQ = 0.99
+# QC histogram bins are split at these rq and mapping quality values
+RQ_BIN_EDGES = (0.95, 0.99, 0.995, 0.999)
+MAPQ_BIN_EDGES = (1, 20, 40, 60)
+# QC metrics are split by HP tag
+QC_HAPLOTYPES = {'1': 1, '2': 2}
+QC_HAPLOTYPE_LABELS = ('unphased', 'hap1', 'hap2')
+# per-read QC values are aggregated this many reads at a time
+QC_FLUSH_READS = 1 << 20
+
+# haplotype buckets, in the order of TandemRepeatCatalog count columns
+HAPLOTYPE_KEYS = ('0', '1', '2', 'fail')
+HAPLOTYPE_COLUMNS = {key: i for i, key in enumerate(HAPLOTYPE_KEYS)}
+
 
 def parse_tr_id(label: str) -> str:
   """Extract TR id from a label string containing 'ID=...'. Raises ValueError if not found."""
+  if label.startswith('ID='):
+    # TRGT catalogs list the ID first
+    return label[3:].split(';', 1)[0]
   for part in label.split(';'):
     if part.startswith('ID='):
       return part.split('=', 1)[1]
@@ -31,29 +74,210 @@ def parse_tr_id(label: str) -> str:
 
 
 class TandemRepeatRegion:
-  """Represent a tandem repeat region with per-haplotype read counts."""
+  """Lightweight view of one tandem repeat region and one sample's per-haplotype read counts in a TandemRepeatCatalog."""
+
+  __slots__ = ('catalog', 'row', 'sample')
+
+  def __init__(self, catalog: 'TandemRepeatCatalog', row: int, sample: int = 0) -> None:
+    self.catalog = catalog
+    self.row = row
+    self.sample = sample
+
+  @property
+  def chrom(self) -> str:
+    return self.catalog.chroms[self.catalog.chrom_idx[self.row]]
+
+  @property
+  def chrom_start(self) -> int:
+    return int(self.catalog.starts[self.row])
+
+  @property
+  def chrom_end(self) -> int:
+    return int(self.catalog.ends[self.row])
 
-  def __init__(self, chrom: str, chrom_start: int, chrom_end: int, label: str) -> None:
-    self.chrom: str = chrom
-    self.chrom_start: int = int(chrom_start)
-    self.chrom_end: int = int(chrom_end)
-    self.label: str = label
-    self.trid: str = parse_tr_id(label)
-    self.reads: Dict[str, int] = {'0': 0, '1': 0, '2': 0, 'fail': 0}
+  @property
+  def label(self) -> str:
+    return self.catalog.label(self.row)
+
+  @property
+  def trid(self) -> str:
+    return parse_tr_id(self.label)
+
+  @property
+  def reads(self) -> Dict[str, int]:
+    return dict(zip(HAPLOTYPE_KEYS, self.catalog.counts[self.sample, self.row].tolist()))
 
   def __repr__(self) -> str:
     return f'TandemRepeatRegion(chrom={self.chrom}, start={self.chrom_start}, end={self.chrom_end}, trid={self.trid}, reads={self.reads})'
 
-  def add_haplotagged_read(self, key) -> None:
-    """Add a read to the appropriate haplotype bucket."""
-    self.reads[key] += 1
+  def add_haplotagged_read(self, key, count: int = 1) -> None:
+    """Add count reads to the appropriate haplotype bucket."""
+    self.catalog.counts[self.sample, self.row, HAPLOTYPE_COLUMNS[key]] += count
+
+
+class TandemRepeatCatalog(Mapping):
+  """
+  Columnar store of catalog regions, mapping TR ID -> TandemRepeatRegion view in catalog order.
+
+  Chromosome indices, starts, ends and the four haplotype count columns are NumPy arrays, and labels are
+  kept in one UTF-8 buffer with per-row offsets, so each region costs a row in each array and an entry in the
+  TR ID -> row index rather than a Python object with its own dict and strings.  Counts are kept per sample,
+  with shape (samples, regions, haplotype buckets).
+  """
+
+  def __init__(
+    self,
+    chroms: List[str],
+    chrom_idx: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    label_buffer: np.ndarray,
+    label_starts: np.ndarray,
+    label_ends: np.ndarray,
+    index: Optional[Dict[str, int]] = None,
+    trid_buffer: Optional[np.ndarray] = None,
+  ) -> None:
+    self.chroms = chroms
+    self.chrom_idx = chrom_idx
+    self.starts = starts
+    self.ends = ends
+    self.label_buffer = label_buffer
+    self.label_starts = label_starts
+    self.label_ends = label_ends
+    self._index = index
+    self._trid_buffer = trid_buffer
+    self.set_samples([''])
 
+  @classmethod
+  def from_records(cls, records: Iterable[Tuple[str, int, int, str]]) -> 'TandemRepeatCatalog':
+    """Build a catalog from (chrom, start, end, label) records; a repeated TR ID replaces the earlier region."""
+    chroms: Dict[str, int] = {}
+    columns = {name: array.array('q') for name in ('chrom_idx', 'starts', 'ends', 'label_starts', 'label_ends')}
+    label_buffer = bytearray()
+    index: Dict[str, int] = {}
+    for chrom, start, end, label in records:
+      values = (chroms.setdefault(chrom, len(chroms)), start, end, len(label_buffer))
+      label_buffer += label.encode()
+      values += (len(label_buffer),)
+      row = index.setdefault(parse_tr_id(label), len(index))
+      for column, value in zip(columns.values(), values):
+        if row < len(column):
+          column[row] = value
+        else:
+          column.append(value)
+    arrays = {name: np.frombuffer(column, dtype=np.int64) for name, column in columns.items()}
+    return cls(
+      list(chroms),
+      arrays['chrom_idx'].astype(np.int32),
+      arrays['starts'],
+      arrays['ends'],
+      np.frombuffer(label_buffer, dtype=np.uint8),
+      arrays['label_starts'],
+      arrays['label_ends'],
+      index,
+    )
 
-def rq_from_bq(bq: 'list[int]') -> float:
-  """Compute read quality from an array of phred scaled base qualities"""
-  read_len = len(bq)
-  expectedErrors = sum([math.pow(10, -0.1 * x) for x in bq])
-  return 1 - (expectedErrors / read_len) if read_len > 0 else 0.0
+  @classmethod
+  def load(cls, path: str) -> 'TandemRepeatCatalog':
+    """Load a catalog saved with save(), memory-mapping its arrays read-only."""
+    arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in CATALOG_CACHE_ARRAYS}
+    return cls(
+      np.load(os.path.join(path, 'chroms.npy')).tolist(),
+      arrays['chrom_idx'],
+      arrays['starts'],
+      arrays['ends'],
+      arrays['label_buffer'],
+      arrays['label_starts'],
+      arrays['label_ends'],
+      trid_buffer=arrays['trid_buffer'],
+    )
+
+  def save(self, path: str) -> None:
+    """Save the catalog regions as .npy files in a new directory at path, replacing it atomically."""
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp')
+    arrays = {
+      'chrom_idx': self.chrom_idx,
+      'starts': self.starts,
+      'ends': self.ends,
+      'label_buffer': self.label_buffer,
+      'label_starts': self.label_starts,
+      'label_ends': self.label_ends,
+      'trid_buffer': np.frombuffer('\n'.join(self.index).encode(), dtype=np.uint8),
+    }
+    for name, values in arrays.items():
+      np.save(os.path.join(tmp_path, f'{name}.npy'), values)
+    np.save(os.path.join(tmp_path, 'chroms.npy'), np.array(self.chroms, dtype=str))
+    try:
+      os.rename(tmp_path, path)
+    except OSError:
+      # another process saved the same catalog first
+      shutil.rmtree(tmp_path)
+
+  @property
+  def index(self) -> Dict[str, int]:
+    """TR ID -> row index, built on first use for catalogs loaded from a cache."""
+    if self._index is None:
+      trids = self._trid_buffer.tobytes().decode().split('\n') if len(self.starts) else []
+      self._index = dict(zip(trids, range(len(trids))))
+    return self._index
+
+  def set_samples(self, samples: List[str]) -> None:
+    """Set the sample names and reset read counts."""
+    self.samples = list(samples)
+    self.counts = np.zeros((len(self.samples), len(self.starts), len(HAPLOTYPE_KEYS)), dtype=np.int32)
+
+  def __getitem__(self, trid: str) -> TandemRepeatRegion:
+    return TandemRepeatRegion(self, self.index[trid])
+
+  def __contains__(self, trid: object) -> bool:
+    return trid in self.index
+
+  def __iter__(self) -> Iterator[str]:
+    return iter(self.index)
+
+  def __len__(self) -> int:
+    return len(self.starts)
+
+  def label(self, row: int) -> str:
+    return self.label_buffer[self.label_starts[row] : self.label_ends[row]].tobytes().decode()
+
+  def labels(self, rows: np.ndarray) -> List[str]:
+    """Return the labels of several rows."""
+    buffer = memoryview(self.label_buffer)
+    return [
+      str(buffer[start:end], 'utf-8')
+      for start, end in zip(self.label_starts[rows].tolist(), self.label_ends[rows].tolist())
+    ]
+
+  def regions(self) -> Iterator[TandemRepeatRegion]:
+    """Yield a view of every region in catalog order."""
+    for row in range(len(self)):
+      yield TandemRepeatRegion(self, row)
+
+  def add_haplotagged_read(self, trid: str, key: str, count: int = 1, sample: int = 0) -> None:
+    """Add count reads of a sample for TR ID trid to the appropriate haplotype bucket."""
+    self.counts[sample, self.index[trid], HAPLOTYPE_COLUMNS[key]] += count
+
+
+# Error probability for every possible BAM base quality; phred 0-93 is the printable range.
+PHRED_TO_ERROR = np.power(10.0, -0.1 * np.arange(256))
+
+
+def rq_from_bq(bq: 'Sequence[int]') -> float:
+  """
+  Compute read quality from an array of phred scaled base qualities.
+
+  bq may be pysam's query_qualities array, which is viewed as uint8 without copying.  The expected
+  number of errors is the dot product of the base quality histogram with PHRED_TO_ERROR.
+  """
+  quals = np.asarray(bq, dtype=np.uint8)
+  read_len = len(quals)
+  if read_len == 0:
+    return 0.0
+  expectedErrors = float(np.dot(np.bincount(quals, minlength=256), PHRED_TO_ERROR))
+  return 1 - (expectedErrors / read_len)
 
 
 def open_bed(path: str):
@@ -62,9 +286,8 @@ def open_bed(path: str):
   return open(path, 'r')
 
 
-def load_trgt_catalog(trbed: str, chrom: Optional[str] = None) -> Dict[str, TandemRepeatRegion]:
-  """Load BED4+ regions and return dict mapping TR ID -> TandemRepeatRegion."""
-  tandem_repeats: Dict[str, TandemRepeatRegion] = {}
+def read_trgt_catalog(trbed: str, chrom: Optional[str] = None) -> Iterator[Tuple[str, int, int, str]]:
+  """Yield (chrom, start, end, label) records from a BED4+ catalog."""
   with open_bed(trbed) as fh:
     for line in fh:
       if not line.strip() or line.startswith('#'):
@@ -75,20 +298,107 @@ def load_trgt_catalog(trbed: str, chrom: Optional[str] = None) -> Dict[str, Tand
         continue
       if chrom and cols[0] != chrom:
         continue
-      tr = TandemRepeatRegion(cols[0], int(cols[1]), int(cols[2]), cols[3])
-      tandem_repeats[tr.trid] = tr
+      yield cols[0], int(cols[1]), int(cols[2]), cols[3]
+
+
+def catalog_cache_key(trbed: str, chrom: Optional[str] = None) -> str:
+  """Return the cache entry name for a catalog: the SHA-256 of its content, the cache version and chrom."""
+  sha256 = hashlib.sha256()
+  with open(trbed, 'rb') as fh:
+    for block in iter(lambda: fh.read(1 << 20), b''):
+      sha256.update(block)
+  return f'{sha256.hexdigest()}.v{CATALOG_CACHE_VERSION}' + (f'.{chrom}' if chrom else '')
+
+
+def load_trgt_catalog(
+  trbed: str, chrom: Optional[str] = None, cache_dir: Optional[str] = None
+) -> TandemRepeatCatalog:
+  """
+  Load BED4+ regions and return a TandemRepeatCatalog mapping TR ID -> TandemRepeatRegion.
+
+  With cache_dir, the parsed catalog is saved there keyed by the catalog's content hash, and later runs
+  memory-map the saved arrays instead of parsing the BED.
+  """
+  cache_path = os.path.join(cache_dir, catalog_cache_key(trbed, chrom)) if cache_dir else None
+  if cache_path and os.path.isdir(cache_path):
+    tandem_repeats = TandemRepeatCatalog.load(cache_path)
+    source = f'{trbed} (cached in {cache_path})'
+  else:
+    tandem_repeats = TandemRepeatCatalog.from_records(read_trgt_catalog(trbed, chrom))
+    source = trbed
+    if cache_path:
+      tandem_repeats.save(cache_path)
+      logging.info(f'Saved catalog cache to {cache_path}')
   logging.info(
-    f'Loaded {len(tandem_repeats)} tandem repeat regions from {trbed}' + (f' for chrom {chrom}' if chrom else '')
+    f'Loaded {len(tandem_repeats)} tandem repeat regions from {source}' + (f' for chrom {chrom}' if chrom else '')
   )
   return tandem_repeats
 
 
-def load_allosome_ploidy_bed(ploidy_bed: Optional[str] = None) -> Dict[Tuple[str, int, int], int]:
-  """Load BED file with ploidy information and return dict mapping (chrom, start, end) -> ploidy."""
+class PloidyIndex:
+  """
+  Per-chromosome sorted interval index over ploidy BED regions.
+
+  Regions are sorted by start for each chromosome, with a running maximum of region ends, so that a lookup
+  is a bisect followed by a short backwards scan over the regions that can still contain the query.  When
+  several regions contain a query, the one listed first in the BED file wins.
+  """
+
+  def __init__(self) -> None:
+    self._regions: Dict[str, List[Tuple[int, int, int, int]]] = defaultdict(list)
+    self._starts: Dict[str, List[int]] = {}
+    self._max_ends: Dict[str, List[int]] = {}
+
+  def __len__(self) -> int:
+    return sum(len(regions) for regions in self._regions.values())
+
+  def __repr__(self) -> str:
+    return f'PloidyIndex({dict(self._regions)})'
+
+  def __contains__(self, chrom: object) -> bool:
+    return chrom in self._regions
+
+  def add(self, chrom: str, start: int, end: int, ploidy: int) -> None:
+    """Add a region; the index is rebuilt on the next lookup."""
+    self._regions[chrom].append((start, end, len(self), ploidy))
+    self._starts.pop(chrom, None)
+
+  def _build(self, chrom: str) -> None:
+    regions = self._regions[chrom]
+    regions.sort()
+    self._starts[chrom] = [region[0] for region in regions]
+    max_ends = []
+    max_end = -1
+    for region in regions:
+      max_end = max(max_end, region[1])
+      max_ends.append(max_end)
+    self._max_ends[chrom] = max_ends
+
+  def get(self, chrom: str, start: int, end: int, default: int = 2) -> int:
+    """Return ploidy of the first region containing [start, end), or default if there is none."""
+    if chrom not in self._regions:
+      return default
+    if chrom not in self._starts:
+      self._build(chrom)
+    regions = self._regions[chrom]
+    max_ends = self._max_ends[chrom]
+    best = None
+    # only regions starting at or before the query can contain it
+    i = bisect.bisect_right(self._starts[chrom], start) - 1
+    while i >= 0 and max_ends[i] >= end:
+      s, e, order, ploidy = regions[i]
+      if e >= end and (best is None or order < best[0]):
+        best = (order, ploidy)
+      i -= 1
+    return best[1] if best is not None else default
+
+
+def load_allosome_ploidy_bed(ploidy_bed: Optional[str] = None) -> PloidyIndex:
+  """Load BED file with ploidy information and return a PloidyIndex of (chrom, start, end) -> ploidy."""
+  ploidy_index = PloidyIndex()
   if not ploidy_bed:
     logging.info('No ploidy BED file provided; assuming diploid for all regions.')
-    return {}
-  ploidy_dict: Dict[Tuple[str, int, int], int] = {}
+    return ploidy_index
   with open_bed(ploidy_bed) as fh:
     for line in fh:
       if not line.strip() or line.startswith('#'):
@@ -97,47 +407,373 @@ def load_allosome_ploidy_bed(ploidy_bed: Optional[str] = None) -> Dict[Tuple[str
       if len(cols) < 5:
         logging.warning(f'Skipping malformed ploidy BED line: {line.rstrip()}')
         continue
-      chrom = cols[0]
-      start = int(cols[1])
-      end = int(cols[2])
-      ploidy = int(cols[4])
-      ploidy_dict[(chrom, start, end)] = ploidy
+      ploidy_index.add(cols[0], int(cols[1]), int(cols[2]), int(cols[4]))
   logging.info(
-    f'Loaded ploidy information for {len(ploidy_dict)} regions from {ploidy_bed}; assuming diploid for all other regions.'
+    f'Loaded ploidy information for {len(ploidy_index)} regions from {ploidy_bed}; assuming diploid for all other regions.'
   )
-  logging.debug(f'Ploidy dict contents: {ploidy_dict}')
-  return ploidy_dict
+  logging.debug(f'Ploidy index contents: {ploidy_index}')
+  return ploidy_index
 
 
-def get_ploidy_for_region(ploidy_dict: Dict[Tuple[str, int, int], int], chrom: str, start: int, end: int) -> int:
-  """Get ploidy for a given region from the ploidy dict, defaulting to 2 if not found."""
-  if chrom not in [_[0] for _ in ploidy_dict.keys()]:
-    return 2
-  for (c, s, e), p in ploidy_dict.items():
-    if c == chrom and start >= s and end <= e:
-      return p
-  return 2
+def get_ploidy_for_region(ploidy_index: PloidyIndex, chrom: str, start: int, end: int) -> int:
+  """Get ploidy for a given region from the ploidy index, defaulting to 2 if not found."""
+  return ploidy_index.get(chrom, start, end)
 
 
-def assign_haplotags(
-  tandem_repeats: Dict[str, TandemRepeatRegion], spanning_bam: str, chrom: Optional[str] = None
-) -> None:
-  """Walk haplotagged spanning BAM and assign read counts to TR regions by haplotype."""
+def merge_catalog_intervals(
+  tandem_repeats: TandemRepeatCatalog, gap: int = TARGETED_FETCH_MERGE_GAP
+) -> Dict[str, List[Tuple[int, int]]]:
+  """Return sorted, merged catalog intervals per chromosome, joining intervals less than gap bp apart."""
+  merged: Dict[str, List[Tuple[int, int]]] = {}
+  for i, chrom in enumerate(tandem_repeats.chroms):
+    rows = np.flatnonzero(tandem_repeats.chrom_idx == i)
+    if len(rows) == 0:
+      continue
+    rows = rows[np.argsort(tandem_repeats.starts[rows], kind='stable')]
+    starts = tandem_repeats.starts[rows]
+    reach = np.maximum.accumulate(tandem_repeats.ends[rows])
+    # an interval starts a new merged interval when it begins at least gap bp after everything before it
+    first = np.flatnonzero(np.concatenate(([True], starts[1:] - reach[:-1] >= gap)))
+    last = np.append(first[1:], len(rows)) - 1
+    merged[chrom] = list(zip(starts[first].tolist(), reach[last].tolist()))
+  return merged
+
+
+def choose_fetch_mode(intervals: Dict[str, List[Tuple[int, int]]], spanning_bam: str) -> str:
+  """Pick 'targeted' when the merged catalog spans a small fraction of the BAM's reference, else 'full'."""
   with pysam.AlignmentFile(spanning_bam, 'rb') as tb:
-    for r in tb.fetch(chrom) if chrom else tb.fetch():
-      if r.has_tag('TR') and r.get_tag('TR') in tandem_repeats:
-        if r.has_tag('rq'):
-          rq = float(r.get_tag('rq'))
-        else:
-          logging.warning(
-            f'Read {str(r.query_name) if r.query_name else ""} missing rq tag; computing from base qualities.'
-          )
-          rq = rq_from_bq(list(r.query_qualities)) if r.query_qualities else 0.0
-        if rq < 0.99:
-          hp = 'fail'
-        else:
-          hp = str(r.get_tag('HP')) if r.has_tag('HP') else '0'
-        tandem_repeats[str(r.get_tag('TR'))].add_haplotagged_read(hp)
+    reference_length = sum(tb.lengths)
+  span = sum(end - start for chrom_intervals in intervals.values() for start, end in chrom_intervals)
+  fraction = span / reference_length if reference_length else 1.0
+  mode = 'targeted' if fraction <= TARGETED_FETCH_MAX_FRACTION else 'full'
+  logging.info(f'Merged catalog intervals cover {fraction:.2%} of the reference; using {mode} BAM fetch')
+  return mode
+
+
+def fetch_reads(
+  tb: pysam.AlignmentFile, chrom: Optional[str] = None, intervals: Optional[List[Tuple[int, int]]] = None
+) -> Iterator[pysam.AlignedSegment]:
+  """
+  Fetch reads from the whole BAM, from chrom, or only reads overlapping sorted, disjoint intervals on chrom,
+  none if chrom is not in the BAM header.
+
+  A read overlapping several intervals is returned by each of their fetches.  Intervals are fetched in
+  order, so a read starting before the end of the previous interval has already been yielded; skipping
+  those deduplicates reads by query name and TR without keeping a set of names.
+  """
+  if intervals is None:
+    yield from tb.fetch(chrom) if chrom else tb.fetch()
+    return
+  if chrom not in tb.references:
+    # catalog loci on contigs missing from the BAM have no reads, as in a full scan
+    return
+  previous_end = -1
+  for start, end in intervals:
+    for r in tb.fetch(chrom, start, end):
+      if r.reference_start >= previous_end:
+        yield r
+    previous_end = end
+
+
+class LocusQC:
+  """
+  Per-region read QC metrics by sample and HP tag: rq and mapping quality histograms, and the count, sum,
+  minimum and maximum of spanning read lengths, which cover the repeat allele and its flanks.
+  """
+
+  def __init__(self, n_samples: int, n_regions: int) -> None:
+    shape = (n_samples, n_regions, len(QC_HAPLOTYPE_LABELS))
+    self.rq_hist = np.zeros(shape + (len(RQ_BIN_EDGES) + 1,), dtype=np.int32)
+    self.mapq_hist = np.zeros(shape + (len(MAPQ_BIN_EDGES) + 1,), dtype=np.int32)
+    self.span_sum = np.zeros(shape, dtype=np.int64)
+    self.span_min = np.full(shape, np.iinfo(np.int32).max, dtype=np.int32)
+    self.span_max = np.zeros(shape, dtype=np.int32)
+
+  def add_reads(
+    self, sample: int, rows: np.ndarray, haps: np.ndarray, rqs: np.ndarray, mapqs: np.ndarray, spans: np.ndarray
+  ) -> None:
+    """Add per-read values for one sample, aggregating reads of the same region and haplotype first."""
+    if len(rows) == 0:
+      return
+    keys = rows * len(QC_HAPLOTYPE_LABELS) + haps
+    for hist, bins in (
+      (self.rq_hist, np.searchsorted(RQ_BIN_EDGES, rqs, side='right')),
+      (self.mapq_hist, np.searchsorted(MAPQ_BIN_EDGES, mapqs, side='right')),
+    ):
+      hist_keys, hist_counts = np.unique(keys * hist.shape[-1] + bins, return_counts=True)
+      hist[sample].reshape(-1)[hist_keys] += hist_counts.astype(hist.dtype)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    spans = spans[order]
+    first = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    keys = keys[first]
+    self.span_sum[sample].reshape(-1)[keys] += np.add.reduceat(spans, first)
+    span_min = self.span_min[sample].reshape(-1)
+    span_min[keys] = np.minimum(span_min[keys], np.minimum.reduceat(spans, first))
+    span_max = self.span_max[sample].reshape(-1)
+    span_max[keys] = np.maximum(span_max[keys], np.maximum.reduceat(spans, first))
+
+  def merge(self, other: 'LocusQC', sample: int, rows: np.ndarray) -> None:
+    """Merge a single-sample LocusQC whose regions are the given rows of this one into sample."""
+    self.rq_hist[sample, rows] += other.rq_hist[0]
+    self.mapq_hist[sample, rows] += other.mapq_hist[0]
+    self.span_sum[sample, rows] += other.span_sum[0]
+    self.span_min[sample, rows] = np.minimum(self.span_min[sample, rows], other.span_min[0])
+    self.span_max[sample, rows] = np.maximum(self.span_max[sample, rows], other.span_max[0])
+
+  def write(self, tandem_repeats: TandemRepeatCatalog, out: TextIO) -> None:
+    """Write one row per region, sample and HP tag with reads, in catalog order."""
+    multi_sample = len(tandem_repeats.samples) > 1
+    out.write(
+      '\t'.join(
+        [
+          'chrom',
+          'start',
+          'end',
+          'trid',
+          *(['sample'] if multi_sample else []),
+          'haplotype',
+          'reads',
+          *bin_labels('rq', RQ_BIN_EDGES),
+          *bin_labels('mapq', MAPQ_BIN_EDGES),
+          'span_len_min',
+          'span_len_mean',
+          'span_len_max',
+        ]
+      )
+      + '\n'
+    )
+    reads = self.rq_hist.sum(axis=-1)
+    samples, rows, haps = np.nonzero(reads)
+    order = np.lexsort((haps, samples, rows))
+    samples, rows, haps = samples[order], rows[order], haps[order]
+    for block in range(0, len(rows), WRITE_BLOCK_ROWS):
+      block_slice = slice(block, block + WRITE_BLOCK_ROWS)
+      index = (samples[block_slice], rows[block_slice], haps[block_slice])
+      block_rows = index[1]
+      block_reads = reads[index]
+      lines = []
+      for label, sample, chrom_idx, start, end, hap, n, rq_hist, mapq_hist, span_min, span_mean, span_max in zip(
+        tandem_repeats.labels(block_rows),
+        index[0].tolist(),
+        tandem_repeats.chrom_idx[block_rows].tolist(),
+        tandem_repeats.starts[block_rows].tolist(),
+        tandem_repeats.ends[block_rows].tolist(),
+        index[2].tolist(),
+        block_reads.tolist(),
+        self.rq_hist[index].tolist(),
+        self.mapq_hist[index].tolist(),
+        self.span_min[index].tolist(),
+        (self.span_sum[index] / block_reads).tolist(),
+        self.span_max[index].tolist(),
+      ):
+        sample_col = f'{tandem_repeats.samples[sample]}\t' if multi_sample else ''
+        lines.append(
+          f'{tandem_repeats.chroms[chrom_idx]}\t{start}\t{end}\t{label}\t{sample_col}{QC_HAPLOTYPE_LABELS[hap]}\t{n}\t'
+          + '\t'.join(map(str, rq_hist + mapq_hist))
+          + f'\t{span_min}\t{span_mean:.1f}\t{span_max}\n'
+        )
+      out.write(''.join(lines))
+
+
+def bin_labels(name: str, edges: Sequence[float]) -> List[str]:
+  """Return column names for a histogram with bins split at edges."""
+  return (
+    [f'{name}_lt{edges[0]}']
+    + [f'{name}_{low}-{high}' for low, high in zip(edges[:-1], edges[1:])]
+    + [f'{name}_ge{edges[-1]}']
+  )
+
+
+class ReadQCBuffer:
+  """Per-read QC values of one sample, buffered in compact arrays until they are added to a LocusQC."""
+
+  def __init__(self, index: Dict[str, int]) -> None:
+    self.index = index
+    self.clear()
+
+  def clear(self) -> None:
+    self.rows = array.array('q')
+    self.haps = array.array('b')
+    self.rqs = array.array('d')
+    self.mapqs = array.array('B')
+    self.spans = array.array('q')
+
+  def __len__(self) -> int:
+    return len(self.rows)
+
+  def add(self, trid: str, tag_hp: str, rq: float, mapq: int, span: int) -> None:
+    self.rows.append(self.index[trid])
+    self.haps.append(QC_HAPLOTYPES.get(tag_hp, 0))
+    self.rqs.append(rq)
+    self.mapqs.append(mapq)
+    self.spans.append(span)
+
+  def arrays(self) -> Tuple[np.ndarray, ...]:
+    return tuple(
+      np.frombuffer(values, dtype=dtype) if len(values) else np.zeros(0, dtype=dtype)
+      for values, dtype in (
+        (self.rows, np.int64),
+        (self.haps, np.int8),
+        (self.rqs, np.float64),
+        (self.mapqs, np.uint8),
+        (self.spans, np.int64),
+      )
+    )
+
+  def flush(self, qc: LocusQC, sample: int) -> None:
+    """Add buffered reads to qc and clear the buffer."""
+    qc.add_reads(sample, *self.arrays())
+    self.clear()
+
+  def compact(self) -> Tuple[np.ndarray, LocusQC]:
+    """Return the catalog rows with reads and a single-sample LocusQC over just those rows."""
+    rows, haps, rqs, mapqs, spans = self.arrays()
+    touched, local_rows = np.unique(rows, return_inverse=True)
+    qc = LocusQC(1, len(touched))
+    qc.add_reads(0, local_rows.reshape(-1), haps, rqs, mapqs, spans)
+    return touched, qc
+
+
+def haplotagged_reads(
+  tb: pysam.AlignmentFile,
+  trids: Container[str],
+  stats: Counter,
+  chrom: Optional[str] = None,
+  intervals: Optional[List[Tuple[int, int]]] = None,
+  min_rq: float = DEFAULT_MIN_RQ,
+  qc_reads: Optional[ReadQCBuffer] = None,
+) -> Iterator[Tuple[str, str]]:
+  """
+  Yield (TR ID, haplotype bucket) for each spanning read of a TR in trids.
+
+  Reads with read quality below min_rq are counted as 'fail'.  Reads without an rq tag are counted in
+  stats['missing_rq'].  With qc_reads, the rq, mapping quality and length of every read are added to it.
+  """
+  for r in fetch_reads(tb, chrom, intervals):
+    if r.has_tag('TR') and r.get_tag('TR') in trids:
+      if r.has_tag('rq'):
+        rq = float(r.get_tag('rq'))
+      else:
+        stats['missing_rq'] += 1
+        quals = r.query_qualities
+        rq = rq_from_bq(quals) if quals else 0.0
+      trid = str(r.get_tag('TR'))
+      if qc_reads is not None:
+        tag_hp = str(r.get_tag('HP')) if r.has_tag('HP') else '0'
+        qc_reads.add(trid, tag_hp, rq, r.mapping_quality, r.query_length)
+      if rq < min_rq:
+        hp = 'fail'
+      else:
+        hp = str(r.get_tag('HP')) if r.has_tag('HP') else '0'
+      yield trid, hp
+
+
+_worker_trids: Container[str] = frozenset()
+
+
+def _init_worker(trids: Container[str]) -> None:
+  global _worker_trids
+  _worker_trids = trids
+
+
+def _count_contig_haplotags(
+  spanning_bam: str, contig: str, intervals: Optional[List[Tuple[int, int]]], min_rq: float, collect_qc: bool
+) -> Tuple[Counter, Counter, Optional[Tuple[np.ndarray, LocusQC]]]:
+  """
+  Count spanning reads per (TR ID, haplotype bucket) for one contig; runs in a worker process.
+
+  With collect_qc, also return QC metrics for the catalog rows with reads.
+  """
+  stats: Counter = Counter()
+  qc_reads = ReadQCBuffer(_worker_trids.index) if collect_qc else None
+  with pysam.AlignmentFile(spanning_bam, 'rb') as tb:
+    counts = Counter(haplotagged_reads(tb, _worker_trids, stats, contig, intervals, min_rq, qc_reads))
+  return counts, stats, qc_reads.compact() if qc_reads is not None else None
+
+
+def bam_contigs(spanning_bam: str) -> List[str]:
+  """Return contigs with mapped reads in an indexed BAM, most reads first."""
+  with pysam.AlignmentFile(spanning_bam, 'rb') as tb:
+    stats = [s for s in tb.get_index_statistics() if s.mapped > 0]
+  return [s.contig for s in sorted(stats, key=lambda s: s.mapped, reverse=True)]
+
+
+def bam_sample_name(spanning_bam: str) -> str:
+  """Return the sample name from the BAM read groups, or the file name if no read group has SM."""
+  with pysam.AlignmentFile(spanning_bam, 'rb') as tb:
+    read_groups = tb.header.to_dict().get('RG', [])
+  samples = list(dict.fromkeys(rg['SM'] for rg in read_groups if 'SM' in rg))
+  if not samples:
+    sample = spanning_bam.split('/')[-1].split('.')[0]
+    logging.warning(f'No read group sample name in {spanning_bam}; using {sample}')
+    return sample
+  if len(samples) > 1:
+    logging.warning(f'Multiple read group sample names in {spanning_bam}; using {samples[0]}')
+  return samples[0]
+
+
+def assign_haplotags(
+  tandem_repeats: TandemRepeatCatalog,
+  spanning_bams: List[str],
+  chrom: Optional[str] = None,
+  threads: int = 1,
+  fetch_mode: str = 'auto',
+  min_rq: float = DEFAULT_MIN_RQ,
+  qc: Optional[LocusQC] = None,
+) -> Counter:
+  """
+  Walk haplotagged spanning BAMs and assign read counts to TR regions by sample and haplotype.
+
+  The i-th BAM is counted into sample i of tandem_repeats, with reads below min_rq counted as 'fail'.
+  With qc, per-region read QC metrics are collected into it in the same walk.
+  fetch_mode is 'full' to scan every read, 'targeted' to fetch only reads overlapping the merged catalog
+  intervals, or 'auto' to choose between them from the catalog's span.
+  With threads > 1, each indexed BAM is split by contig and every (BAM, contig) pair is counted in a
+  worker process.  Counts are merged back into tandem_repeats, so the result is identical to the serial walk.
+  Return aggregated statistics of the walk.
+  """
+  stats: Counter = Counter()
+  if not tandem_repeats:
+    return stats
+  intervals = merge_catalog_intervals(tandem_repeats)
+  if fetch_mode == 'auto':
+    fetch_mode = choose_fetch_mode(intervals, spanning_bams[0])
+  tasks = []
+  for sample, spanning_bam in enumerate(spanning_bams):
+    if fetch_mode == 'targeted':
+      contig_tasks = list(intervals.items())
+    elif threads > 1:
+      contig_tasks = [(contig, None) for contig in ([chrom] if chrom else bam_contigs(spanning_bam))]
+    else:
+      contig_tasks = [(chrom, None)]
+    tasks.extend((sample, spanning_bam, contig, contig_intervals) for contig, contig_intervals in contig_tasks)
+
+  if threads <= 1:
+    for (sample, spanning_bam), bam_tasks in itertools.groupby(tasks, key=lambda task: task[:2]):
+      qc_reads = ReadQCBuffer(tandem_repeats.index) if qc is not None else None
+      with pysam.AlignmentFile(spanning_bam, 'rb') as tb:
+        for _, _, contig, contig_intervals in bam_tasks:
+          for trid, hp in haplotagged_reads(tb, tandem_repeats, stats, contig, contig_intervals, min_rq, qc_reads):
+            tandem_repeats.add_haplotagged_read(trid, hp, sample=sample)
+            if qc_reads is not None and len(qc_reads) >= QC_FLUSH_READS:
+              qc_reads.flush(qc, sample)
+      if qc_reads is not None:
+        qc_reads.flush(qc, sample)
+    return stats
+  logging.info(f'Counting spanning reads for {len(tasks)} BAM contigs with {threads} worker processes')
+  with multiprocessing.Pool(threads, initializer=_init_worker, initargs=(tandem_repeats,)) as pool:
+    results = pool.starmap(
+      _count_contig_haplotags, [(*task[1:], min_rq, qc is not None) for task in tasks], chunksize=1
+    )
+    for (sample, *_), (counts, contig_stats, contig_qc) in zip(tasks, results):
+      for (trid, hp), n in counts.items():
+        tandem_repeats.add_haplotagged_read(trid, hp, n, sample)
+      stats.update(contig_stats)
+      if contig_qc is not None:
+        rows, part = contig_qc
+        qc.merge(part, sample, rows)
+  return stats
 
 
 def determine_dropout(
@@ -176,20 +812,72 @@ def determine_dropout(
   )
 
 
+def determine_dropouts(
+  hap1: np.ndarray,
+  hap2: np.ndarray,
+  unphased: np.ndarray,
+  coverage: int,
+  ploidy: np.ndarray,
+) -> np.ndarray:
+  """Vectorized determine_dropout over arrays of counts and ploidy; return indices into DROPOUT_LABELS."""
+  unsupported = ~np.isin(ploidy, (0, 1, 2))
+  if unsupported.any():
+    raise ValueError(f'Unsupported ploidy value: {ploidy[unsupported].flat[0]}')
+  hap1_low = hap1 < coverage
+  hap2_low = hap2 < coverage
+  total_low = (hap1 + hap2 + unphased) < coverage * ploidy
+  ploidy, total_low = np.broadcast_arrays(ploidy, total_low)
+  return np.select(
+    [ploidy == 0, ploidy == 1, hap1_low & hap2_low, hap1_low | hap2_low],
+    [0, np.where(total_low, 3, 0), np.where(total_low, 3, 2), 1],
+    default=0,
+  ).astype(np.int8)
+
+
+def region_ploidy(tandem_repeats: TandemRepeatCatalog, ploidy_index: PloidyIndex) -> np.ndarray:
+  """Return the expected ploidy of every catalog region."""
+  ploidy = np.full(len(tandem_repeats), 2, dtype=np.int64)
+  for i, chrom in enumerate(tandem_repeats.chroms):
+    if chrom not in ploidy_index:
+      continue
+    rows = np.flatnonzero(tandem_repeats.chrom_idx == i)
+    starts = tandem_repeats.starts[rows].tolist()
+    ends = tandem_repeats.ends[rows].tolist()
+    ploidy[rows] = [get_ploidy_for_region(ploidy_index, chrom, s, e) for s, e in zip(starts, ends)]
+  return ploidy
+
+
+def position_order(tandem_repeats: TandemRepeatCatalog) -> np.ndarray:
+  """Return catalog rows ordered by chromosome, in order of first appearance, then start."""
+  return np.lexsort((tandem_repeats.starts, tandem_repeats.chrom_idx))
+
+
 def compute_and_print_results(
-  tandem_repeats: Dict[str, TandemRepeatRegion],
-  ploidy_dict: Dict[Tuple[str, int, int], int],
+  tandem_repeats: TandemRepeatCatalog,
+  ploidy_index: PloidyIndex,
   coverage: int,
   print_all: bool,
+  out: Optional[TextIO] = None,
+  sort: bool = False,
 ) -> None:
-  """Compute dropouts and write tab-delimited output to stdout."""
-  print(
+  """
+  Compute dropouts and write tab-delimited output to out, by default stdout.
+
+  Dropouts are computed for all regions at once, and only the rows that will be printed are formatted.
+  Rows are written in catalog order, or ordered by position if sort is set, in blocks of WRITE_BLOCK_ROWS.
+  With more than one sample, the output is a long table with one row per region and sample, and a sample
+  column after trid.
+  """
+  out = out or sys.stdout
+  multi_sample = len(tandem_repeats.samples) > 1
+  out.write(
     '\t'.join(
       [
         'chrom',
         'start',
         'end',
         'trid',
+        *(['sample'] if multi_sample else []),
         'expected_ploidy',
         'hap1_count',
         'hap2_count',
@@ -197,43 +885,142 @@ def compute_and_print_results(
         'fail_read_count',
         'dropout',
       ]
-    ),
-    file=sys.stdout,
-  )
-  for tr in tandem_repeats.values():
-    unphased = tr.reads['0']
-    hap1 = tr.reads['1']
-    hap2 = tr.reads['2']
-    fail = tr.reads['fail']
-    ploidy = get_ploidy_for_region(ploidy_dict, tr.chrom, int(tr.chrom_start), int(tr.chrom_end))
-    dropout = determine_dropout(hap1, hap2, unphased, coverage, ploidy)
-
-    # print only regions with dropouts or fail_reads unless print_all is set
-    if not print_all and dropout == '' and fail == 0:
-      continue
-    print(
-      f'{tr.chrom}\t{tr.chrom_start}\t{tr.chrom_end}\t{tr.label}\t{ploidy}\t{hap1}\t{hap2}\t{unphased}\t{fail}\t{dropout}',
-      file=sys.stdout,
     )
+    + '\n'
+  )
+  ploidy = region_ploidy(tandem_repeats, ploidy_index)
+  counts = tandem_repeats.counts.transpose(1, 0, 2)
+  unphased, hap1, hap2, fail = (counts[:, :, HAPLOTYPE_COLUMNS[key]] for key in HAPLOTYPE_KEYS)
+  dropouts = determine_dropouts(hap1, hap2, unphased, coverage, ploidy[:, np.newaxis])
+
+  # print only regions with dropouts or fail_reads unless print_all is set
+  order = position_order(tandem_repeats) if sort else np.arange(len(tandem_repeats))
+  keep = np.ones(dropouts.shape, dtype=bool) if print_all else (dropouts != 0) | (fail > 0)
+  rows, samples = np.nonzero(keep[order])
+  rows = order[rows]
+  for block in range(0, len(rows), WRITE_BLOCK_ROWS):
+    block_rows = rows[block : block + WRITE_BLOCK_ROWS]
+    block_samples = samples[block : block + WRITE_BLOCK_ROWS]
+    lines = []
+    for label, sample, chrom_idx, start, end, row_ploidy, h1, h2, h0, f, dropout in zip(
+      tandem_repeats.labels(block_rows),
+      block_samples.tolist(),
+      tandem_repeats.chrom_idx[block_rows].tolist(),
+      tandem_repeats.starts[block_rows].tolist(),
+      tandem_repeats.ends[block_rows].tolist(),
+      ploidy[block_rows].tolist(),
+      hap1[block_rows, block_samples].tolist(),
+      hap2[block_rows, block_samples].tolist(),
+      unphased[block_rows, block_samples].tolist(),
+      fail[block_rows, block_samples].tolist(),
+      dropouts[block_rows, block_samples].tolist(),
+    ):
+      sample_col = f'{tandem_repeats.samples[sample]}\t' if multi_sample else ''
+      lines.append(
+        f'{tandem_repeats.chroms[chrom_idx]}\t{start}\t{end}\t{label}\t{sample_col}'
+        f'{row_ploidy}\t{h1}\t{h2}\t{h0}\t{f}\t{DROPOUT_LABELS[dropout]}\n'
+      )
+    out.write(''.join(lines))
+
+
+def open_output(output: str) -> TextIO:
+  """Open output for writing text, bgzip-compressed if it ends in .gz."""
+  if output.endswith('.gz'):
+    return io.TextIOWrapper(pysam.BGZFile(output, 'wb'), encoding='utf-8')
+  return open(output, 'w', buffering=WRITE_BUFFER_BYTES)
+
+
+def write_results(
+  tandem_repeats: TandemRepeatCatalog,
+  ploidy_index: PloidyIndex,
+  coverage: int,
+  print_all: bool,
+  output: Optional[str] = None,
+  tabix: bool = False,
+) -> None:
+  """
+  Write results to stdout, a plain TSV, or a bgzip-compressed TSV if output ends in .gz.
+
+  With tabix, output must be bgzip-compressed; rows are written sorted by position and a tabix index is
+  built so that regions can be queried without reading the whole file.
+  """
+  if tabix and not (output and output.endswith('.gz')):
+    raise ValueError('A tabix index requires bgzip output; use an output path ending in .gz')
+  if not output or output == '-':
+    compute_and_print_results(tandem_repeats, ploidy_index, coverage, print_all)
+    sys.stdout.flush()
+    return
+  with open_output(output) as out:
+    compute_and_print_results(tandem_repeats, ploidy_index, coverage, print_all, out, sort=tabix)
+  if tabix:
+    # header is the first line; coordinates are BED-style
+    pysam.tabix_index(output, seq_col=0, start_col=1, end_col=2, line_skip=1, zerobased=True, force=True)
+    logging.info(f'Wrote tabix index {output}.tbi')
 
 
 def main(argv=None):
   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('trbed', help='Regions of interest, BED4+ (chrom, chromStart, chromEnd, label)')
-  parser.add_argument('spanning_bam', help='Spanning reads bam.')
+  parser.add_argument(
+    'spanning_bam', nargs='+', help='Spanning reads bam; with several, one per sample named by read group SM.'
+  )
   parser.add_argument('--chrom', help='Chromosome to analyze', default=None)
+  parser.add_argument(
+    '--threads', '-t', type=int, default=1, help='Worker processes for counting reads by BAM and contig.'
+  )
+  parser.add_argument(
+    '--fetch',
+    choices=['auto', 'targeted', 'full'],
+    default='auto',
+    help='Fetch only reads overlapping catalog intervals (targeted), scan the whole BAM (full), or choose from the catalog span (auto).',
+  )
+  parser.add_argument(
+    '--catalog-cache',
+    default=os.environ.get('TRGT_CATALOG_CACHE'),
+    help='Directory of precompiled catalogs keyed by content hash (default: $TRGT_CATALOG_CACHE).',
+  )
   parser.add_argument('--ploidybed', '-p', type=str, help='BED file with ploidy information for allosomes')
   parser.add_argument('--coverage', '-c', type=int, default=2, help='Minimum per-haplotype coverage for region.')
+  parser.add_argument(
+    '--min-rq', type=float, default=DEFAULT_MIN_RQ, help='Reads with lower read quality are counted as failed.'
+  )
+  parser.add_argument(
+    '--qc-output',
+    default=None,
+    help='Write per-region rq, mapping quality and read length QC by haplotype to this TSV; bgzip-compressed if it ends in .gz.',
+  )
   parser.add_argument('--print-all', '-a', action='store_true', help='Print all regions, not just those with dropouts.')
+  parser.add_argument(
+    '--output', '-o', default=None, help='Output TSV; bgzip-compressed if it ends in .gz. (default: stdout)'
+  )
+  parser.add_argument(
+    '--tabix', action='store_true', help='Sort bgzip output by position and build a tabix index for it.'
+  )
   parser.add_argument('--version', '-V', action='version', version=f'%(prog)s (version {__version__})')
   args = parser.parse_args(argv)
 
   logging.info(f'Starting find_trgt_dropouts (version {__version__})')
 
-  tandem_repeats = load_trgt_catalog(args.trbed, args.chrom)
-  ploidy_dict = load_allosome_ploidy_bed(args.ploidybed)
-  assign_haplotags(tandem_repeats, args.spanning_bam, args.chrom)
-  compute_and_print_results(tandem_repeats, ploidy_dict, args.coverage, args.print_all)
+  tandem_repeats = load_trgt_catalog(args.trbed, args.chrom, args.catalog_cache)
+  if len(args.spanning_bam) > 1:
+    samples = [bam_sample_name(spanning_bam) for spanning_bam in args.spanning_bam]
+    duplicates = sorted({sample for sample in samples if samples.count(sample) > 1})
+    if duplicates:
+      raise ValueError(f'Duplicate sample names across spanning BAMs: {", ".join(duplicates)}')
+    tandem_repeats.set_samples(samples)
+    logging.info(f'Counting {len(samples)} samples: {", ".join(samples)}')
+  ploidy_index = load_allosome_ploidy_bed(args.ploidybed)
+  qc = LocusQC(len(tandem_repeats.samples), len(tandem_repeats)) if args.qc_output else None
+  stats = assign_haplotags(
+    tandem_repeats, args.spanning_bam, args.chrom, args.threads, args.fetch, args.min_rq, qc
+  )
+  if stats['missing_rq']:
+    logging.warning(f'{stats["missing_rq"]} reads missing rq tag; read quality computed from base qualities.')
+  write_results(tandem_repeats, ploidy_index, args.coverage, args.print_all, args.output, args.tabix)
+  if qc is not None:
+    with open_output(args.qc_output) as out:
+      qc.write(tandem_repeats, out)
+    logging.info(f'Wrote read QC metrics to {args.qc_output}')
   logging.info('Completed processing')
 
 
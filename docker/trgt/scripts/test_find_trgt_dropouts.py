@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+import array
+import math
+import random
+
+import numpy as np
+import pysam
+import pytest
+
+from find_trgt_dropouts import (
+  DROPOUT_LABELS,
+  PloidyIndex,
+  TandemRepeatCatalog,
+  determine_dropout,
+  determine_dropouts,
+  fetch_reads,
+  load_trgt_catalog,
+  get_ploidy_for_region,
+  load_allosome_ploidy_bed,
+  main,
+  merge_catalog_intervals,
+  rq_from_bq,
+)
+
+
+CONTIGS = {'chr1': 100000, 'chr2': 80000, 'chrX': 60000}
+
+
+def write_spanning_bam(tmp_path, catalog, name, sample=None, seed=1):
+  """Write a sorted, indexed spanning BAM with a mix of haplotagged and failing reads for each catalog region."""
+  rng = random.Random(seed)
+  header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': c, 'LN': n} for c, n in CONTIGS.items()]}
+  if sample:
+    header['RG'] = [{'ID': f'{sample}_rg', 'SM': sample}]
+  reads = []
+  with pysam.AlignmentFile(str(tmp_path / 'unsorted.bam'), 'wb', header=header) as out:
+    for chrom, start, end, label in catalog:
+      trid = label.split(';')[0][3:]
+      for j in range(rng.randint(0, 8)):
+        a = pysam.AlignedSegment(out.header)
+        a.query_name = f'{trid}_read{j}'
+        a.reference_id = out.header.get_tid(chrom)
+        a.reference_start = start - 100
+        a.mapping_quality = 60
+        length = end - start + 200
+        a.query_sequence = 'A' * length
+        a.cigartuples = [(0, length)]
+        a.query_qualities = pysam.qualitystring_to_array(chr(33 + rng.choice([20, 40, 93])) * length)
+        tags = [('TR', trid)]
+        if rng.random() < 0.8:
+          tags.append(('rq', rng.choice([0.95, 0.995, 0.999])))
+        if rng.random() < 0.7:
+          tags.append(('HP', rng.choice([1, 2])))
+        a.set_tags(tags)
+        reads.append(a)
+    for a in reads:
+      out.write(a)
+  bam = str(tmp_path / name)
+  pysam.sort('-o', bam, str(tmp_path / 'unsorted.bam'))
+  pysam.index(bam)
+  return bam
+
+
+@pytest.fixture
+def trgt_catalog(tmp_path):
+  rng = random.Random(1)
+  catalog = []
+  for chrom, length in CONTIGS.items():
+    for i in range(40):
+      start = 1000 + i * (length - 2000) // 40
+      catalog.append((chrom, start, start + rng.randint(20, 200), f'ID={chrom}_{i};MOTIFS=CAG;STRUC=(CAG)n'))
+  return catalog
+
+
+@pytest.fixture
+def trgt_inputs(tmp_path, trgt_catalog):
+  """Write a small catalog, spanning BAM and ploidy BED."""
+  bed = tmp_path / 'catalog.bed'
+  bed.write_text(''.join(f'{c}\t{s}\t{e}\t{label}\n' for c, s, e, label in trgt_catalog))
+  bam = write_spanning_bam(tmp_path, trgt_catalog, 'spanning.bam')
+  ploidy = tmp_path / 'ploidy.bed'
+  ploidy.write_text('chrX\t0\t60000\tnonPAR\t1\n')
+  return str(bed), bam, str(ploidy)
+
+
+def run_main(capsys, argv):
+  main(argv)
+  return capsys.readouterr().out
+
+
+def legacy_get_ploidy_for_region(ploidy_dict, chrom, start, end):
+  for (c, s, e), p in ploidy_dict.items():
+    if c == chrom and start >= s and end <= e:
+      return p
+  return 2
+
+
+def test_ploidy_default_diploid():
+  ploidy_index = load_allosome_ploidy_bed(None)
+  assert len(ploidy_index) == 0
+  assert get_ploidy_for_region(ploidy_index, 'chrX', 100, 200) == 2
+
+
+def test_ploidy_bed(tmp_path):
+  bed = tmp_path / 'ploidy.bed'
+  bed.write_text(
+    '#chrom\tstart\tend\tname\tploidy\n'
+    'chrX\t10000\t2781479\tPAR1\t2\n'
+    'chrX\t2781479\t155701383\tnonPAR\t1\n'
+    'chrY\t2781479\t56887902\tnonPAR\t1\n'
+    'chrY\t10000\n'
+  )
+  ploidy_index = load_allosome_ploidy_bed(str(bed))
+  assert len(ploidy_index) == 3
+  assert get_ploidy_for_region(ploidy_index, 'chrX', 20000, 20100) == 2
+  assert get_ploidy_for_region(ploidy_index, 'chrX', 3000000, 3000100) == 1
+  # spans the PAR1 boundary, so not contained in either region
+  assert get_ploidy_for_region(ploidy_index, 'chrX', 2781400, 2781500) == 2
+  assert get_ploidy_for_region(ploidy_index, 'chrY', 0, 100) == 2
+  assert get_ploidy_for_region(ploidy_index, 'chr1', 20000, 20100) == 2
+
+
+def test_ploidy_index_matches_linear_scan():
+  """Overlapping regions resolve to the first containing region in file order."""
+  rng = random.Random(0)
+  ploidy_dict = {}
+  ploidy_index = PloidyIndex()
+  for _ in range(200):
+    chrom = rng.choice(['chrX', 'chrY'])
+    start = rng.randrange(0, 10000)
+    end = start + rng.randrange(1, 3000)
+    ploidy = rng.choice([0, 1, 2])
+    if (chrom, start, end) not in ploidy_dict:
+      ploidy_dict[(chrom, start, end)] = ploidy
+      ploidy_index.add(chrom, start, end, ploidy)
+  for _ in range(5000):
+    chrom = rng.choice(['chrX', 'chrY', 'chr1'])
+    start = rng.randrange(0, 12000)
+    end = start + rng.randrange(1, 500)
+    assert ploidy_index.get(chrom, start, end) == legacy_get_ploidy_for_region(ploidy_dict, chrom, start, end)
+
+
+def test_threads_match_serial(trgt_inputs, capsys):
+  bed, bam, ploidy = trgt_inputs
+  serial = run_main(capsys, [bed, bam, '-p', ploidy, '-a'])
+  assert len(serial.splitlines()) == 1 + 3 * 40
+  assert run_main(capsys, [bed, bam, '-p', ploidy, '-a', '--threads', '3']) == serial
+  assert run_main(capsys, [bed, bam, '-p', ploidy, '--threads', '2']) == run_main(capsys, [bed, bam, '-p', ploidy])
+
+
+def test_rq_from_bq():
+  rng = random.Random(2)
+  for n in (1, 10, 20000):
+    bq = [rng.randrange(0, 94) for _ in range(n)]
+    expected = 1 - sum(math.pow(10, -0.1 * x) for x in bq) / n
+    assert rq_from_bq(bq) == pytest.approx(expected)
+    assert rq_from_bq(array.array('B', bq)) == pytest.approx(expected)
+  assert rq_from_bq([]) == 0.0
+
+
+def test_fetch_modes_match(trgt_inputs, capsys):
+  bed, bam, ploidy = trgt_inputs
+  full = run_main(capsys, [bed, bam, '-p', ploidy, '-a', '--fetch', 'full'])
+  assert run_main(capsys, [bed, bam, '-p', ploidy, '-a', '--fetch', 'targeted']) == full
+  assert run_main(capsys, [bed, bam, '-p', ploidy, '-a', '--fetch', 'targeted', '--threads', '2']) == full
+  assert run_main(capsys, [bed, bam, '-p', ploidy, '-a', '--fetch', 'targeted', '--chrom', 'chr2']) == run_main(
+    capsys, [bed, bam, '-p', ploidy, '-a', '--fetch', 'full', '--chrom', 'chr2']
+  )
+
+
+def test_targeted_fetch_missing_contig(trgt_inputs, trgt_catalog, tmp_path, capsys):
+  """Catalog loci on a contig that is not in the BAM header are dropouts in every fetch mode."""
+  _, bam, ploidy = trgt_inputs
+  bed = tmp_path / 'chrM.bed'
+  rows = trgt_catalog[:2] + [('chrM', 100, 200, 'ID=chrM_0;MOTIFS=CAG;STRUC=(CAG)n')]
+  bed.write_text(''.join(f'{c}\t{s}\t{e}\t{label}\n' for c, s, e, label in rows))
+  full = run_main(capsys, [str(bed), bam, '-p', ploidy, '-a', '--fetch', 'full'])
+  assert 'chrM_0' in full
+  for fetch in ('targeted', 'auto'):
+    assert run_main(capsys, [str(bed), bam, '-p', ploidy, '-a', '--fetch', fetch]) == full
+  assert run_main(capsys, [str(bed), bam, '-p', ploidy, '-a', '--fetch', 'targeted', '--threads', '2']) == full
+  with pysam.AlignmentFile(bam) as tb:
+    assert list(fetch_reads(tb, 'chrM', [(100, 200)])) == []
+
+
+def test_targeted_fetch_deduplicates_reads(trgt_inputs):
+  _, bam, _ = trgt_inputs
+  windows = [(start, start + 500) for start in range(0, CONTIGS['chr1'], 500)]
+  with pysam.AlignmentFile(bam) as tb:
+    full = sorted(r.query_name for r in fetch_reads(tb, 'chr1'))
+    targeted = sorted(r.query_name for r in fetch_reads(tb, 'chr1', windows))
+  assert len(full) > 0
+  assert targeted == full
+
+
+def test_merge_catalog_intervals():
+  catalog = TandemRepeatCatalog.from_records(
+    [('chr1', 500, 600, 'ID=a'), ('chr1', 100, 200, 'ID=b'), ('chr1', 150, 300, 'ID=c'), ('chr2', 0, 10, 'ID=d')]
+  )
+  assert merge_catalog_intervals(catalog, gap=0) == {'chr1': [(100, 300), (500, 600)], 'chr2': [(0, 10)]}
+  assert merge_catalog_intervals(catalog, gap=250) == {'chr1': [(100, 600)], 'chr2': [(0, 10)]}
+
+
+def test_catalog():
+  catalog = TandemRepeatCatalog.from_records(
+    [('chr1', 100, 200, 'ID=a;MOTIFS=CAG'), ('chr2', 300, 400, 'ID=b;MOTIFS=GAA'), ('chr3', 10, 20, 'MOTIFS=AT;ID=a')]
+  )
+  assert list(catalog) == ['a', 'b']
+  assert 'b' in catalog and 'c' not in catalog
+  # a repeated TR ID replaces the earlier region in its original position
+  tr = catalog['a']
+  assert (tr.chrom, tr.chrom_start, tr.chrom_end, tr.label, tr.trid) == ('chr3', 10, 20, 'MOTIFS=AT;ID=a', 'a')
+  catalog.add_haplotagged_read('a', '1')
+  catalog.add_haplotagged_read('a', 'fail', 3)
+  catalog['b'].add_haplotagged_read('0')
+  assert tr.reads == {'0': 0, '1': 1, '2': 0, 'fail': 3}
+  assert [r.reads['0'] for r in catalog.regions()] == [0, 1]
+
+
+def test_multiple_samples(trgt_inputs, trgt_catalog, tmp_path, capsys):
+  bed, _, ploidy = trgt_inputs
+  bams = {
+    sample: write_spanning_bam(tmp_path, trgt_catalog, f'{sample}.bam', sample, seed)
+    for seed, sample in enumerate(['proband', 'father', 'mother'])
+  }
+  expected = {}
+  for sample, bam in bams.items():
+    lines = run_main(capsys, [bed, bam, '-p', ploidy, '-a']).splitlines()
+    expected[sample] = [line.split('\t') for line in lines[1:]]
+  for threads in ('1', '3'):
+    lines = run_main(capsys, [bed, *bams.values(), '-p', ploidy, '-a', '--threads', threads]).splitlines()
+    assert lines[0].split('\t')[3:6] == ['trid', 'sample', 'expected_ploidy']
+    rows = [line.split('\t') for line in lines[1:]]
+    assert len(rows) == 3 * len(trgt_catalog)
+    # regions in catalog order, samples in command line order
+    assert [row[4] for row in rows[:3]] == list(bams)
+    for sample in bams:
+      assert [row[:4] + row[5:] for row in rows if row[4] == sample] == expected[sample]
+
+
+def test_catalog_cache(trgt_inputs, tmp_path, capsys):
+  bed, bam, ploidy = trgt_inputs
+  cache = tmp_path / 'cache'
+  expected = run_main(capsys, [bed, bam, '-p', ploidy, '-a'])
+  assert run_main(capsys, [bed, bam, '-p', ploidy, '-a', '--catalog-cache', str(cache)]) == expected
+  assert len(list(cache.iterdir())) == 1
+  assert run_main(capsys, [bed, bam, '-p', ploidy, '-a', '--catalog-cache', str(cache)]) == expected
+  assert run_main(capsys, [bed, bam, '-a', '--chrom', 'chr2', '--catalog-cache', str(cache)]) == run_main(
+    capsys, [bed, bam, '-a', '--chrom', 'chr2']
+  )
+  assert len(list(cache.iterdir())) == 2
+
+  parsed = load_trgt_catalog(bed)
+  cached = load_trgt_catalog(bed, cache_dir=str(cache))
+  assert list(cached) == list(parsed)
+  assert [repr(tr) for tr in cached.regions()] == [repr(tr) for tr in parsed.regions()]
+
+
+def test_determine_dropouts_matches_scalar():
+  grid = np.array(np.meshgrid(range(4), range(4), range(4), [0, 1, 2], indexing='ij')).reshape(4, -1)
+  hap1, hap2, unphased, ploidy = grid
+  codes = determine_dropouts(hap1, hap2, unphased, 2, ploidy)
+  for h1, h2, h0, p, code in zip(hap1, hap2, unphased, ploidy, codes):
+    assert DROPOUT_LABELS[code] == determine_dropout(h1, h2, h0, 2, p)
+  with pytest.raises(ValueError):
+    determine_dropouts(hap1, hap2, unphased, 2, np.full_like(ploidy, 3))
+
+
+def test_bgzip_tabix_output(trgt_inputs, tmp_path, capsys):
+  bed, bam, ploidy = trgt_inputs
+  # shuffle the catalog so that tabix output has to be sorted
+  lines = open(bed).read().splitlines(keepends=True)
+  random.Random(3).shuffle(lines)
+  shuffled = tmp_path / 'shuffled.bed'
+  shuffled.write_text(''.join(lines))
+  expected = run_main(capsys, [str(shuffled), bam, '-p', ploidy, '-a']).splitlines()
+
+  plain = tmp_path / 'dropouts.tsv'
+  run_main(capsys, [str(shuffled), bam, '-p', ploidy, '-a', '-o', str(plain)])
+  assert plain.read_text().splitlines() == expected
+
+  output = str(tmp_path / 'dropouts.tsv.gz')
+  run_main(capsys, [str(shuffled), bam, '-p', ploidy, '-a', '-o', output, '--tabix'])
+  with pysam.TabixFile(output) as tbx:
+    region = list(tbx.fetch('chr2', 20000, 40000))
+  assert region == sorted(
+    (line for line in expected[1:] if line.startswith('chr2\t') and 20000 <= int(line.split('\t')[1]) < 40000),
+    key=lambda line: int(line.split('\t')[1]),
+  )
+  assert len(region) > 0
+  with pytest.raises(ValueError):
+    main([bed, bam, '-o', str(plain), '--tabix'])
+
+
+def read_tsv(path):
+  with pysam.BGZFile(path, 'rb') if path.endswith('.gz') else open(path, 'rb') as f:
+    lines = f.read().decode().splitlines()
+  header = lines[0].split('\t')
+  return [dict(zip(header, line.split('\t'))) for line in lines[1:]]
+
+
+def read_tsv_text(text):
+  lines = text.splitlines()
+  header = lines[0].split('\t')
+  return [dict(zip(header, line.split('\t'))) for line in lines[1:]]
+
+
+def test_min_rq(trgt_inputs, capsys):
+  bed, bam, ploidy = trgt_inputs
+  default = read_tsv_text(run_main(capsys, [bed, bam, '-p', ploidy, '-a']))
+  lenient = read_tsv_text(run_main(capsys, [bed, bam, '-p', ploidy, '-a', '--min-rq', '0.9']))
+  strict = read_tsv_text(run_main(capsys, [bed, bam, '-p', ploidy, '-a', '--min-rq', '0.9991']))
+  assert sum(int(row['fail_read_count']) for row in default) > 0
+  assert all(row['fail_read_count'] == '0' for row in lenient)
+  assert sum(int(row['fail_read_count']) for row in strict) > sum(int(row['fail_read_count']) for row in default)
+  columns = ('hap1_count', 'hap2_count', 'unphased_count', 'fail_read_count')
+  for rows in (lenient, strict):
+    assert [sum(int(row[c]) for c in columns) for row in rows] == [
+      sum(int(row[c]) for c in columns) for row in default
+    ]
+
+
+def test_qc_output(trgt_inputs, tmp_path, capsys):
+  bed, bam, ploidy = trgt_inputs
+  qc_path = str(tmp_path / 'qc.tsv')
+  dropouts = read_tsv_text(run_main(capsys, [bed, bam, '-p', ploidy, '-a', '--qc-output', qc_path]))
+  qc = read_tsv(qc_path)
+  assert {row['haplotype'] for row in qc} == {'unphased', 'hap1', 'hap2'}
+
+  reads = {}
+  for row in qc:
+    n = int(row['reads'])
+    assert sum(int(v) for k, v in row.items() if k.startswith('rq_')) == n
+    assert sum(int(v) for k, v in row.items() if k.startswith('mapq_')) == n
+    assert int(row['mapq_ge60']) == n
+    assert int(row['span_len_min']) <= float(row['span_len_mean']) <= int(row['span_len_max'])
+    # fixture reads span the region with 100 bp flanks
+    assert int(row['span_len_min']) == int(row['end']) - int(row['start']) + 200
+    reads[row['trid']] = reads.get(row['trid'], 0) + n
+  columns = ('hap1_count', 'hap2_count', 'unphased_count', 'fail_read_count')
+  assert reads == {
+    row['trid']: sum(int(row[c]) for c in columns) for row in dropouts if any(int(row[c]) for c in columns)
+  }
+
+  for argv in (['--threads', '3'], ['--fetch', 'full']):
+    other = str(tmp_path / f'qc{argv[0]}.tsv.gz')
+    run_main(capsys, [bed, bam, '-p', ploidy, '--qc-output', other, *argv])
+    assert read_tsv(other) == qc
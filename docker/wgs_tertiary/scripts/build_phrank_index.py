@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Build the precompiled Phenotyper index used by calculate_phrank.py --index.
+"""
+
+__version__ = "1.0.0"
+
+import argparse
+
+from calculate_phrank import Phenotyper, read_ensembl_to_hgnc
+
+
+def main(args):
+    phenotyper = Phenotyper(args.hpo_terms_tsv, args.hpo_dag_tsv, args.ensembl_to_hpo_tsv)
+    if args.ensembl_to_hgnc:
+        phenotyper.set_gene_symbols(read_ensembl_to_hgnc(args.ensembl_to_hgnc), args.ensembl_to_hgnc)
+    phenotyper.save(args.index)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("hpo_terms_tsv", help="HPO terms and definitions", type=str)
+    parser.add_argument("hpo_dag_tsv", help="HPO DAG structure (child to parent)", type=str)
+    parser.add_argument("ensembl_to_hpo_tsv", help="Map from Ensembl genes to HPO terms", type=str)
+    parser.add_argument("index", help="Output Phenotyper index (.npz)", type=str)
+    parser.add_argument(
+        "--ensembl-to-hgnc", default=None, help="Map from Ensembl gene ID to HGNC gene symbol to store in the index", type=str
+    )
+    parser.add_argument("--version", action="version", version="%(prog)s (version {version})".format(version=__version__))
+    args = parser.parse_args()
+    main(args)
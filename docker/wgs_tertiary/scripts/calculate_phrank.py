@@ -3,17 +3,120 @@
 Calculate the "Phrank" phenotype match score for a list of phenotypes for every gene.
 """
 
-__version__ = "2.0.0"
+__version__ = "2.1.0"
 
 import argparse
 import collections
+import contextlib
 import functools
+import hashlib
+import heapq
+import itertools
+import json
+import logging
 import math
+import multiprocessing
+import os
+import resource
+import time
+
+import numpy as np
 
 
 HpoTerm = collections.namedtuple("HpoTerm", ["id", "name", "definition"])
 HpoAnnotation = collections.namedtuple("HpoAnnotation", ["term", "gene", "conditions"])
 
+# number of bits set in each byte value
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+# bumped whenever the layout of the arrays written by Phenotyper.save changes
+INDEX_FORMAT_VERSION = 3
+
+
+def file_sha256(path):
+    """Return the hex SHA-256 digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def pack_strings(strings):
+    """Pack strings into a UTF-8 byte array and offsets such that string i is bytes offsets[i]:offsets[i + 1]."""
+    encoded = [s.encode() for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(buffer, offsets):
+    """Inverse of pack_strings."""
+    data = buffer.tobytes()
+    bounds = offsets.tolist()
+    return [data[start:end].decode() for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def peak_rss_mb():
+    """Return (process, children) peak RSS in MB."""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024, children
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, children
+
+
+class Profiler:
+    """Wall time of a run and of its stages, counts of what it processed, and its peak memory."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage, adding to the time of earlier stages with the same name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, **counts):
+        self.counts.update(counts)
+
+    def report(self):
+        rss, children_rss = peak_rss_mb()
+        return {
+            "version": __version__,
+            "stages": self.stages,
+            "wall_time_s": time.perf_counter() - self.start,
+            "counts": self.counts,
+            "peak_rss_mb": rss,
+            "children_peak_rss_mb": children_rss,
+        }
+
+    def write(self, path):
+        """Write the report as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+            f.write("\n")
+
+
+def group_max(keys, values):
+    """Return the unique keys, in sorted order, and the max of values for each."""
+    if len(keys) == 0:
+        return keys, values
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.maximum.reduceat(values[order], starts)
+
 
 class Phenotyper:
     @staticmethod
@@ -22,28 +125,55 @@ class Phenotyper:
         terms in the list and all its ancestors or descendants depending on the dag passed.
         """
         closure = set()
-        def helper(term):
-            # avoid retraversing a subtree
+        # Traverse starting with each term in the term list, without retraversing a subtree
+        stack = list(term_list)
+        while stack:
+            term = stack.pop()
             if term not in closure:
                 closure.add(term)
-                for parent in term_to_relatives.get(term, set()):
-                    helper(parent)
-        # Traverse starting with each term in the term list
-        for term in term_list:
-            helper(term)
+                stack.extend(term_to_relatives.get(term, ()))
         return closure
 
     @staticmethod
-    def canonicalize_annotations(term_to_parents, gene_to_annotations, term_to_annotations):
+    def ancestor_sets(term_to_parents):
+        """Return a map from each term in the DAG to the frozenset of the term and all its ancestors.
+        Sets are built in topological order, parents before children, so each is the union of its
+        parents' sets."""
+        term_to_children = collections.defaultdict(list)
+        pending_parents = dict()
+        for child, parents in term_to_parents.items():
+            pending_parents[child] = len(parents)
+            for parent in parents:
+                term_to_children[parent].append(child)
+                pending_parents.setdefault(parent, len(term_to_parents.get(parent, ())))
+        ancestors = dict()
+        ready = [term for term, n in pending_parents.items() if n == 0]
+        while ready:
+            term = ready.pop()
+            ancestors[term] = frozenset((term,)).union(*[ancestors[p] for p in term_to_parents.get(term, ())])
+            for child in term_to_children[term]:
+                pending_parents[child] -= 1
+                if pending_parents[child] == 0:
+                    ready.append(child)
+        # terms on a cycle are never ready; fall back to traversal for them
+        for term in pending_parents.keys() - ancestors.keys():
+            ancestors[term] = frozenset(Phenotyper.term_closure([term], term_to_parents))
+        return ancestors
+
+    @staticmethod
+    def canonicalize_annotations(term_to_parents, gene_to_annotations, term_to_annotations, ancestors=None):
         # Take the "closure" over gene<->term annotations such that
         # if a gene is annotated with term T, it is also annotated with
         # all the ancestors of T up to the root of the DAG.
+        if ancestors is None:
+            ancestors = Phenotyper.ancestor_sets(term_to_parents)
         for gene_id in gene_to_annotations:
             direct_terms = set([a.term for a in gene_to_annotations[gene_id].values()])
-            closure = Phenotyper.term_closure(direct_terms, term_to_parents)
+            closure = frozenset().union(*[ancestors.get(t, (t,)) for t in direct_terms])
             # Add annotations for terms that are in the closure but not in the
-            # directly annotated terms.
-            for term_id in closure.difference(direct_terms):
+            # directly annotated terms, in sorted order so that the order in which
+            # scores are summed does not depend on the hash seed.
+            for term_id in sorted(closure.difference(direct_terms)):
                 annotation = HpoAnnotation(term_id, gene_id, [])
                 gene_to_annotations[gene_id][term_id] = annotation
                 term_to_annotations[term_id][gene_id] = annotation
@@ -67,6 +197,14 @@ class Phenotyper:
         # the intersection of the gene lists of the parents of the term.  The intersection
         # of the gene lists for the parent terms is guaranteed to be at least as large as
         # the gene list of the term itself because of closure.
+        #
+        # Gene sets are rows of a bit matrix over gene indices, so a parent intersection is a bitwise
+        # and of the parents' rows.
+        gene_index = {g: i for i, g in enumerate(gene_to_annotations)}
+        term_rows = {t: i for i, t in enumerate(term_to_annotations)}
+        term_gene_bits = Phenotyper._term_gene_bits(
+            [[gene_index[g] for g in term_to_annotations[t]] for t in term_rows], len(gene_index)
+        )
         termMarginalIc = dict()
         for term in hpoterms.values():
             if term.id not in term_to_annotations:
@@ -76,53 +214,344 @@ class Phenotyper:
                 if len(parentTerms) == 0:
                     parentIc = 0
                 else:
-                    parentGeneSets = [set([a.gene for g, a in term_to_annotations[t].items()]) for t in parentTerms]
-                    parentIntersection = functools.reduce(lambda a, b: a.intersection(b), parentGeneSets)
-                    parentIc = -math.log(len(parentIntersection) / annotatedGeneCt) / math.log(2)
+                    if len(parentTerms) == 1:
+                        parentIntersectionCt = len(term_to_annotations.get(parentTerms[0], ()))
+                    else:
+                        rows = [term_rows.get(t, -1) for t in parentTerms]
+                        if min(rows) < 0:
+                            parentIntersectionCt = 0
+                        else:
+                            parentIntersectionCt = int(POPCOUNT[np.bitwise_and.reduce(term_gene_bits[rows])].sum())
+                    parentIc = -math.log(parentIntersectionCt / annotatedGeneCt) / math.log(2)
                 termMarginalIc[term.id] = termRawIc[term.id] - parentIc
         return termMarginalIc
 
-    def __init__(self, termsfile, dagfile, annotationsfile):
-        """Initialize the phenotyper with HPO terms, DAG, and gene<->term annotations."""
+    @staticmethod
+    def _term_gene_bits(term_genes, n_genes):
+        """Return a matrix with a row per term of packed bits (as by np.packbits) set for the gene
+        indices in term_genes."""
+        bits = np.zeros((len(term_genes), (n_genes + 7) // 8), dtype=np.uint8)
+        lengths = [len(genes) for genes in term_genes]
+        if sum(lengths) == 0:
+            return bits
+        terms = np.repeat(np.arange(len(term_genes)), lengths)
+        genes = np.fromiter(itertools.chain.from_iterable(term_genes), dtype=np.int64, count=sum(lengths))
+        # combine the bits of genes that share a byte of a term's row
+        cells = terms * bits.shape[1] + (genes >> 3)
+        order = np.argsort(cells, kind="stable")
+        cells = cells[order]
+        gene_bits = (np.uint8(0x80) >> (genes[order] & 7)).astype(np.uint8)
+        first = np.flatnonzero(np.concatenate(([True], cells[1:] != cells[:-1])))
+        bits.reshape(-1)[cells[first]] = np.bitwise_or.reduceat(gene_bits, first)
+        return bits
+
+    def __init__(self, termsfile, dagfile, annotationsfile, profiler=None):
+        """Initialize the phenotyper with HPO terms, DAG, and gene<->term annotations.  If given, the
+        profiler times each stage."""
+        profiler = profiler or Profiler()
+        self._sources = (termsfile, dagfile, annotationsfile)
         # terms
-        self._hpoTerms = {}
-        f = open(termsfile)
-        for line in f:
-            (term_id, term_name, term_defn) = line.rstrip("\n").split("\t")
-            self._hpoTerms[term_id] = HpoTerm(term_id, term_name, term_defn)
-        f.close()
+        with profiler.stage("parse_terms"):
+            self._hpoTerms = {}
+            f = open(termsfile)
+            for line in f:
+                (term_id, term_name, term_defn) = line.rstrip("\n").split("\t")
+                self._hpoTerms[term_id] = HpoTerm(term_id, term_name, term_defn)
+            f.close()
         # bottom-up DAG (child to parents) and top-down DAGs (parent to children)
-        self._buHpoDag = collections.defaultdict(list)
-        self._tdHpoDag = collections.defaultdict(list)
-        f = open(dagfile)
-        for line in f:
-            (child_id, parent_id) = line.rstrip("\n").split("\t")
-            self._buHpoDag[child_id].append(parent_id)
-            self._tdHpoDag[parent_id].append(child_id)
+        with profiler.stage("parse_dag"):
+            self._buHpoDag = collections.defaultdict(list)
+            self._tdHpoDag = collections.defaultdict(list)
+            f = open(dagfile)
+            for line in f:
+                (child_id, parent_id) = line.rstrip("\n").split("\t")
+                self._buHpoDag[child_id].append(parent_id)
+                self._tdHpoDag[parent_id].append(child_id)
         # gene<->terms annotations and term<->genes annotations
-        self._hpoGeneToAnnotations = collections.defaultdict(dict)
-        self._hpoTermToAnnotations = collections.defaultdict(dict)
-        f = open(annotationsfile)
-        for line in f:
-            (gene_id, term_id, conditions) = line.rstrip("\n").split("\t")
-            annotation = HpoAnnotation(term_id, gene_id, conditions.split(","))
-            self._hpoGeneToAnnotations[gene_id][term_id] = annotation
-            self._hpoTermToAnnotations[term_id][gene_id] = annotation
-        f.close()
-        Phenotyper.canonicalize_annotations(
-            self._buHpoDag, self._hpoGeneToAnnotations, self._hpoTermToAnnotations
+        with profiler.stage("parse_annotations"):
+            self._hpoGeneToAnnotations = collections.defaultdict(dict)
+            self._hpoTermToAnnotations = collections.defaultdict(dict)
+            f = open(annotationsfile)
+            for line in f:
+                (gene_id, term_id, conditions) = line.rstrip("\n").split("\t")
+                annotation = HpoAnnotation(term_id, gene_id, conditions.split(","))
+                self._hpoGeneToAnnotations[gene_id][term_id] = annotation
+                self._hpoTermToAnnotations[term_id][gene_id] = annotation
+            f.close()
+        with profiler.stage("ancestors"):
+            self._ancestors = Phenotyper.ancestor_sets(self._buHpoDag)
+        with profiler.stage("canonicalize"):
+            Phenotyper.canonicalize_annotations(
+                self._buHpoDag, self._hpoGeneToAnnotations, self._hpoTermToAnnotations, self._ancestors
+            )
+        with profiler.stage("info_content"):
+            self._termMarginalIc = Phenotyper.compute_term_info_content(
+                self._hpoTerms,
+                self._buHpoDag,
+                self._hpoGeneToAnnotations,
+                self._hpoTermToAnnotations,
+            )
+
+    @classmethod
+    def load(cls, index_path, sources=None):
+        """Load a phenotyper from an index written by save().
+
+        If sources (terms, DAG and annotations files) are given, raise ValueError unless the index
+        was built from files with the same contents.
+        """
+        with np.load(index_path) as index:
+            arrays = {key: index[key] for key in index.files}
+        if int(arrays["version"]) != INDEX_FORMAT_VERSION:
+            raise ValueError(f"{index_path} has index format {int(arrays['version'])}, expected {INDEX_FORMAT_VERSION}")
+        phenotyper = cls.__new__(cls)
+        phenotyper._index = arrays
+        phenotyper._sourceSha256 = unpack_strings(arrays["source_sha256"], arrays["source_sha256_offsets"])
+        if sources is not None and [file_sha256(path) for path in sources] != phenotyper._sourceSha256:
+            raise ValueError(f"{index_path} was built from different HPO files")
+        return phenotyper
+
+    def save(self, index_path):
+        """Write the canonicalized DAG, gene annotation closures and marginal information content to a
+        binary index, so that load() does not need to reparse or recompute them."""
+        term_ids = self._termIds
+        term_index = self._termIndex
+        term_parents = {term_index[child]: [term_index[p] for p in parents] for child, parents in self._buHpoDag.items()}
+        gene_ids = self._geneIds
+        conditions, condition_offsets, annotation_conditions = self._annotationConditions
+        arrays = {"version": np.array(INDEX_FORMAT_VERSION)}
+        for name, strings in (
+            ("source_sha256", [file_sha256(path) for path in self._sources]),
+            ("term_ids", term_ids),
+            ("term_names", [t.name for t in self._hpoTerms.values()]),
+            ("term_definitions", [t.definition for t in self._hpoTerms.values()]),
+            ("gene_ids", gene_ids),
+            ("conditions", conditions),
+            ("symbols", self._geneSymbols[0]),
+            ("symbol_source_sha256", [self._symbolSourceSha256]),
+        ):
+            arrays[name], arrays[f"{name}_offsets"] = pack_strings(strings)
+        arrays["parent_offsets"] = np.cumsum(
+            [0] + [len(term_parents.get(i, [])) for i in range(len(term_ids))], dtype=np.int64
         )
-        self._termMarginalIc = Phenotyper.compute_term_info_content(
-            self._hpoTerms,
-            self._buHpoDag,
-            self._hpoGeneToAnnotations,
-            self._hpoTermToAnnotations,
+        arrays["parents"] = np.array([p for i in range(len(term_ids)) for p in term_parents.get(i, [])], dtype=np.int32)
+        # annotations of each gene, direct and added by closure, are a contiguous run
+        arrays["gene_annotation_offsets"] = np.cumsum(
+            [0] + [len(self._hpoGeneToAnnotations[g]) for g in gene_ids], dtype=np.int64
         )
+        arrays["annotation_terms"] = self._geneTermMatrix[1]
+        arrays["annotation_condition_offsets"] = condition_offsets
+        arrays["annotation_conditions"] = annotation_conditions
+        arrays["ancestor_offsets"], arrays["ancestors"] = self._ancestorMatrix
+        arrays["gene_symbols"] = self._geneSymbols[1]
+        arrays["marginal_ic"] = self._marginalIcVector
+        tmp_path = f"{index_path}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, index_path)
+
+    # Terms and genes are numbered for the array representation used by the index and by vectorized
+    # scoring.  When loaded from an index, the term, DAG and annotation dicts are rebuilt from its
+    # arrays on first use.
+
+    @functools.cached_property
+    def _termIds(self):
+        """Term IDs in the order of the terms file, then any other terms in the DAG or annotations."""
+        if "_index" in self.__dict__:
+            return unpack_strings(self._index["term_ids"], self._index["term_ids_offsets"])
+        term_ids = dict.fromkeys(self._hpoTerms)
+        for child_id, parents in self._buHpoDag.items():
+            term_ids.setdefault(child_id)
+            term_ids.update(dict.fromkeys(parents))
+        for term_id in self._hpoTermToAnnotations:
+            term_ids.setdefault(term_id)
+        return list(term_ids)
+
+    @functools.cached_property
+    def _termIndex(self):
+        return {term_id: i for i, term_id in enumerate(self._termIds)}
+
+    @functools.cached_property
+    def _ancestors(self):
+        """Map from each term in the DAG to the frozenset of the term and all its ancestors."""
+        return Phenotyper.ancestor_sets(self._buHpoDag)
+
+    @functools.cached_property
+    def _ancestorMatrix(self):
+        """Sparse term x term matrix of each term's ancestor closure, as (offsets, term indices) such
+        that the closure of term index i is indices offsets[i]:offsets[i + 1]."""
+        if "_index" in self.__dict__:
+            return self._index["ancestor_offsets"], self._index["ancestors"]
+        term_index = self._termIndex
+        closures = [self._ancestors.get(t, (t,)) for t in self._termIds]
+        offsets = np.cumsum([0] + [len(c) for c in closures], dtype=np.int64)
+        return offsets, np.array([term_index[t] for c in closures for t in c], dtype=np.int32)
+
+    @functools.cached_property
+    def _annotationConditions(self):
+        """Conditions of each annotation, in the order of the gene x term matrix, as (condition IDs,
+        offsets, condition indices) such that annotation i has conditions offsets[i]:offsets[i + 1].
+        Annotations added by closure have no conditions."""
+        if "_index" in self.__dict__:
+            conditions = unpack_strings(self._index["conditions"], self._index["conditions_offsets"])
+            return conditions, self._index["annotation_condition_offsets"], self._index["annotation_conditions"]
+        annotations = [a for g in self._geneIds for a in self._hpoGeneToAnnotations[g].values()]
+        conditions = sorted({s for a in annotations for s in a.conditions})
+        condition_index = {s: i for i, s in enumerate(conditions)}
+        offsets = np.cumsum([0] + [len(a.conditions) for a in annotations], dtype=np.int64)
+        indices = np.array([condition_index[s] for a in annotations for s in a.conditions], dtype=np.int32)
+        return conditions, offsets, indices
+
+    @functools.cached_property
+    def _conditionFacetMatrix(self):
+        """Facets of genes by condition, as (facet genes, facet conditions, facet rows, term indices).
+
+        A (gene, condition) facet is annotated with the terms of the gene's direct annotations for the
+        condition.  Facet rows and term indices are the nonzero entries of the sparse facet x term matrix
+        of the ancestor closures of those terms, with each facet's row the closure of a disease as
+        presented by one gene."""
+        genes, terms = self._geneTermMatrix
+        conditions, condition_offsets, annotation_conditions = self._annotationConditions
+        ancestor_offsets, ancestors = self._ancestorMatrix
+        n_terms = len(self._termIds)
+        # one (facet, term) pair per condition of each direct annotation
+        pair_annotations = np.repeat(np.arange(len(terms)), np.diff(condition_offsets))
+        facet_keys, pair_facets = np.unique(
+            genes[pair_annotations].astype(np.int64) * max(len(conditions), 1) + annotation_conditions,
+            return_inverse=True,
+        )
+        pair_facets = pair_facets.reshape(-1)
+        pair_terms = terms[pair_annotations]
+        # expand each pair to the ancestors of its term, then drop duplicate (facet, ancestor) entries
+        closure_lengths = ancestor_offsets[pair_terms + 1] - ancestor_offsets[pair_terms]
+        closure_pairs = np.repeat(np.arange(len(pair_terms)), closure_lengths)
+        closure_starts = np.cumsum(closure_lengths) - closure_lengths
+        positions = (
+            ancestor_offsets[pair_terms][closure_pairs] + np.arange(len(closure_pairs)) - closure_starts[closure_pairs]
+        )
+        entries = np.unique(pair_facets[closure_pairs].astype(np.int64) * n_terms + ancestors[positions])
+        facet_genes, facet_conditions = np.divmod(facet_keys, max(len(conditions), 1))
+        return facet_genes, facet_conditions, entries // n_terms, entries % n_terms
+
+    @functools.cached_property
+    def _geneSymbols(self):
+        """Gene symbols, sorted, and the index of each gene's symbol.  Unless set by set_gene_symbols,
+        each gene is its own symbol."""
+        if "_index" in self.__dict__:
+            return unpack_strings(self._index["symbols"], self._index["symbols_offsets"]), self._index["gene_symbols"]
+        symbols = sorted(self._geneIds)
+        symbol_index = {s: i for i, s in enumerate(symbols)}
+        return symbols, np.array([symbol_index[g] for g in self._geneIds], dtype=np.int32)
+
+    @functools.cached_property
+    def _symbolSourceSha256(self):
+        if "_index" in self.__dict__:
+            return unpack_strings(self._index["symbol_source_sha256"], self._index["symbol_source_sha256_offsets"])[0]
+        return ""
+
+    @functools.cached_property
+    def _termGeneCounts(self):
+        """Number of genes annotated with each term, including annotations added by closure."""
+        return np.bincount(self._geneTermMatrix[1], minlength=len(self._termIds))
+
+    def _closure_mask(self, term_list):
+        """Return a boolean mask over term indices of the ancestor closure of a list of terms.
+        Terms that are not in the DAG or annotations are ignored, as their information content is 0."""
+        offsets, ancestors = self._ancestorMatrix
+        term_index = self._termIndex
+        mask = np.zeros(len(self._termIds), dtype=bool)
+        for i in {term_index[t] for t in term_list if t in term_index}:
+            mask[ancestors[offsets[i] : offsets[i + 1]]] = True
+        return mask
+
+    @functools.cached_property
+    def _marginalIcVector(self):
+        """Marginal information content by term index."""
+        if "_index" in self.__dict__:
+            return self._index["marginal_ic"]
+        return np.array([self._termMarginalIc.get(t, 0) for t in self._termIds], dtype=np.float64)
+
+    @functools.cached_property
+    def _geneTermMatrix(self):
+        """Sparse gene x term matrix of annotations including those added by closure, as (gene index,
+        term index) arrays in gene order.  Each gene's row is the bit vector of its ancestor closure."""
+        if "_index" in self.__dict__:
+            gene_offsets = self._index["gene_annotation_offsets"]
+            genes = np.repeat(np.arange(len(gene_offsets) - 1, dtype=np.int32), np.diff(gene_offsets))
+            return genes, self._index["annotation_terms"]
+        term_index = self._termIndex
+        genes = np.repeat(
+            np.arange(len(self._geneIds), dtype=np.int32),
+            [len(self._hpoGeneToAnnotations[g]) for g in self._geneIds],
+        )
+        terms = np.array(
+            [term_index[t] for g in self._geneIds for t in self._hpoGeneToAnnotations[g]], dtype=np.int32
+        )
+        return genes, terms
+
+    @functools.cached_property
+    def _hpoTerms(self):
+        names = unpack_strings(self._index["term_names"], self._index["term_names_offsets"])
+        definitions = unpack_strings(self._index["term_definitions"], self._index["term_definitions_offsets"])
+        return {t: HpoTerm(t, name, defn) for t, name, defn in zip(self._termIds, names, definitions)}
+
+    @functools.cached_property
+    def _buHpoDag(self):
+        dag = collections.defaultdict(list)
+        offsets = self._index["parent_offsets"].tolist()
+        parents = [self._termIds[p] for p in self._index["parents"].tolist()]
+        for i, child_id in enumerate(self._termIds):
+            if offsets[i] < offsets[i + 1]:
+                dag[child_id] = parents[offsets[i] : offsets[i + 1]]
+        return dag
+
+    @functools.cached_property
+    def _tdHpoDag(self):
+        dag = collections.defaultdict(list)
+        for child_id, parents in self._buHpoDag.items():
+            for parent_id in parents:
+                dag[parent_id].append(child_id)
+        return dag
+
+    @functools.cached_property
+    def _geneIds(self):
+        if "_index" in self.__dict__:
+            return unpack_strings(self._index["gene_ids"], self._index["gene_ids_offsets"])
+        return list(self._hpoGeneToAnnotations)
+
+    @functools.cached_property
+    def _hpoGeneToAnnotations(self):
+        gene_ids = self._geneIds
+        conditions = unpack_strings(self._index["conditions"], self._index["conditions_offsets"])
+        gene_offsets = self._index["gene_annotation_offsets"].tolist()
+        annotation_terms = [self._termIds[t] for t in self._index["annotation_terms"].tolist()]
+        condition_offsets = self._index["annotation_condition_offsets"].tolist()
+        annotation_conditions = [conditions[s] for s in self._index["annotation_conditions"].tolist()]
+        gene_to_annotations = collections.defaultdict(dict)
+        for g, gene_id in enumerate(gene_ids):
+            for a in range(gene_offsets[g], gene_offsets[g + 1]):
+                term_id = annotation_terms[a]
+                gene_to_annotations[gene_id][term_id] = HpoAnnotation(
+                    term_id, gene_id, annotation_conditions[condition_offsets[a] : condition_offsets[a + 1]]
+                )
+        return gene_to_annotations
+
+    @functools.cached_property
+    def _hpoTermToAnnotations(self):
+        term_to_annotations = collections.defaultdict(dict)
+        for gene_id, annotations in self._hpoGeneToAnnotations.items():
+            for term_id, annotation in annotations.items():
+                term_to_annotations[term_id][gene_id] = annotation
+        return term_to_annotations
+
+    @functools.cached_property
+    def _termMarginalIc(self):
+        return dict(zip(self._hpoTerms, self._index["marginal_ic"].tolist()))
 
     def term_ancestor_closure(self, term_list):
         """Take the closure over a list of terms.  The closure is defined as the
         terms in the list and all ancestors up to the root of the DAG."""
-        return Phenotyper.term_closure(term_list, self._buHpoDag)
+        ancestors = self._ancestors
+        return set().union(*[ancestors.get(t, (t,)) for t in term_list])
 
     def term_descendant_closure(self, term_list):
         """Identify all of the terms in term list or its descendants down
@@ -131,8 +560,9 @@ class Phenotyper:
 
     def _phenotype_information(self, term_list):
         """Find the information content of a list of terms, which is the sum
-        of the marginal information of the terms in the closure of the term list."""
-        return sum([self._termMarginalIc.get(t, 0)for t in self.term_ancestor_closure(term_list)])
+        of the marginal information of the terms in the closure of the term list.  The sum is exact,
+        so it does not depend on the set's iteration order."""
+        return math.fsum([self._termMarginalIc.get(t, 0)for t in self.term_ancestor_closure(term_list)])
 
     def phenotype_score(self, term_list1, term_list2):
         """Find the information content shared by two term lists, which is the
@@ -140,27 +570,96 @@ class Phenotyper:
         the two term lists."""
         return self._phenotype_information(self.term_ancestor_closure(term_list1).intersection(self.term_ancestor_closure(term_list2)))
 
+    def gene_ids(self):
+        """Return the IDs of all annotated genes, in the order of gene_score_array."""
+        return self._geneIds
+
+    def gene_score_array(self, term_list=None):
+        """Return the scores of all_gene_scores as an array in the order of gene_ids.
+
+        Scores are the product of the gene x term closure matrix with the marginal information
+        content of the terms in the closure of the term list, so the query closure is taken once.
+        """
+        genes, terms = self._geneTermMatrix
+        weights = self._marginalIcVector
+        if term_list is not None:
+            weights = np.where(self._closure_mask(term_list), weights, 0)
+        return np.bincount(genes, weights=weights[terms], minlength=len(self._geneIds))
+
+    def condition_facets(self):
+        """Return the (gene ID, condition) facets of all genes, in the order of condition_score_array."""
+        facet_genes, facet_conditions, _, _ = self._conditionFacetMatrix
+        conditions = self._annotationConditions[0]
+        return [(self._geneIds[g], conditions[s]) for g, s in zip(facet_genes.tolist(), facet_conditions.tolist())]
+
+    def condition_score_array(self, term_list=None):
+        """Return the information content shared by the term list and each (gene, condition) facet,
+        in the order of condition_facets.  If no term_list is passed, score each facet against itself."""
+        facet_genes, _, rows, terms = self._conditionFacetMatrix
+        weights = self._marginalIcVector
+        if term_list is not None:
+            weights = np.where(self._closure_mask(term_list), weights, 0)
+        return np.bincount(rows, weights=weights[terms], minlength=len(facet_genes))
+
+    def counts(self):
+        """Return the number of HPO terms, annotated genes and canonical annotations."""
+        return {"terms": len(self._termIds), "genes": len(self.gene_ids()), "annotations": len(self._geneTermMatrix[1])}
+
+    def set_gene_symbols(self, ensembl_to_hgnc, source=None):
+        """Set the symbols that scores are collapsed to from a map of gene ID to symbol; genes without a
+        symbol keep their ID.  The hash of source, the file the map was read from, is saved in the index
+        so that gene_symbols_match can tell whether a loaded phenotyper has the same symbols."""
+        gene_symbols = [ensembl_to_hgnc.get(g, g) for g in self._geneIds]
+        symbols = sorted(set(gene_symbols))
+        symbol_index = {s: i for i, s in enumerate(symbols)}
+        self._geneSymbols = symbols, np.array([symbol_index[s] for s in gene_symbols], dtype=np.int32)
+        self._symbolSourceSha256 = file_sha256(source) if source else ""
+
+    def gene_symbols_match(self, source):
+        """Return whether the gene symbols were set from a file with the same contents as source."""
+        return bool(self._symbolSourceSha256) and self._symbolSourceSha256 == file_sha256(source)
+
+    def symbols(self):
+        """Return the sorted gene symbols, in the order of symbol_score_array."""
+        return self._geneSymbols[0]
+
+    def symbol_score_array(self, term_list=None):
+        """Return the scores of gene_score_array collapsed to gene symbols, keeping the max score of the
+        genes with each symbol, in the order of symbols."""
+        _, scores = group_max(self._geneSymbols[1], self.gene_score_array(term_list))
+        return np.maximum(scores, 0)
+
+    def symbol_condition_scores(self, term_list=None):
+        """Return a map from (gene symbol, condition) to the max score of the (gene, condition) facets of
+        the genes with the symbol."""
+        symbols, gene_symbols = self._geneSymbols
+        facet_genes, facet_conditions, _, _ = self._conditionFacetMatrix
+        conditions = self._annotationConditions[0]
+        n_conditions = max(len(conditions), 1)
+        keys, scores = group_max(
+            gene_symbols[facet_genes].astype(np.int64) * n_conditions + facet_conditions,
+            np.maximum(self.condition_score_array(term_list), 0),
+        )
+        symbol_indices, condition_indices = np.divmod(keys, n_conditions)
+        return {
+            (symbols[g], conditions[s]): score
+            for g, s, score in zip(symbol_indices.tolist(), condition_indices.tolist(), scores.tolist())
+        }
+
     def all_gene_scores(self, term_list=None, facet_by_condition=False):
         """Return a map from gene ID to the information content shared by the
         term list and the annotations applied to the gene, for all annotated genes.
-        If no term_list is passed, then we return the max score for all the genes
+        If no term_list is passed, then we return the max score for all the genes.
+        With facet_by_condition, return a map from condition to such a map for the
+        genes annotated with the condition, with the gene-level map under None.
         """
-        gene_facet_scores = dict()
-        for g, annotations in self._hpoGeneToAnnotations.items():
-            gene_facet_terms = dict()
-            gene_facet_terms[(g, None)] = set(annotations.keys())
-            # define facets
-            if facet_by_condition:
-                for a in annotations.values():
-                    for s in a.conditions:
-                        gene_facet_terms.setdefault((g, s), set()).add(a.term)
-            # compute scores
-            for facet, facet_terms in gene_facet_terms.items():
-                (g, s) = facet
-                gene_facet_scores.setdefault(s, {})[g] = self.phenotype_score(
-                    term_list if term_list is not None else facet_terms, facet_terms
-                )
-        return gene_facet_scores if facet_by_condition else gene_facet_scores[None]
+        gene_scores = dict(zip(self._geneIds, self.gene_score_array(term_list).tolist()))
+        if not facet_by_condition:
+            return gene_scores
+        gene_facet_scores = {None: gene_scores}
+        for (g, s), score in zip(self.condition_facets(), self.condition_score_array(term_list).tolist()):
+            gene_facet_scores.setdefault(s, {})[g] = score
+        return gene_facet_scores
 
     def hpoTermDict(self, hpoId):
         """Return a dictionary that lists details about an HPO term."""
@@ -168,7 +667,7 @@ class Phenotyper:
             "hpoId": hpoId,
             "name": self._hpoTerms[hpoId].name,
             "defn": self._hpoTerms[hpoId].definition,
-            "genesWithTerm": len(self._hpoTermToAnnotations.get(hpoId, [])),
+            "genesWithTerm": int(self._termGeneCounts[self._termIndex[hpoId]]),
         }
 
     def geneAnnotations(self, geneId):
@@ -178,38 +677,162 @@ class Phenotyper:
         """Prune a list of terms to only include "leaf" terms that do not have
         a descendant on the list.  This provides a minimal representation such
         that closure(pruneTerms(termList))==closure(termList)."""
-        prune = set()  # set of terms to prune
-        def helper(term):
-            # Mark a term and its ancestors for pruning,
-            # if it has not already been pruned.
-            if term not in prune:
-                prune.add(term)
-                for p in self._buHpoDag.get(term, []):
-                    helper(p)
         closure = self.term_ancestor_closure(termList)
-        for term in closure:
-            for p in self._buHpoDag.get(term, []):
-                helper(p)
+        # prune the ancestors of the parents of every term in the closure
+        prune = self.term_ancestor_closure([p for term in closure for p in self._buHpoDag.get(term, [])])
         return closure.difference(prune)
 
-def main(args):
-    phenotyper = Phenotyper(args.hpo_terms_tsv, args.hpo_dag_tsv, args.ensembl_to_hpo_tsv)
-    phenotypes = args.phenotypes.split(",")
+def load_phenotyper(args, profiler=None):
+    """Load the phenotyper from args.index if it was built from the given HPO files, or build it from them."""
+    profiler = profiler or Profiler()
+    sources = (args.hpo_terms_tsv, args.hpo_dag_tsv, args.ensembl_to_hpo_tsv)
+    if args.index and os.path.exists(args.index):
+        try:
+            with profiler.stage("load_index"):
+                return Phenotyper.load(args.index, sources)
+        except ValueError as e:
+            logging.warning(f"Not using Phenotyper index: {e}")
+    return Phenotyper(*sources, profiler=profiler)
+
+def load_gene_symbols(phenotyper, path):
+    """Use the gene symbols saved in the phenotyper's index if they were read from the same file as path,
+    or read them from path."""
+    if not phenotyper.gene_symbols_match(path):
+        phenotyper.set_gene_symbols(read_ensembl_to_hgnc(path), path)
+
+def read_ensembl_to_hgnc(path):
+    """Read the map from Ensembl gene ID to HGNC gene symbol."""
     ensembl_to_hgnc = dict()
-    f = open(args.ensembl_to_hgnc)
+    f = open(path)
     for line in f:
         ensg, hgnc = line.rstrip("\n").split("\t")
         ensembl_to_hgnc[ensg] = hgnc
     f.close()
-    fout = open(args.phrank_out_tsv, "w")
-    genescores = phenotyper.all_gene_scores(phenotypes)
-    hgncscores = dict()
-    for ensg in sorted(genescores.keys()):
-        hgnc = ensembl_to_hgnc.get(ensg, ensg)
-        hgncscores[hgnc] = max(genescores[ensg], hgncscores.get(hgnc, 0))
-    for hgnc in sorted(hgncscores.keys()):
-        fout.write(f"{hgnc}\t{hgncscores[hgnc]:0.3f}\n")
-    fout.close()
+    return ensembl_to_hgnc
+
+def hgnc_scores(phenotyper, phenotypes):
+    """Score phenotypes against all genes and collapse to HGNC symbols, keeping the max score of
+    the Ensembl genes with each symbol.  Genes without a symbol keep their Ensembl ID."""
+    return dict(zip(phenotyper.symbols(), phenotyper.symbol_score_array(phenotypes).tolist()))
+
+def hgnc_condition_scores(phenotyper, phenotypes):
+    """Score phenotypes against the (gene, condition) facets of all genes and collapse to (HGNC symbol,
+    condition), keeping the max score.  Annotations without a condition are not faceted."""
+    return {key: score for key, score in phenotyper.symbol_condition_scores(phenotypes).items() if key[1]}
+
+def ranked_scores(hgncscores, top_k=None, min_score=None):
+    """Return (gene symbol, score) pairs with score at least min_score, highest score first and ties
+    by symbol.  Scores are ranked as written, to 3 decimals, so that ties do not depend on their last
+    bits.  With top_k, only the top_k pairs are kept, in a heap of that size."""
+    items = hgncscores.items()
+    if min_score is not None:
+        items = ((hgnc, score) for hgnc, score in items if score >= min_score)
+    key = lambda item: (-round(item[1], 3), item[0])
+    if top_k is not None:
+        return heapq.nsmallest(top_k, items, key=key)
+    return sorted(items, key=key)
+
+def format_scores(hgncscores, sample_id=None, top_k=None, min_score=None, rank=False):
+    """Format scores as TSV lines sorted by gene symbol, with a leading sample ID column if given.
+    With top_k or min_score, only the selected genes are written (see ranked_scores).  With rank,
+    lines are in rank order with a trailing rank column."""
+    prefix = f"{sample_id}\t" if sample_id is not None else ""
+    if top_k is None and min_score is None and not rank:
+        return "".join(f"{prefix}{hgnc}\t{hgncscores[hgnc]:0.3f}\n" for hgnc in sorted(hgncscores.keys()))
+    ranked = ranked_scores(hgncscores, top_k, min_score)
+    if rank:
+        return "".join(f"{prefix}{hgnc}\t{score:0.3f}\t{i}\n" for i, (hgnc, score) in enumerate(ranked, 1))
+    return "".join(f"{prefix}{hgnc}\t{score:0.3f}\n" for hgnc, score in sorted(ranked))
+
+def read_sample_phenotypes(path):
+    """Read (sample ID, HPO term list) pairs from a TSV of sample ID and comma delimited HPO terms.
+    Blank lines and lines starting with # are skipped.  Sample IDs name the --per-sample output files,
+    so empty IDs and IDs with path separators are rejected."""
+    samples = dict()
+    f = open(path)
+    for line in f:
+        if not line.strip() or line.startswith("#"):
+            continue
+        sample_id, _, phenotypes = line.rstrip("\n").partition("\t")
+        if not sample_id or any(c in sample_id for c in ("/", "\0", os.sep, os.altsep) if c):
+            raise ValueError(f"Sample ID {sample_id!r} in {path} is not a valid file name")
+        if sample_id in samples:
+            raise ValueError(f"Sample {sample_id} is listed more than once in {path}")
+        samples[sample_id] = [t for t in phenotypes.replace(" ", "").split(",") if t]
+    f.close()
+    return list(samples.items())
+
+_worker_phenotyper = None
+
+def _init_worker(phenotyper):
+    global _worker_phenotyper
+    _worker_phenotyper = phenotyper
+
+def _score_sample(sample_id, phenotypes, sample_column, format_options):
+    """Score one sample, in a worker process if scoring in parallel, and return its formatted rows."""
+    hgncscores = hgnc_scores(_worker_phenotyper, phenotypes)
+    return sample_id, format_scores(hgncscores, sample_id if sample_column else None, **format_options)
+
+def score_samples(phenotyper, samples, threads=1, sample_column=True, format_options=None):
+    """Yield (sample ID, formatted rows) for each (sample ID, HPO term list) in order, scoring
+    samples in a pool of worker processes if threads > 1.  format_options are passed to format_scores."""
+    tasks = [(sample_id, phenotypes, sample_column, format_options or {}) for sample_id, phenotypes in samples]
+    if threads <= 1:
+        _init_worker(phenotyper)
+        yield from itertools.starmap(_score_sample, tasks)
+        return
+    with multiprocessing.Pool(threads, initializer=_init_worker, initargs=(phenotyper,)) as pool:
+        yield from pool.starmap(_score_sample, tasks, chunksize=max(1, len(tasks) // (4 * threads)))
+
+def score(args, profiler):
+    """Score the phenotypes in args and write the output files."""
+    phenotyper = load_phenotyper(args, profiler)
+    with profiler.stage("gene_symbols"):
+        load_gene_symbols(phenotyper, args.ensembl_to_hgnc)
+    format_options = dict(top_k=args.top_k, min_score=args.min_score, rank=args.rank)
+    if not args.batch:
+        phenotypes = args.phenotypes.split(",")
+        with profiler.stage("score"):
+            hgncscores = hgnc_scores(phenotyper, phenotypes)
+        with profiler.stage("output"):
+            fout = open(args.phrank_out_tsv, "w")
+            fout.write(format_scores(hgncscores, **format_options))
+            fout.close()
+        if args.condition_out:
+            with profiler.stage("condition_score"):
+                conditionscores = hgnc_condition_scores(phenotyper, phenotypes)
+            with profiler.stage("condition_output"):
+                fout = open(args.condition_out, "w")
+                for hgnc, condition in sorted(conditionscores.keys()):
+                    fout.write(f"{hgnc}\t{condition}\t{conditionscores[(hgnc, condition)]:0.3f}\n")
+                fout.close()
+        profiler.count(**phenotyper.counts(), symbols=len(hgncscores), samples=1)
+        return
+    if args.condition_out:
+        raise ValueError("--condition-out is only supported when scoring a single phenotype list")
+    with profiler.stage("read_samples"):
+        samples = read_sample_phenotypes(args.phenotypes)
+    # samples are written as they are scored, so in batch mode the score stage includes the output
+    with profiler.stage("score"):
+        if args.per_sample:
+            # per-sample files have the single sample format, without the sample ID column
+            os.makedirs(args.phrank_out_tsv, exist_ok=True)
+            for sample_id, rows in score_samples(phenotyper, samples, args.threads, False, format_options):
+                fout = open(os.path.join(args.phrank_out_tsv, f"{sample_id}.phrank.tsv"), "w")
+                fout.write(rows)
+                fout.close()
+        else:
+            fout = open(args.phrank_out_tsv, "w")
+            for sample_id, rows in score_samples(phenotyper, samples, args.threads, True, format_options):
+                fout.write(rows)
+            fout.close()
+    profiler.count(**phenotyper.counts(), symbols=len(phenotyper.symbols()), samples=len(samples))
+
+def main(args):
+    profiler = Profiler()
+    score(args, profiler)
+    if args.profile:
+        profiler.write(f"{args.phrank_out_tsv}.profile.json")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -218,8 +841,44 @@ if __name__ == "__main__":
     parser.add_argument("hpo_dag_tsv", help="HPO DAG structure (child to parent)", type=str)
     parser.add_argument("ensembl_to_hpo_tsv", help="Map from Ensembl genes to HPO terms", type=str)
     parser.add_argument("ensembl_to_hgnc", help="Map from Ensembl gene ID to HGNC gene symbol", type=str)
-    parser.add_argument("phenotypes", help="Comma delimited string of HPO terms for phenotypes.", type=str)
-    parser.add_argument("phrank_out_tsv", help="Phrank scores: <gene_symbol><TAB><phrank_score>", type=str)
+    parser.add_argument(
+        "phenotypes",
+        help="Comma delimited string of HPO terms for phenotypes, or with --batch, a TSV of <sample_id><TAB><comma delimited HPO terms>.",
+        type=str,
+    )
+    parser.add_argument(
+        "phrank_out_tsv",
+        help="Phrank scores: <gene_symbol><TAB><phrank_score>; with --batch, <sample_id><TAB><gene_symbol><TAB><phrank_score>, or a directory of <sample_id>.phrank.tsv files with --per-sample.",
+        type=str,
+    )
+    parser.add_argument("--top-k", default=None, help="Only write the top K scoring genes", type=int)
+    parser.add_argument("--min-score", default=None, help="Only write genes with at least this score", type=float)
+    parser.add_argument(
+        "--rank",
+        action="store_true",
+        help="Write genes in order of decreasing score, ties by symbol, with a trailing rank column",
+    )
+    parser.add_argument(
+        "--condition-out",
+        default=None,
+        help="Also write Phrank scores faceted by the OMIM/Orphanet condition of each gene annotation: <gene_symbol><TAB><condition><TAB><phrank_score>",
+        type=str,
+    )
+    parser.add_argument("--batch", action="store_true", help="Score every sample in the phenotypes TSV with one Phenotyper")
+    parser.add_argument("--per-sample", action="store_true", help="With --batch, write one scores file per sample")
+    parser.add_argument("--threads", "-t", default=1, help="With --batch, worker processes for scoring samples", type=int)
+    parser.add_argument(
+        "--index",
+        default=os.environ.get("PHRANK_INDEX"),
+        help="Precompiled Phenotyper index from build_phrank_index.py, used if it matches the HPO files (default: $PHRANK_INDEX)",
+        type=str,
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=os.environ.get("PHRANK_PROFILE", "0") != "0",
+        help="Write the wall time of each stage, counts of terms, genes and annotations, and peak memory to <phrank_out_tsv>.profile.json (default: $PHRANK_PROFILE set and not 0)",
+    )
     parser.add_argument("--version", action="version", version="%(prog)s (version {version})".format(version=__version__))
     args = parser.parse_args()
     main(args)
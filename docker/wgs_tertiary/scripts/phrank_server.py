@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Serve Phenotyper queries as JSON lines on stdin/stdout or a Unix socket, keeping the Phenotyper resident.
+
+Each request is a JSON object on one line:
+
+    {"id": 1, "method": "phenotype_score", "params": {"term_list1": ["HP:0001250"], "term_list2": ["HP:0001263"]}}
+
+and is answered by one line with the same id and either "result" or "error".  Methods and params:
+
+    phenotype_score   term_list1, term_list2
+    all_gene_scores   term_list (optional), facet_by_condition (optional; the gene-level map is under "null")
+    pruneTerms        termList
+    hpoTermDict       hpoId
+
+Term sets are returned as sorted lists.
+"""
+
+__version__ = "1.0.0"
+
+import argparse
+import json
+import logging
+import os
+import socketserver
+import sys
+
+from calculate_phrank import load_phenotyper
+
+# root of the HPO
+ROOT_TERM = "HP:0000001"
+
+METHODS = {
+    "phenotype_score": ("term_list1", "term_list2"),
+    "all_gene_scores": ("term_list", "facet_by_condition"),
+    "pruneTerms": ("termList",),
+    "hpoTermDict": ("hpoId",),
+}
+
+
+def handle_request(phenotyper, request):
+    """Answer one request object, returning the response object."""
+    response = {"id": request.get("id")} if isinstance(request, dict) else {"id": None}
+    try:
+        if not isinstance(request, dict) or request.get("method") not in METHODS:
+            raise ValueError(f"Unknown method; expected one of {', '.join(METHODS)}")
+        params = request.get("params", {})
+        unknown = set(params) - set(METHODS[request["method"]])
+        if unknown:
+            raise ValueError(f"Unknown params for {request['method']}: {', '.join(sorted(unknown))}")
+        result = getattr(phenotyper, request["method"])(**params)
+        if isinstance(result, (set, frozenset)):
+            result = sorted(result)
+        response["result"] = result
+    except (KeyError, TypeError, ValueError) as e:
+        response["error"] = f"{type(e).__name__}: {e}"
+    return response
+
+
+def serve_stream(phenotyper, fin, fout):
+    """Answer JSON-lines requests from fin, text or UTF-8 bytes lines, on fout until fin is closed."""
+    for line in fin:
+        if not line.strip():
+            continue
+        try:
+            if isinstance(line, bytes):
+                line = line.decode()
+            request = json.loads(line)
+        except UnicodeDecodeError as e:
+            response = {"id": None, "error": f"Invalid UTF-8: {e}"}
+        except json.JSONDecodeError as e:
+            response = {"id": None, "error": f"Invalid JSON: {e}"}
+        except (ValueError, RecursionError) as e:
+            # e.g. JSON nested too deeply for the parser
+            response = {"id": None, "error": f"Invalid JSON: {type(e).__name__}: {e}"}
+        else:
+            response = handle_request(phenotyper, request)
+        fout.write(json.dumps(response) + "\n")
+        fout.flush()
+
+
+def serve_socket(phenotyper, path):
+    """Answer JSON-lines requests on a Unix socket, one thread per connection, until interrupted."""
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            serve_stream(phenotyper, self.rfile, _SocketWriter(self.wfile))
+
+    if os.path.exists(path):
+        os.unlink(path)
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+        logging.info(f"Serving Phenotyper queries on {path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+class _SocketWriter:
+    """Text writer over a socket's binary file."""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        self.wfile.write(text.encode())
+
+    def flush(self):
+        self.wfile.flush()
+
+
+def warm_up(phenotyper):
+    """Build the Phenotyper's lazily computed structures before serving, so that no request pays for them
+    and connection threads do not build them concurrently."""
+    phenotyper.all_gene_scores([], facet_by_condition=True)
+    phenotyper.pruneTerms([])
+    # an empty term list would not look up any term's information content
+    phenotyper.phenotype_score([ROOT_TERM], [ROOT_TERM])
+    handle_request(phenotyper, {"method": "hpoTermDict", "params": {"hpoId": ROOT_TERM}})
+
+
+def main(args):
+    phenotyper = load_phenotyper(args)
+    warm_up(phenotyper)
+    if args.socket:
+        serve_socket(phenotyper, args.socket)
+    else:
+        serve_stream(phenotyper, sys.stdin.buffer, sys.stdout)
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%Y%m%dT%H:%M:%S%z", level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("hpo_terms_tsv", help="HPO terms and definitions", type=str)
+    parser.add_argument("hpo_dag_tsv", help="HPO DAG structure (child to parent)", type=str)
+    parser.add_argument("ensembl_to_hpo_tsv", help="Map from Ensembl genes to HPO terms", type=str)
+    parser.add_argument(
+        "--index",
+        default=os.environ.get("PHRANK_INDEX"),
+        help="Precompiled Phenotyper index from build_phrank_index.py, used if it matches the HPO files (default: $PHRANK_INDEX)",
+        type=str,
+    )
+    parser.add_argument("--socket", default=None, help="Serve on this Unix socket path instead of stdin/stdout", type=str)
+    parser.add_argument("--version", action="version", version="%(prog)s (version {version})".format(version=__version__))
+    args = parser.parse_args()
+    main(args)
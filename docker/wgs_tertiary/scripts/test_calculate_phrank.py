@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import functools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from calculate_phrank import Phenotyper, group_max, hgnc_scores, load_gene_symbols, main, read_ensembl_to_hgnc
+
+
+HPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'hpo')
+HPO_TERMS_TSV = os.path.join(HPO_DIR, 'hpoTerms.txt')
+HPO_DAG_TSV = os.path.join(HPO_DIR, 'hpoDag.txt')
+
+
+def write_annotations(path, n_genes=300, seed=1):
+  """Write synthetic Ensembl gene to HPO term annotations over the shipped HPO DAG."""
+  rng = random.Random(seed)
+  children = sorted({line.split('\t')[0] for line in open(HPO_DAG_TSV)})
+  with open(path, 'w') as out:
+    for g in range(n_genes):
+      for term in sorted(rng.sample(children, rng.randint(1, 15))):
+        conditions = ','.join(f'OMIM:{100000 + rng.randrange(40)}' for _ in range(rng.randint(0, 2)))
+        out.write(f'ENSG{g:011d}\t{term}\t{conditions}\n')
+
+
+@pytest.fixture(scope='module')
+def hpo_files(tmp_path_factory):
+  tmp_path = tmp_path_factory.mktemp('hpo')
+  annotations = str(tmp_path / 'ensembl.hpoPhenotype.tsv')
+  write_annotations(annotations)
+  hgnc = tmp_path / 'ensembl.hgncSymbol.tsv'
+  # pairs of Ensembl genes share a symbol; genes past 280 have none
+  hgnc.write_text(''.join(f'ENSG{g:011d}\tGENE{g // 2}\n' for g in range(280)))
+  return HPO_TERMS_TSV, HPO_DAG_TSV, annotations, str(hgnc)
+
+
+@pytest.fixture(scope='module')
+def phenotyper(hpo_files):
+  return Phenotyper(*hpo_files[:3])
+
+
+@pytest.fixture(scope='module')
+def phrank_index(phenotyper, tmp_path_factory):
+  index = str(tmp_path_factory.mktemp('index') / 'phrank.npz')
+  phenotyper.save(index)
+  return index
+
+
+@pytest.fixture(scope='module')
+def query_terms(phenotyper):
+  rng = random.Random(2)
+  return rng.sample(sorted(phenotyper._buHpoDag), 8) + ['HP:9999999']
+
+
+def phrank_args(hpo_files, phenotypes, output, **kwargs):
+  args = argparse.Namespace(
+    hpo_terms_tsv=hpo_files[0],
+    hpo_dag_tsv=hpo_files[1],
+    ensembl_to_hpo_tsv=hpo_files[2],
+    ensembl_to_hgnc=hpo_files[3],
+    phenotypes=','.join(phenotypes),
+    phrank_out_tsv=str(output),
+    index=None,
+    condition_out=None,
+    top_k=None,
+    min_score=None,
+    rank=False,
+    batch=False,
+    per_sample=False,
+    threads=1,
+    profile=False,
+  )
+  for key, value in kwargs.items():
+    setattr(args, key, value)
+  return args
+
+
+def run_main(hpo_files, tmp_path, phenotypes, **kwargs):
+  output = tmp_path / 'phrank.tsv'
+  main(phrank_args(hpo_files, phenotypes, output, **kwargs))
+  return output.read_text()
+
+
+def test_ancestor_sets(phenotyper):
+  dag = phenotyper._buHpoDag
+  ancestors = Phenotyper.ancestor_sets(dag)
+  assert ancestors.keys() == set(dag) | {p for parents in dag.values() for p in parents}
+  for term, closure in ancestors.items():
+    assert closure == Phenotyper.term_closure([term], dag)
+  # a cycle falls back to traversal
+  dag = {'b': ['a', 'c'], 'c': ['b'], 'd': ['c']}
+  assert Phenotyper.ancestor_sets(dag) == {
+    'a': {'a'},
+    'b': {'a', 'b', 'c'},
+    'c': {'a', 'b', 'c'},
+    'd': {'a', 'b', 'c', 'd'},
+  }
+
+
+def test_prune_terms(phenotyper, query_terms):
+  pruned = phenotyper.pruneTerms(query_terms)
+  assert phenotyper.term_ancestor_closure(pruned) == phenotyper.term_ancestor_closure(query_terms)
+  for term in pruned:
+    assert not (phenotyper.term_ancestor_closure([term]) - {term}) & pruned
+  term = query_terms[0]
+  assert phenotyper.pruneTerms([term, *phenotyper._buHpoDag[term]]) == {term}
+
+
+def legacy_compute_term_info_content(hpoterms, term_to_parents, gene_to_annotations, term_to_annotations):
+  """Phenotyper.compute_term_info_content as implemented in calculate_phrank.py 2.0.0."""
+  annotatedGeneCt = len(gene_to_annotations)
+  termRawIc = dict()
+  for term in hpoterms.values():
+    annotations = term_to_annotations.get(term.id, [])
+    termRawIc[term.id] = -math.log(len(annotations) / annotatedGeneCt) / math.log(2) if len(annotations) else 0
+  termMarginalIc = dict()
+  for term in hpoterms.values():
+    if term.id not in term_to_annotations:
+      termMarginalIc[term.id] = 0
+    else:
+      parentTerms = term_to_parents.get(term.id, [])
+      if len(parentTerms) == 0:
+        parentIc = 0
+      else:
+        parentGeneSets = [set([a.gene for g, a in term_to_annotations[t].items()]) for t in parentTerms]
+        parentIntersection = functools.reduce(lambda a, b: a.intersection(b), parentGeneSets)
+        parentIc = -math.log(len(parentIntersection) / annotatedGeneCt) / math.log(2)
+      termMarginalIc[term.id] = termRawIc[term.id] - parentIc
+  return termMarginalIc
+
+
+def test_term_info_content_matches_legacy(phenotyper):
+  args = (
+    phenotyper._hpoTerms,
+    phenotyper._buHpoDag,
+    phenotyper._hpoGeneToAnnotations,
+    collections.defaultdict(dict, phenotyper._hpoTermToAnnotations),
+  )
+  expected = legacy_compute_term_info_content(*args)
+  assert Phenotyper.compute_term_info_content(*args) == expected
+  assert phenotyper._termMarginalIc == expected
+  assert sum(ic != 0 for ic in expected.values()) > 1000
+
+
+def test_term_gene_bits():
+  rng = random.Random(5)
+  for n_genes in (0, 1, 7, 8, 9, 1000):
+    term_genes = [sorted(rng.sample(range(n_genes), rng.randint(0, n_genes))) for _ in range(20)]
+    bits = Phenotyper._term_gene_bits(term_genes, n_genes)
+    for row, genes in zip(bits, term_genes):
+      assert list(map(int, np.flatnonzero(np.unpackbits(row)))) == genes
+
+
+def test_all_gene_scores_match_phenotype_score(phenotyper, query_terms):
+  annotations = phenotyper._hpoGeneToAnnotations
+  for term_list in (query_terms, query_terms[:1], ['HP:9999999'], []):
+    expected = {g: phenotyper.phenotype_score(term_list, set(a)) for g, a in annotations.items()}
+    assert phenotyper.all_gene_scores(term_list) == pytest.approx(expected)
+  expected = {g: phenotyper.phenotype_score(set(a), set(a)) for g, a in annotations.items()}
+  assert phenotyper.all_gene_scores() == pytest.approx(expected)
+  assert list(phenotyper.all_gene_scores(query_terms)) == phenotyper.gene_ids() == list(annotations)
+
+
+def test_condition_facets_match_phenotype_score(phenotyper, query_terms):
+  facets = {}
+  for g, annotations in phenotyper._hpoGeneToAnnotations.items():
+    for a in annotations.values():
+      for s in a.conditions:
+        facets.setdefault(s, {}).setdefault(g, set()).add(a.term)
+  assert '' in facets and len(facets) > 10
+  for term_list in (query_terms, None):
+    faceted = phenotyper.all_gene_scores(term_list, facet_by_condition=True)
+    assert faceted[None] == pytest.approx(phenotyper.all_gene_scores(term_list))
+    assert faceted.keys() == facets.keys() | {None}
+    for s, gene_terms in facets.items():
+      expected = {g: phenotyper.phenotype_score(term_list or terms, terms) for g, terms in gene_terms.items()}
+      assert faceted[s] == pytest.approx(expected)
+
+
+def test_index_round_trip(phenotyper, hpo_files, query_terms, tmp_path):
+  index = str(tmp_path / 'phrank.npz')
+  phenotyper.save(index)
+  loaded = Phenotyper.load(index, hpo_files[:3])
+  assert loaded.all_gene_scores(query_terms) == pytest.approx(phenotyper.all_gene_scores(query_terms))
+  assert loaded.all_gene_scores() == pytest.approx(phenotyper.all_gene_scores())
+  faceted = phenotyper.all_gene_scores(query_terms, facet_by_condition=True)
+  loaded_faceted = loaded.all_gene_scores(query_terms, facet_by_condition=True)
+  assert loaded_faceted.keys() == faceted.keys()
+  for condition, scores in faceted.items():
+    assert loaded_faceted[condition] == pytest.approx(scores)
+  assert loaded.pruneTerms(query_terms) == phenotyper.pruneTerms(query_terms)
+  assert loaded.term_descendant_closure(query_terms[:2]) == phenotyper.term_descendant_closure(query_terms[:2])
+  for term in query_terms[:-1]:
+    assert loaded.hpoTermDict(term) == phenotyper.hpoTermDict(term)
+  for gene in ('ENSG00000000000', 'ENSG00000000123', 'ENSG99999999999'):
+    assert loaded.geneAnnotations(gene) == phenotyper.geneAnnotations(gene)
+
+
+def test_main_index(hpo_files, query_terms, tmp_path):
+  expected = run_main(hpo_files, tmp_path, query_terms)
+  assert len(expected.splitlines()) == 140 + 20
+
+  index = str(tmp_path / 'phrank.npz')
+  Phenotyper(*hpo_files[:3]).save(index)
+  assert run_main(hpo_files, tmp_path, query_terms, index=index) == expected
+
+  # an index built from other annotations is not used
+  other = str(tmp_path / 'other.hpoPhenotype.tsv')
+  write_annotations(other, seed=3)
+  with pytest.raises(ValueError):
+    Phenotyper.load(index, (*hpo_files[:2], other))
+  assert run_main((*hpo_files[:2], other, hpo_files[3]), tmp_path, query_terms, index=index) == run_main(
+    (*hpo_files[:2], other, hpo_files[3]), tmp_path, query_terms
+  )
+
+
+def test_group_max():
+  keys, values = group_max(np.array([3, 1, 3, 0, 1]), np.array([1.0, 5.0, 2.0, -1.0, 4.0]))
+  assert keys.tolist() == [0, 1, 3]
+  assert values.tolist() == [-1.0, 5.0, 2.0]
+  keys, values = group_max(np.array([], dtype=np.int32), np.array([]))
+  assert len(keys) == len(values) == 0
+
+
+def test_gene_symbols(hpo_files, query_terms, tmp_path):
+  phenotyper = Phenotyper(*hpo_files[:3])
+  ensembl_to_hgnc = read_ensembl_to_hgnc(hpo_files[3])
+  genescores = phenotyper.all_gene_scores(query_terms)
+  expected = dict()
+  for ensg, score in genescores.items():
+    hgnc = ensembl_to_hgnc.get(ensg, ensg)
+    expected[hgnc] = max(score, expected.get(hgnc, 0))
+  phenotyper.set_gene_symbols(ensembl_to_hgnc, hpo_files[3])
+  assert phenotyper.symbols() == sorted(expected)
+  assert hgnc_scores(phenotyper, query_terms) == pytest.approx(expected)
+
+  index = str(tmp_path / 'phrank.npz')
+  phenotyper.save(index)
+  loaded = Phenotyper.load(index)
+  assert loaded.gene_symbols_match(hpo_files[3])
+  assert hgnc_scores(loaded, query_terms) == pytest.approx(expected)
+  assert run_main(hpo_files, tmp_path, query_terms, index=index) == run_main(hpo_files, tmp_path, query_terms)
+
+  # symbols read from another file are not used
+  other = str(tmp_path / 'other.hgncSymbol.tsv')
+  with open(other, 'w') as f:
+    f.writelines(f'ENSG{g:011d}\tOTHER{g % 7}\n' for g in range(300))
+  assert not loaded.gene_symbols_match(other)
+  other_files = (*hpo_files[:3], other)
+  assert run_main(other_files, tmp_path, query_terms, index=index) == run_main(other_files, tmp_path, query_terms)
+  assert len(run_main(other_files, tmp_path, query_terms).splitlines()) == 7
+
+
+def test_main_profile(hpo_files, phrank_index, query_terms, tmp_path):
+  output = tmp_path / 'scores.tsv'
+  main(phrank_args(hpo_files, query_terms, output, profile=True))
+  profile = json.loads((tmp_path / 'scores.tsv.profile.json').read_text())
+  assert {'parse_annotations', 'canonicalize', 'info_content', 'score', 'output'} <= set(profile['stages'])
+  # the run's wall time also covers what happens outside the stages
+  assert profile['wall_time_s'] >= sum(profile['stages'].values())
+  assert profile['counts']['genes'] == 300
+  assert profile['counts']['symbols'] == len(output.read_text().splitlines())
+  assert profile['peak_rss_mb'] > 0
+
+  main(phrank_args(hpo_files, query_terms, output, index=phrank_index, profile=True))
+  profile = json.loads((tmp_path / 'scores.tsv.profile.json').read_text())
+  assert 'load_index' in profile['stages'] and 'canonicalize' not in profile['stages']
+  assert profile['counts']['annotations'] == Phenotyper.load(phrank_index).counts()['annotations']
+
+  main(phrank_args(hpo_files, query_terms, tmp_path / 'unprofiled.tsv', index=phrank_index))
+  assert not (tmp_path / 'unprofiled.tsv.profile.json').exists()
+
+
+def test_batch(hpo_files, phrank_index, query_terms, tmp_path):
+  rng = random.Random(4)
+  samples = {f'sample{i}': rng.sample(query_terms, rng.randint(0, 4)) for i in range(6)}
+  batch = tmp_path / 'samples.tsv'
+  batch.write_text('#sample_id\thpo_terms\n' + ''.join(f'{s}\t{",".join(t)}\n' for s, t in samples.items()))
+  single = {sample_id: run_main(hpo_files, tmp_path, terms, index=phrank_index) for sample_id, terms in samples.items()}
+  expected = ''.join(
+    ''.join(f'{sample_id}\t{line}\n' for line in single[sample_id].splitlines()) for sample_id in samples
+  )
+  assert run_main(hpo_files, tmp_path, [str(batch)], batch=True, index=phrank_index) == expected
+  assert run_main(hpo_files, tmp_path, [str(batch)], batch=True, index=phrank_index, threads=3) == expected
+
+  output = tmp_path / 'per_sample'
+  main(phrank_args(hpo_files, [str(batch)], output, batch=True, per_sample=True, threads=2, index=phrank_index))
+  for sample_id in samples:
+    assert (output / f'{sample_id}.phrank.tsv').read_text() == single[sample_id]
+
+  batch.write_text('a\tHP:0000001\nb\t\na\tHP:0000002\n')
+  with pytest.raises(ValueError):
+    run_main(hpo_files, tmp_path, [str(batch)], batch=True, index=phrank_index)
+
+  # sample IDs name the per-sample files, so they cannot leave the output directory
+  for sample_id in ('../escaped', 'sub/sample', ''):
+    batch.write_text(f'a\tHP:0000001\n{sample_id}\tHP:0000002\n')
+    with pytest.raises(ValueError):
+      main(phrank_args(hpo_files, [str(batch)], output, batch=True, per_sample=True, index=phrank_index))
+  assert not (tmp_path / 'escaped.phrank.tsv').exists()
+
+
+def test_main_condition_out(hpo_files, phrank_index, query_terms, tmp_path):
+  phenotyper = Phenotyper.load(phrank_index)
+  symbols = dict(line.rstrip('\n').split('\t') for line in open(hpo_files[3]))
+  faceted = phenotyper.all_gene_scores(query_terms, facet_by_condition=True)
+  expected = {}
+  for condition, scores in faceted.items():
+    if condition:
+      for gene, score in scores.items():
+        key = (symbols.get(gene, gene), condition)
+        expected[key] = max(score, expected.get(key, 0))
+
+  output = tmp_path / 'conditions.tsv'
+  genes = run_main(hpo_files, tmp_path, query_terms, index=phrank_index, condition_out=str(output))
+  assert genes == run_main(hpo_files, tmp_path, query_terms, index=phrank_index)
+  rows = [line.split('\t') for line in output.read_text().splitlines()]
+  assert [(gene, condition) for gene, condition, _ in rows] == sorted(expected)
+  for gene, condition, score in rows:
+    assert float(score) == pytest.approx(expected[(gene, condition)], abs=5e-4)
+
+
+def test_main_top_k_min_score(hpo_files, phrank_index, query_terms, tmp_path):
+  rows = [line.split('\t') for line in run_main(hpo_files, tmp_path, query_terms, index=phrank_index).splitlines()]
+  scores = {gene: float(score) for gene, score in rows}
+  by_rank = sorted(scores, key=lambda gene: (-scores[gene], gene))
+  assert scores[by_rank[9]] > 0
+
+  ranked = run_main(hpo_files, tmp_path, query_terms, index=phrank_index, rank=True).splitlines()
+  assert ranked == [f'{gene}\t{scores[gene]:0.3f}\t{i}' for i, gene in enumerate(by_rank, 1)]
+
+  top = run_main(hpo_files, tmp_path, query_terms, index=phrank_index, top_k=10).splitlines()
+  assert top == [f'{gene}\t{scores[gene]:0.3f}' for gene in sorted(by_rank[:10])]
+  top = run_main(hpo_files, tmp_path, query_terms, index=phrank_index, top_k=10, rank=True).splitlines()
+  assert top == ranked[:10]
+
+  # exactly the scores that are written as at least the threshold
+  threshold = scores[by_rank[9]]
+  selected = run_main(hpo_files, tmp_path, query_terms, index=phrank_index, min_score=threshold - 5e-4)
+  assert selected.splitlines() == [f'{gene}\t{scores[gene]:0.3f}' for gene in sorted(scores) if scores[gene] >= threshold]
+  assert run_main(hpo_files, tmp_path, query_terms, index=phrank_index, min_score=1e6) == ''
+
+  batch = tmp_path / 'samples.tsv'
+  batch.write_text(f'a\t{",".join(query_terms)}\nb\t{query_terms[0]}\n')
+  long = run_main(hpo_files, tmp_path, [str(batch)], batch=True, index=phrank_index, top_k=3, rank=True)
+  assert long.splitlines()[:3] == [f'a\t{line}' for line in ranked[:3]]
+  assert len(long.splitlines()) == 6
+
+
+def test_main_hash_seed(hpo_files, query_terms, tmp_path):
+  """Scores and their ranking do not depend on the hash seed of the Python running the script."""
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calculate_phrank.py')
+  outputs = []
+  for seed in ('0', '1'):
+    output = tmp_path / f'phrank.{seed}.tsv'
+    for options in (['--rank'], ['--top-k', '10']):
+      subprocess.run(
+        [sys.executable, script, *hpo_files, ','.join(query_terms), str(output), *options],
+        capture_output=True, check=True, env={**os.environ, 'PYTHONHASHSEED': seed},
+      )
+      outputs.append(output.read_text())
+  assert outputs[0] and outputs[:2] == outputs[2:]
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of Phrank scoring over the shipped HPO terms and DAG.  Run with pytest-benchmark installed,
+e.g. `pytest test_phrank_benchmark.py --benchmark-only`; skipped without it.
+"""
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from calculate_phrank import Phenotyper, format_scores, hgnc_condition_scores, hgnc_scores, load_gene_symbols
+from test_calculate_phrank import HPO_DAG_TSV, HPO_TERMS_TSV, write_annotations
+
+
+N_GENES = 2000
+QUERY_TERMS = ['HP:0001250', 'HP:0001263', 'HP:0000252', 'HP:0001252', 'HP:0000750']
+
+
+@pytest.fixture(scope='module')
+def hpo_files(tmp_path_factory):
+  tmp_path = tmp_path_factory.mktemp('hpo')
+  annotations = str(tmp_path / 'ensembl.hpoPhenotype.tsv')
+  write_annotations(annotations, n_genes=N_GENES)
+  hgnc = tmp_path / 'ensembl.hgncSymbol.tsv'
+  hgnc.write_text(''.join(f'ENSG{g:011d}\tGENE{g // 2}\n' for g in range(N_GENES)))
+  return HPO_TERMS_TSV, HPO_DAG_TSV, annotations, str(hgnc)
+
+
+@pytest.fixture(scope='module')
+def phenotyper(hpo_files):
+  phenotyper = Phenotyper(*hpo_files[:3])
+  load_gene_symbols(phenotyper, hpo_files[3])
+  return phenotyper
+
+
+@pytest.fixture(scope='module')
+def phrank_index(phenotyper, tmp_path_factory):
+  index = str(tmp_path_factory.mktemp('index') / 'phrank.npz')
+  phenotyper.save(index)
+  return index
+
+
+def test_build_phenotyper(benchmark, hpo_files):
+  phenotyper = benchmark.pedantic(Phenotyper, args=hpo_files[:3], rounds=3)
+  assert len(phenotyper.gene_ids()) == N_GENES
+
+
+def test_ancestor_sets(benchmark, phenotyper):
+  ancestors = benchmark(Phenotyper.ancestor_sets, phenotyper._buHpoDag)
+  assert 'HP:0000001' in ancestors['HP:0001250']
+
+
+def test_load_index(benchmark, phrank_index):
+  # loading is lazy, so include the first query
+  scores = benchmark(lambda: Phenotyper.load(phrank_index).symbol_score_array(QUERY_TERMS))
+  assert len(scores) == N_GENES // 2
+
+
+def test_hgnc_scores(benchmark, phenotyper):
+  scores = benchmark(hgnc_scores, phenotyper, QUERY_TERMS)
+  assert len(scores) == N_GENES // 2
+
+
+def test_hgnc_condition_scores(benchmark, phenotyper):
+  scores = benchmark(hgnc_condition_scores, phenotyper, QUERY_TERMS)
+  assert scores
+
+
+def test_format_scores(benchmark, phenotyper):
+  scores = hgnc_scores(phenotyper, QUERY_TERMS)
+  rows = benchmark(format_scores, scores, 'sample', rank=True)
+  assert len(rows.splitlines()) == len(scores)
+
+
+def test_prune_terms(benchmark, phenotyper):
+  terms = phenotyper.term_ancestor_closure(QUERY_TERMS)
+  pruned = benchmark(phenotyper.pruneTerms, terms)
+  assert set(QUERY_TERMS) & set(phenotyper._termIds) == set(pruned)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+from calculate_phrank import Phenotyper
+from phrank_server import handle_request, serve_socket, serve_stream, warm_up
+from test_calculate_phrank import HPO_DAG_TSV, HPO_TERMS_TSV, write_annotations
+
+
+@pytest.fixture(scope='module')
+def phenotyper(tmp_path_factory):
+  annotations = str(tmp_path_factory.mktemp('hpo') / 'ensembl.hpoPhenotype.tsv')
+  write_annotations(annotations)
+  phenotyper = Phenotyper(HPO_TERMS_TSV, HPO_DAG_TSV, annotations)
+  warm_up(phenotyper)
+  return phenotyper
+
+
+def query(phenotyper, lines):
+  fout = io.StringIO()
+  serve_stream(phenotyper, io.StringIO(''.join(f'{line}\n' for line in lines)), fout)
+  return [json.loads(line) for line in fout.getvalue().splitlines()]
+
+
+def test_serve_stream(phenotyper):
+  terms = ['HP:0001250', 'HP:0001263']
+  requests = [
+    {'id': 1, 'method': 'phenotype_score', 'params': {'term_list1': terms, 'term_list2': ['HP:0000252']}},
+    {'id': 2, 'method': 'all_gene_scores', 'params': {'term_list': terms}},
+    {'id': 3, 'method': 'pruneTerms', 'params': {'termList': [*terms, 'HP:0000118']}},
+    {'id': 'a', 'method': 'hpoTermDict', 'params': {'hpoId': 'HP:0001250'}},
+    {'id': 5, 'method': 'all_gene_scores', 'params': {'term_list': terms, 'facet_by_condition': True}},
+  ]
+  responses = query(phenotyper, [json.dumps(r) for r in requests] + [''])
+  assert [r['id'] for r in responses] == [1, 2, 3, 'a', 5]
+  assert responses[0]['result'] == phenotyper.phenotype_score(terms, ['HP:0000252'])
+  assert responses[1]['result'] == phenotyper.all_gene_scores(terms)
+  assert responses[2]['result'] == sorted(phenotyper.pruneTerms([*terms, 'HP:0000118']))
+  assert responses[3]['result'] == phenotyper.hpoTermDict('HP:0001250')
+  faceted = phenotyper.all_gene_scores(terms, facet_by_condition=True)
+  assert responses[4]['result'] == {('null' if s is None else s): scores for s, scores in faceted.items()}
+
+
+def test_errors(phenotyper):
+  responses = query(
+    phenotyper,
+    [
+      'not json',
+      json.dumps({'id': 1, 'method': 'geneAnnotations', 'params': {'geneId': 'x'}}),
+      json.dumps({'id': 2, 'method': 'hpoTermDict', 'params': {'hpoId': 'HP:9999999'}}),
+      json.dumps({'id': 3, 'method': 'pruneTerms', 'params': {'terms': []}}),
+      json.dumps([1, 2]),
+      json.dumps({'id': 4, 'method': 'pruneTerms', 'params': {'termList': []}}),
+    ],
+  )
+  assert [r['id'] for r in responses] == [None, 1, 2, 3, None, 4]
+  assert all('error' in r for r in responses[:5])
+  assert responses[5] == {'id': 4, 'result': []}
+  assert handle_request(phenotyper, {'method': 'hpoTermDict', 'params': {}})['error'].startswith('TypeError')
+
+
+def test_invalid_requests(phenotyper):
+  responses = query(phenotyper, ['[' * 100000, json.dumps({'id': 1, 'method': 'pruneTerms', 'params': {'termList': []}})])
+  assert responses[0]['id'] is None and responses[0]['error'].startswith('Invalid JSON')
+  assert responses[1] == {'id': 1, 'result': []}
+
+
+def test_warm_up(tmp_path):
+  annotations = str(tmp_path / 'ensembl.hpoPhenotype.tsv')
+  write_annotations(annotations, n_genes=20)
+  phenotyper = Phenotyper(HPO_TERMS_TSV, HPO_DAG_TSV, annotations)
+  index = str(tmp_path / 'phrank.npz')
+  phenotyper.save(index)
+  loaded = Phenotyper.load(index)
+  warm_up(loaded)
+  assert '_termMarginalIc' in loaded.__dict__
+
+
+def start_server(phenotyper, name):
+  """Serve phenotyper on a Unix socket in a daemon thread and return the socket's path."""
+  # AF_UNIX paths are limited to about 100 characters
+  path = os.path.join('/tmp', f'phrank_server_{name}.{os.getpid()}.sock')
+  thread = threading.Thread(target=serve_socket, args=(phenotyper, path), daemon=True)
+  thread.start()
+  for _ in range(100):
+    if os.path.exists(path):
+      break
+    threading.Event().wait(0.05)
+  return path
+
+
+def test_serve_socket(phenotyper):
+  path = start_server(phenotyper, 'test')
+  request = {'id': 7, 'method': 'hpoTermDict', 'params': {'hpoId': 'HP:0001250'}}
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+    client.connect(path)
+    f = client.makefile('rw')
+    for _ in range(3):
+      f.write(json.dumps(request) + '\n')
+      f.flush()
+      assert json.loads(f.readline()) == {'id': 7, 'result': phenotyper.hpoTermDict('HP:0001250')}
+
+
+def test_serve_socket_invalid_utf8(phenotyper):
+  path = start_server(phenotyper, 'utf8')
+  request = {'id': 8, 'method': 'pruneTerms', 'params': {'termList': []}}
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+    client.connect(path)
+    client.sendall(b'{"id": "\xff"}\n' + json.dumps(request).encode() + b'\n')
+    f = client.makefile('r')
+    response = json.loads(f.readline())
+    assert response['id'] is None and response['error'].startswith('Invalid UTF-8')
+    # the connection is still served after the error
+    assert json.loads(f.readline()) == {'id': 8, 'result': []}